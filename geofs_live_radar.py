@@ -4,46 +4,4218 @@ geofs_live_radar.py
 
 Run:
     pip install flask requests
+    pip install brotli          # optional, adds br alongside gzip
+    pip install 'httpx[http2]'  # optional, HTTP/2 to upstream
+    pip install numpy           # optional, vectorized snapshot columns and ?q= filters
+    pip install orjson          # optional, faster JSON parsing and encoding
     python geofs_live_radar.py
 
 Then open http://127.0.0.1:5000
 
+Under gunicorn, use a threaded worker so /api/stream subscribers do not each
+pin a whole worker, e.g.:
+    gunicorn -k gthread --threads 64 geofs_live_radar:app
+Each subscriber still holds one of those threads, so a WSGI worker takes at
+most half its threads in streams (see WSGI_THREADS); serve large numbers of
+subscribers through asgi_app instead.
+
+Or serve everything from one event loop (needs httpx and uvicorn):
+    python geofs_live_radar.py --asgi
+    uvicorn geofs_live_radar:asgi_app --port 5000
+
 Features:
 - Proxies GeoFS public endpoint as /api/map
+- One upstream fetch per CACHE_TTL, shared by all workers (CACHE_DIR)
+- Background poller keeps the snapshot warm; X-Snapshot-Age tells how old it is
+- Server-side callsign tag filtering (?tags=) and field projection (?fields=)
+- One cached tag classifier; each aircraft carries the tags it matched ("tags")
+- Delta updates (?since=<seq>): only added/changed/removed aircraft
+- Each snapshot parsed once into validated columns (NumPy when installed), altitudes in feet
+- Viewport queries (?bbox=) served from a per-snapshot spatial grid
+- Filter expressions (?q=tag:[PMC] alt>20000 type:F-16 near:51.5,-0.1,200nm), cached per snapshot
+- Low-zoom clustering (?zoom=): counts, centroids and dominant type per cell
+- Server-Sent Events push stream at /api/stream (page falls back to polling)
+- Track history with trails at /api/history and time travel at /api/replay?t=
+- Optional on-disk columnar track archive (ARCHIVE_DIR) for days of tracks
+- Compact columnar binary frames for full lists (Accept: application/x-geofs-frame)
+- gzip/brotli compression done once per snapshot/asset, strong ETags and 304s
+- orjson for parsing upstream and encoding answers when installed (stdlib json otherwise)
+- Identical queries share one encoded answer per snapshot (LRU result cache)
+- Pooled keep-alive upstream connection (HTTP/2 with httpx); stats at /api/stats
+- Prometheus metrics at /metrics: upstream, parse and response time histograms, sizes, errors, streams
+- Several upstream mirrors (UPSTREAM_URLS) with hedged requests, health scoring and circuit breakers
+- Scale-out: one ROLE=ingest poller publishes snapshots to any number of ROLE=edge servers
 - Shows all aircraft filtered by keywords
-- Smooth marker updates with heading + callsign labels
+- Smooth marker updates with heading + callsign labels, drawn in one canvas pass
+- Dead reckoning between fixes; update rate adapts to zoom, speed and tab visibility
+- Page networking, decoding and delta merging run in a Web Worker
 - Shows all Aircraft's Details
 - Advanced Search Filter
 """
 
-from flask import Flask, Response, make_response 
+from flask import Flask, Response, request
+from werkzeug.wrappers import Request
 import requests 
+from requests.adapters import HTTPAdapter
 import os
+import asyncio
+import contextlib
+import gzip
+import hashlib
+import importlib.util
+import io
 import json
+import math
+import mmap
+import operator
+import random
+import re
+import shlex
+import socket
+import struct
+import sys
+from array import array
+import tempfile
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+from functools import cached_property, lru_cache
+import itertools
+from itertools import accumulate, repeat
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, cache stays per-process
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # optional: without it responses are gzip-only
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # optional: without it JSON goes through the stdlib json module
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:  # optional: without it snapshot columns are array("d") and filters loop in Python
+    np = None
+
+try:
+    import httpx
+except ImportError:  # optional: without it upstream is fetched over HTTP/1.1 keep-alive
+    httpx = None
+# httpx only speaks HTTP/2 when the h2 package is installed too.
+HTTP2_AVAILABLE = httpx is not None and importlib.util.find_spec("h2") is not None
 
 # ---------------- Config ----------------
-UPSTREAM_URL = "https://mps.geo-fs.com/map"
-TIMEOUT = 3
+UPSTREAM_URL = os.environ.get("UPSTREAM_URL", "https://mps.geo-fs.com/map")
+# Upstream timeouts: establishing the connection, then waiting for the response.
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", 2))
+READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", 3))
+# Keep-alive connections kept open to upstream per worker.
+UPSTREAM_POOL_SIZE = 4
+# Comma-separated upstream endpoints (UPSTREAM_URL plus any mirrors), tried
+# healthiest first; each has its own connection pool and circuit breaker.
+UPSTREAM_URLS = tuple(u.strip() for u in os.environ.get("UPSTREAM_URLS", UPSTREAM_URL).split(",") if u.strip())
+# A fetch still unanswered after the endpoint's recent p95 latency is
+# hedged: the request also goes to the next endpoint and the first answer
+# wins. The deadline is at most HEDGE_MEDIAN_FACTOR times the median, for
+# when more than 5% of answers are slow, and kept between the two bounds.
+# UPSTREAM_HEDGE=0 turns hedging off.
+UPSTREAM_HEDGE = os.environ.get("UPSTREAM_HEDGE", "1") != "0"
+HEDGE_MEDIAN_FACTOR = 4
+HEDGE_MIN_DELAY = 0.15
+HEDGE_MAX_DELAY = READ_TIMEOUT
+# Latency samples kept per endpoint for its p95 and health score.
+UPSTREAM_LATENCY_WINDOW = 64
+# Failures in a row that take an endpoint out of rotation, and how long it
+# stays out before a single trial request may bring it back.
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 3))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 15))
+# Set UPSTREAM_HTTP2=0 to stay on HTTP/1.1 even when httpx[http2] is installed.
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "1") != "0"
 PORT = int(os.environ.get("PORT", 5000))
+# "wsgi" (Flask, threads) or "asgi" (one event loop); `--asgi` on the command line also selects ASGI.
+SERVER_MODE = os.environ.get("SERVER_MODE", "wsgi")
+# How long a fetched /map payload is served before upstream is asked again.
+# Kept a little under POLL_INTERVAL so every poll round finds it due.
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 0.9))
+# Directory shared by all gunicorn workers on this host.
+CACHE_DIR = os.environ.get("CACHE_DIR") or os.path.join(tempfile.gettempdir(), "geofs-live-radar")
+# Background poller cadence, and the ceiling for its backoff while upstream is failing.
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 1.0))
+BACKOFF_MAX = 30
+# Snapshots kept per worker for answering ?since=<seq>; older clients get a full resync.
+DELTA_WINDOW = int(os.environ.get("DELTA_WINDOW", 10))
+# Per-worker cap on /api/stream subscribers (beyond it clients fall back to polling),
+# and how often an idle stream sends a keep-alive comment.
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 500))
+STREAM_KEEPALIVE = 15
+
+def gunicorn_threads():
+    """--threads of the gunicorn command line this process was started from, if any."""
+    if "gunicorn" not in os.path.basename(sys.argv[0]):
+        return None
+    args = shlex.split(os.environ.get("GUNICORN_CMD_ARGS", "")) + sys.argv[1:]
+    for i, arg in enumerate(args):
+        if arg == "--threads" and i + 1 < len(args) and args[i + 1].isdigit():
+            return int(args[i + 1])
+        if arg.startswith("--threads=") and arg[len("--threads="):].isdigit():
+            return int(arg[len("--threads="):])
+    return None
+
+# Request threads per WSGI worker. A WSGI stream holds one for as long as
+# it is open, so only half of them may be streams and the rest stay free
+# for /api/map; beyond that subscribers get a 503 and poll instead. Taken
+# from gunicorn's --threads when it is on the command line (set it here if
+# it comes from a config file).
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS") or gunicorn_threads() or 64)
+WSGI_MAX_STREAMS = max(1, min(MAX_STREAMS, WSGI_THREADS // 2))
+# Cell size of the per-snapshot spatial index behind ?bbox=.
+GRID_CELL_DEG = 2.0
+# Below this map zoom /api/map?zoom= answers with clusters instead of single
+# aircraft; a cluster cell spans about CLUSTER_CELL_PX screen pixels.
+CLUSTER_MAX_ZOOM = int(os.environ.get("CLUSTER_MAX_ZOOM", 6))
+CLUSTER_CELL_PX = 64
+# Per-worker track history behind /api/history and /api/replay: how far back
+# it reaches, and a memory budget that evicts the oldest trails first.
+# HISTORY_SECONDS=0 turns it off. A trail is split where an aircraft went
+# unseen for more than HISTORY_MAX_GAP seconds.
+HISTORY_SECONDS = float(os.environ.get("HISTORY_SECONDS", 3600))
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", 64 * 1024 * 1024))
+HISTORY_CHUNK = 64
+HISTORY_MAX_GAP = float(os.environ.get("HISTORY_MAX_GAP", 10))
+# On-disk track archive (off unless ARCHIVE_DIR is set): one segment file per
+# ARCHIVE_SEGMENT_SECONDS, a sample every ARCHIVE_EVERY seconds, written out
+# every ARCHIVE_FLUSH_SECONDS. See tools/archive.py to query and compact it.
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "")
+ARCHIVE_SEGMENT_SECONDS = int(os.environ.get("ARCHIVE_SEGMENT_SECONDS", 3600))
+ARCHIVE_EVERY = float(os.environ.get("ARCHIVE_EVERY", 5))
+ARCHIVE_FLUSH_SECONDS = float(os.environ.get("ARCHIVE_FLUSH_SECONDS", 120))
+# Deployment role. "standalone" polls upstream in every worker. "ingest"
+# does the same and also publishes each snapshot on BUS_ADDRESS; "edge"
+# never polls upstream and serves the snapshots the ingest node publishes.
+ROLE = os.environ.get("ROLE", "standalone")
+if ROLE not in ("standalone", "ingest", "edge"):
+    raise SystemExit(f"ROLE must be standalone, ingest or edge, not {ROLE!r}")
+# Snapshot bus between the ingest node and edges: "tcp://host:port" or
+# "unix:/path/to.sock". Messages queued per edge before a slow one loses the
+# oldest, how long an edge waits for a message before reconnecting, and how
+# often an ingest worker that found the address taken tries to bind it again.
+BUS_ADDRESS = os.environ.get("BUS_ADDRESS", "tcp://127.0.0.1:5100")
+BUS_QUEUE = 8
+BUS_IDLE_TIMEOUT = 60
+BUS_REBIND = 10
+# Bodies smaller than this are sent uncompressed.
+COMPRESS_MIN_BYTES = 1024
+# JSON library for upstream payloads and responses: orjson when installed,
+# unless JSON_BACKEND=json asks for the standard library.
+JSON_BACKEND = "orjson" if orjson is not None and os.environ.get("JSON_BACKEND") != "json" else "json"
+# Encoded answers kept per worker for identical queries against the same
+# snapshot (see ResultCache): at most this many, and this many body bytes.
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 32 * 1024 * 1024))
+# Each worker writes its metrics to METRICS_DIR every METRICS_SAVE_EVERY
+# seconds from a background thread, and /metrics adds up every worker's
+# file, so a scrape covers the whole host whichever worker it hits.
+METRICS_DIR = os.path.join(CACHE_DIR, "metrics")
+METRICS_SAVE_EVERY = 5
+# Squadron/community tags the page filters on until the user edits its list;
+# a tag matches callsigns containing it, ignoring case.
+DEFAULT_TAGS = (
+    "[U]", "[UTP]", "[P]", "[PMC]", "[NKG-KG]", "[SHL]", "[NFS]", "[AEF]", "lasallian", "butter", "ek-069",
+    "tarun", "massiv4515", "walch", "ljf", "ek-1", "notipa", "est201", "raptor4001", "speedbird",
+    "[WANK]", "[NIUF]", "[TBD]", "[Luftwaffe]", "[BPYR]", "[Luftwafe]", "[MAC]", "[PRC]", "xavier", "tassin",
+    "[TASC]", "[UAC]", "[USSR]", "[JASDF]", "[EVKS]", "[VKS]", "[ACP]", "[PYR]", "[FFL]", "[IOA]", "AF]",
+)
+# Callsigns whose matched tags the classifier remembers, how many custom
+# tags it compiles in beside DEFAULT_TAGS, and how many of those one query
+# may add; tags past either cap are matched separately (see TagClassifier).
+CLASSIFY_CACHE_SIZE = 65536
+CLASSIFY_MAX_TAGS = 512
+CLASSIFY_LEARN_PER_QUERY = 16
+# Callsigns that are never shown, whatever the tag filter says.
+EXCLUDED_CALLSIGNS = {"EventHorizon[USAF]"}
+EXCLUDED_CALLSIGNS_CI = {"randomassguy[u]"}
+
+# ---------------- JSON ----------------
+# Every upstream payload is parsed once and every filtered answer is
+# serialized once (see ResultCache), but at a few thousand aircraft per
+# second those two calls are still most of the CPU a snapshot costs.
+# Encoders return UTF-8 bytes, which orjson writes directly, so bodies never
+# go through an intermediate str.
+def _stdlib_loads(body):
+    return json.loads(body)
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def _orjson_loads(body):
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        # orjson rejects a few documents the stdlib takes, e.g. integers
+        # beyond 64 bits; the stdlib still raises for truly broken ones.
+        return json.loads(body)
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return _stdlib_dumps(obj)
+
+# name -> (decode, encode); tools/bench_json.py times each one.
+JSON_BACKENDS = {"json": (_stdlib_loads, _stdlib_dumps)}
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = (_orjson_loads, _orjson_dumps)
+
+# decode_json(bytes or str) -> object; encode_json(object) -> compact UTF-8 bytes.
+decode_json, encode_json = JSON_BACKENDS[JSON_BACKEND]
+
+# ---------------- Metrics ----------------
+# Prometheus text-format metrics at /metrics. Observing is a bisect and two
+# additions under the metric's own lock, which only that worker's threads
+# ever take, so it stays on in production. Workers never talk to each other:
+# each one saves its totals from a background thread (Metrics.start) and
+# the worker that is scraped merges the other workers' files with its own.
+# The last totals of workers that exited are folded into retired.json, so
+# host-wide counters never go down when a worker is replaced.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(2 ** n for n in range(8, 25, 2))
+
+class Histogram:
+    """Observations counted into fixed buckets, one series per label set."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket ... count above the last, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def values(self):
+        with self._lock:
+            return {labels: list(series) for labels, series in self._series.items()}
+
+    def samples(self, labels, series):
+        cumulative = 0
+        for le, n in zip(self.buckets + ("+Inf",), series):
+            cumulative += n
+            yield "_bucket", labels + (("le", str(le)),), cumulative
+        yield "_sum", labels, series[-1]
+        yield "_count", labels, cumulative
+
+class Tally:
+    """A counter per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + n
+
+    def values(self):
+        with self._lock:
+            return dict(self._series)
+
+    def samples(self, labels, value):
+        yield "", labels, value
+
+class Sampled(Tally):
+    """A counter or gauge read from existing state when metrics are collected.
+
+    `read()` returns {label values: number}. Per-worker values are added up
+    across workers; `host_wide` ones (the snapshot, which every worker
+    shares) are taken from the scraped worker alone.
+    """
+
+    def __init__(self, name, help, read, kind="gauge", labels=(), host_wide=False):
+        super().__init__(name, help, labels)
+        self.read = read
+        self.kind = kind
+        self.host_wide = host_wide
+
+    def values(self):
+        return self.read()
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    """This worker's metrics, saved to `directory` for the other workers to merge."""
+
+    def __init__(self, directory, save_every):
+        self.directory = directory
+        self.save_every = save_every
+        self.metrics = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    def start(self):
+        """Start saving in the background; once per process, like the pollers."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="metrics", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self.save()
+            time.sleep(self.save_every)
+
+    def dump(self):
+        """name -> [[label values, value(s)]] for every per-worker series."""
+        return {m.name: [[list(labels), value] for labels, value in m.values().items()]
+                for m in self.metrics if not getattr(m, "host_wide", False)}
+
+    def _write(self, name, data):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{self.path(name)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(encode_json(data))
+        os.replace(tmp, self.path(name))
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "rb") as f:
+                return decode_json(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def save(self):
+        with contextlib.suppress(OSError):
+            self._write(os.getpid(), self.dump())
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def others(self):
+        """Saved dumps of the other live workers on this host; dead ones are retired."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            pid = name[:-len(".json")]
+            if not name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not self._alive(int(pid)):
+                self._retire(os.path.join(self.directory, name))
+                continue
+            dump = self._read(os.path.join(self.directory, name))
+            if dump is not None:
+                yield dump
+
+    def _retire(self, path):
+        """Add an exited worker's counters and histograms to retired.json."""
+        kinds = {m.name: m.kind for m in self.metrics}
+        with contextlib.ExitStack() as stack:
+            if fcntl is not None:
+                lock = stack.enter_context(open(os.path.join(self.directory, "retired.lock"), "a"))
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another worker may have retired it while we waited.
+            dump = self._read(path)
+            if dump is None:
+                return
+            retired = self._read(self.path("retired")) or {}
+            for name, series in dump.items():
+                if kinds.get(name) not in ("counter", "histogram"):
+                    continue
+                values = {tuple(labels): value for labels, value in retired.get(name, ())}
+                for labels, value in series:
+                    merge_value(values, tuple(labels), value)
+                retired[name] = [[list(labels), value] for labels, value in values.items()]
+            with contextlib.suppress(OSError):
+                self._write("retired", retired)
+                os.unlink(path)
+
+    def collect(self):
+        """(metric, {label values: value(s)}) with every worker, live or retired, added in."""
+        merged = [(m, m.values()) for m in self.metrics]
+        dumps = list(self.others())
+        retired = self._read(self.path("retired"))
+        if retired is not None:
+            dumps.append(retired)
+        for dump in dumps:
+            for m, values in merged:
+                if getattr(m, "host_wide", False):
+                    continue
+                for labels, value in dump.get(m.name, ()):
+                    merge_value(values, tuple(labels), value)
+        return merged
+
+    def render(self):
+        """The Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for m, values in self.collect():
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for labels, value in sorted(values.items()):
+                for suffix, pairs, v in m.samples(tuple(zip(m.labels, labels)), value):
+                    tags = ",".join(f'{k}="{escape_label(lv)}"' for k, lv in pairs)
+                    lines.append(f"{m.name}{suffix}{{{tags}}} {v}" if tags else f"{m.name}{suffix} {v}")
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+def merge_value(values, labels, value):
+    """Add one series' value (a number, or histogram buckets and sum) into `values`."""
+    mine = values.get(labels)
+    if mine is None:
+        values[labels] = value
+    elif isinstance(value, list):
+        values[labels] = [a + b for a, b in zip(mine, value)]
+    else:
+        values[labels] = mine + value
+
+metrics = Metrics(METRICS_DIR, METRICS_SAVE_EVERY)
+upstream_fetch_seconds = metrics.add(Histogram(
+    "radar_upstream_fetch_seconds", "Upstream snapshot fetches, including any hedge or failover"))
+upstream_request_seconds = metrics.add(Histogram(
+    "radar_upstream_request_seconds", "Single upstream requests that succeeded", ("endpoint",)))
+upstream_errors = metrics.add(Tally(
+    "radar_upstream_errors_total", "Upstream requests that failed", ("endpoint", "error")))
+snapshot_parse_seconds = metrics.add(Histogram(
+    "radar_snapshot_parse_seconds", "Parsing and validating an upstream payload into a snapshot"))
+snapshot_compress_seconds = metrics.add(Histogram(
+    "radar_snapshot_compress_seconds", "Precompressing a snapshot's raw body"))
+poll_errors = metrics.add(Tally(
+    "radar_poll_errors_total", "Poll rounds that failed, by exception", ("error",)))
+http_request_seconds = metrics.add(Histogram(
+    "radar_http_request_seconds", "Time to build each response (streams excluded)", ("endpoint",)))
+http_response_bytes = metrics.add(Histogram(
+    "radar_http_response_bytes", "Response body size as sent (streams excluded)", ("endpoint",), SIZE_BUCKETS))
+http_requests = metrics.add(Tally(
+    "radar_http_requests_total", "Responses by endpoint and status", ("endpoint", "status")))
+stream_events = metrics.add(Tally(
+    "radar_stream_events_total", "Map events sent to /api/stream subscribers"))
+
+# ---------------- Snapshot cache ----------------
+class SnapshotCache:
+    """Latest upstream /map payload, shared by every worker on the host.
+
+    Each process keeps the payload in memory. When it goes stale the process
+    looks at the copy on disk in CACHE_DIR, and only if that is stale too does
+    it fetch upstream, holding an exclusive file lock so that concurrent misses
+    in this and all sibling workers collapse into a single upstream request.
+    """
+
+    def __init__(self, fetch, ttl, cache_dir):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.path = os.path.join(cache_dir, "map.bin")
+        self.lock_path = os.path.join(cache_dir, "map.lock")
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._alock = None
+        # (body, fetched_at, seq); seq grows by one per upstream fetch, host-wide.
+        self._entry = None
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry[1] < self.ttl
+
+    def get(self):
+        """Return (body, fetched_at, seq), fetching upstream at most once per TTL."""
+        entry = self._entry
+        if self._fresh(entry):
+            return entry
+        with self._lock:
+            entry = self._entry
+            if self._fresh(entry):
+                return entry
+            if fcntl is None:
+                started = time.time()
+                self._entry = (self.fetch(), started, self._next_seq(entry, None))
+                return self._entry
+            shared = self._read_shared()
+            if self._fresh(shared):
+                self._entry = shared
+                return shared
+            with open(self.lock_path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # Another worker may have refreshed while we waited.
+                    shared = self._read_shared()
+                    if self._fresh(shared):
+                        self._entry = shared
+                    else:
+                        started = time.time()
+                        self._entry = (self.fetch(), started, self._next_seq(entry, shared))
+                        self._write_shared(self._entry)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            return self._entry
+
+    async def aget(self, afetch):
+        """get() for the event loop, fetching with the coroutine function `afetch`."""
+        entry = self._entry
+        if self._fresh(entry):
+            return entry
+        if self._alock is None:
+            self._alock = asyncio.Lock()
+        async with self._alock:
+            entry = self._entry
+            if self._fresh(entry):
+                return entry
+            if fcntl is None:
+                started = time.time()
+                self._entry = (await afetch(), started, self._next_seq(entry, None))
+                return self._entry
+            shared = self._read_shared()
+            if self._fresh(shared):
+                self._entry = shared
+                return shared
+            with open(self.lock_path, "a") as lock:
+                # flock blocks, so wait for it off the loop.
+                await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+                try:
+                    shared = self._read_shared()
+                    if self._fresh(shared):
+                        self._entry = shared
+                    else:
+                        started = time.time()
+                        self._entry = (await afetch(), started, self._next_seq(entry, shared))
+                        self._write_shared(self._entry)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            return self._entry
+
+    @staticmethod
+    def _next_seq(*entries):
+        return max([e[2] for e in entries if e] + [0]) + 1
+
+    def _read_shared(self):
+        """The on-disk entry, fresh or not, or None if missing/corrupt."""
+        try:
+            with open(self.path, "rb") as f:
+                header, body = f.read().split(b"\n", 1)
+            fetched_at, seq = header.split()
+            return body, float(fetched_at), int(seq)
+        except (OSError, ValueError):
+            return None
+
+    def _write_shared(self, entry):
+        body, fetched_at, seq = entry
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"%r %d\n" % (fetched_at, seq))
+            f.write(body)
+        os.replace(tmp, self.path)
+
+# ---------------- Upstream client ----------------
+class UpstreamClient:
+    """Persistent, pooled connection to the GeoFS map endpoint.
+
+    Uses httpx with HTTP/2 when it is installed, otherwise a requests
+    Session with a keep-alive pool. Either way it counts requests and new
+    connections (TCP+TLS handshakes) so connection reuse can be checked.
+    """
+
+    def __init__(self, url, connect_timeout, read_timeout, pool_size, http2):
+        self.url = url
+        self.requests = 0
+        self.errors = 0
+        self.http_version = None
+        self._handshakes = 0
+        if http2 and HTTP2_AVAILABLE:
+            self.backend = "httpx"
+            self._client = httpx.Client(
+                http2=True,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+        else:
+            self.backend = "requests"
+            self._timeout = (connect_timeout, read_timeout)
+            self._session = requests.Session()
+            self._adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            self._session.mount("https://", self._adapter)
+            self._session.mount("http://", self._adapter)
+
+    def fetch(self):
+        """POST to upstream and return the response body."""
+        self.requests += 1
+        try:
+            if self.backend == "httpx":
+                r = self._client.post(self.url, data={}, extensions={"trace": self._trace})
+                self.http_version = r.http_version
+            else:
+                r = self._session.post(self.url, data={}, timeout=self._timeout)
+                self.http_version = "HTTP/1.1" if r.raw.version == 11 else "HTTP/1.0"
+            r.raise_for_status()
+            return r.content
+        except Exception:
+            self.errors += 1
+            raise
+
+    def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self._handshakes += 1
+
+    def handshakes(self):
+        if self.backend != "requests":
+            return self._handshakes
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()))
+
+    def stats(self):
+        handshakes = self.handshakes()
+        return {
+            "backend": self.backend,
+            "http_version": self.http_version,
+            "requests": self.requests,
+            "errors": self.errors,
+            "handshakes": handshakes,
+            "reuse_ratio": round(1 - handshakes / self.requests, 4) if self.requests else None,
+        }
+
+class AsyncUpstreamClient(UpstreamClient):
+    """UpstreamClient for ASGI mode, on httpx.AsyncClient."""
+
+    def __init__(self, url, connect_timeout, read_timeout, pool_size, http2):
+        if httpx is None:
+            raise RuntimeError("ASGI mode needs httpx: pip install 'httpx[http2]'")
+        self.url = url
+        self.requests = 0
+        self.errors = 0
+        self.http_version = None
+        self._handshakes = 0
+        self.backend = "httpx-async"
+        self._client = httpx.AsyncClient(
+            http2=http2 and HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def fetch(self):
+        self.requests += 1
+        try:
+            r = await self._client.post(self.url, data={}, extensions={"trace": self._atrace})
+            self.http_version = r.http_version
+            r.raise_for_status()
+            return r.content
+        except Exception:
+            self.errors += 1
+            raise
+
+    async def _atrace(self, event, info):
+        self._trace(event, info)
+
+def percentile(samples, q):
+    """The `q` quantile (0..1) of `samples`, or None if there are none."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+class EndpointHealth:
+    """Recent latencies, failures and circuit breaker of one upstream endpoint.
+
+    The circuit opens after `max_failures` failures in a row. Once it has
+    been open for `cooldown` seconds it is half-open: one trial request may
+    go through, and its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, window, max_failures, cooldown):
+        self.latencies = deque(maxlen=window)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.opens = 0
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def acquire(self):
+        """True if a request may go to this endpoint now; claims the half-open trial."""
+        with self._lock:
+            state = self.state()
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return state == "closed"
+
+    def release(self):
+        """Give back a trial whose request was abandoned."""
+        with self._lock:
+            self.trial = False
+
+    def succeeded(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.max_failures):
+                self.opened_at = time.monotonic()
+                self.opens += 1
+            self.trial = False
+
+    def hedge_after(self):
+        """Seconds to give a request before hedging it, or None while there are too few samples."""
+        if len(self.latencies) < 8:
+            return None
+        p95 = percentile(self.latencies, 0.95)
+        median = percentile(self.latencies, 0.5)
+        return min(p95, median * HEDGE_MEDIAN_FACTOR)
+
+    def score(self):
+        """Lower is better: median latency, doubled for each recent failure."""
+        median = percentile(self.latencies, 0.5) or 0.0
+        return (median + 0.01) * 2 ** min(self.failures, 10)
+
+    def stats(self):
+        p50, p95 = percentile(self.latencies, 0.5), percentile(self.latencies, 0.95)
+        return {"state": self.state(), "failures": self.failures, "opens": self.opens,
+                "p50": round(p50, 4) if p50 is not None else None,
+                "p95": round(p95, 4) if p95 is not None else None}
+
+class UpstreamPool:
+    """Every upstream endpoint behind one fetch(), with hedging and failover.
+
+    fetch() asks the healthiest endpoint whose circuit lets it through. If
+    that has not answered by its hedge deadline (see hedge_delay), the
+    request also goes to the next endpoint (or, with a single endpoint,
+    again over another pooled connection) and the first answer wins. A
+    failed request fails over to the next endpoint at once. A hedge's
+    loser is left to finish in the background, so it still counts toward
+    its endpoint's health.
+
+    One fetch makes at most one attempt per candidate, and the thread pool
+    has room for two fetches' worth. A hedge is only sent while at least
+    two threads are idle, so losers still running from earlier fetches can
+    never hold every thread and queue the next first attempt or failover
+    behind them; a hedge skipped for that is counted in hedge_skipped.
+    """
+
+    client_class = UpstreamClient
+
+    def __init__(self, urls, connect_timeout, read_timeout, pool_size, http2, hedge=True):
+        self.clients = [self.client_class(url, connect_timeout, read_timeout, pool_size, http2)
+                        for url in urls]
+        self.health = [EndpointHealth(UPSTREAM_LATENCY_WINDOW, BREAKER_FAILURES, BREAKER_COOLDOWN)
+                       for _ in urls]
+        self.read_timeout = read_timeout
+        self.hedge = hedge
+        self.latencies = deque(maxlen=UPSTREAM_LATENCY_WINDOW)
+        self.hedged = self.hedge_wins = self.hedge_skipped = self.failovers = self.rejected = 0
+        self.workers = 2 * max(len(self.clients), 2)
+        self._executor = None
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+
+    def candidates(self):
+        """Endpoint indexes to try, healthiest first. A half-open endpoint
+        comes before all of them, so that it gets its trial request; failover
+        and hedging cover for it if that goes badly. A lone endpoint is
+        listed twice so that it can still be hedged."""
+        usable = [i for i, h in enumerate(self.health) if h.state() != "open"]
+        usable.sort(key=lambda i: (self.health[i].state() != "half-open", self.health[i].score()))
+        return usable * 2 if len(self.clients) == 1 else usable
+
+    def hedge_delay(self, i):
+        """Seconds to wait on endpoint `i` before hedging, or None not to hedge."""
+        if not self.hedge:
+            return None
+        after = self.health[i].hedge_after()
+        if after is None:
+            return self.read_timeout / 2
+        return min(max(after, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def _next(self, candidates):
+        for i in candidates:
+            if self.health[i].acquire():
+                return i
+        return None
+
+    def _attempt(self, i):
+        started = time.monotonic()
+        try:
+            body = self.clients[i].fetch()
+        except Exception as e:
+            self.health[i].failed()
+            upstream_errors.inc(self.clients[i].url, type(e).__name__)
+            raise
+        self._succeeded(i, time.monotonic() - started)
+        return body
+
+    def _succeeded(self, i, latency):
+        self.health[i].succeeded(latency)
+        upstream_request_seconds.observe(latency, self.clients[i].url)
+
+    def _fetched(self, started):
+        latency = time.monotonic() - started
+        self.latencies.append(latency)
+        upstream_fetch_seconds.observe(latency)
+
+    def _submit(self, i):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="upstream")
+        with self._busy_lock:
+            self._busy += 1
+        future = self._executor.submit(self._attempt, i)
+        future.add_done_callback(self._idle)
+        return future
+
+    def _idle(self, future):
+        with self._busy_lock:
+            self._busy -= 1
+
+    def _can_hedge(self):
+        with self._busy_lock:
+            return self._busy + 2 <= self.workers
+
+    def fetch(self):
+        """POST to the best upstream endpoint (hedged) and return the response body."""
+        started = time.monotonic()
+        candidates = iter(self.candidates())
+        first = self._next(candidates)
+        if first is None:
+            self.rejected += 1
+            raise RuntimeError("every upstream endpoint is out of rotation (circuit open)")
+        pending = {self._submit(first)}
+        hedges = set()
+        timeout, error = self.hedge_delay(first), None
+        while pending:
+            done, pending = wait(pending, timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # The first request is late: hedge it, if a thread is free.
+                timeout = None
+                if not self._can_hedge():
+                    self.hedge_skipped += 1
+                    continue
+                i = self._next(candidates)
+                if i is not None:
+                    self.hedged += 1
+                    hedge = self._submit(i)
+                    hedges.add(hedge)
+                    pending.add(hedge)
+                continue
+            for f in done:
+                if f.exception() is None:
+                    if f in hedges:
+                        self.hedge_wins += 1
+                    self._fetched(started)
+                    return f.result()
+                error = f.exception()
+            if not pending:
+                i = self._next(candidates)
+                if i is not None:
+                    self.failovers += 1
+                    pending.add(self._submit(i))
+        raise error
+
+    def stats(self):
+        clients = [c.stats() for c in self.clients]
+        requests = sum(c["requests"] for c in clients)
+        handshakes = sum(c["handshakes"] for c in clients)
+        p50, p95 = percentile(self.latencies, 0.5), percentile(self.latencies, 0.95)
+        return {
+            "backend": clients[0]["backend"],
+            "http_version": next((c["http_version"] for c in clients if c["http_version"]), None),
+            "requests": requests,
+            "errors": sum(c["errors"] for c in clients),
+            "handshakes": handshakes,
+            "reuse_ratio": round(1 - handshakes / requests, 4) if requests else None,
+            "fetch_p50": round(p50, 4) if p50 is not None else None,
+            "fetch_p95": round(p95, 4) if p95 is not None else None,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_skipped": self.hedge_skipped,
+            "failovers": self.failovers,
+            "rejected": self.rejected,
+            "endpoints": [{"url": c.url, **h.stats(), **{k: s[k] for k in ("requests", "errors", "http_version")}}
+                          for c, h, s in zip(self.clients, self.health, clients)],
+        }
+
+class AsyncUpstreamPool(UpstreamPool):
+    """UpstreamPool for ASGI mode: each attempt is a task on the event loop."""
+
+    client_class = AsyncUpstreamClient
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Hedge losers still running; held so they are not garbage-collected.
+        self._stragglers = set()
+
+    async def _attempt(self, i):
+        started = time.monotonic()
+        try:
+            body = await self.clients[i].fetch()
+        except asyncio.CancelledError:
+            self.health[i].release()
+            raise
+        except Exception as e:
+            self.health[i].failed()
+            upstream_errors.inc(self.clients[i].url, type(e).__name__)
+            raise
+        self._succeeded(i, time.monotonic() - started)
+        return body
+
+    def _straggle(self, tasks):
+        for task in tasks:
+            self._stragglers.add(task)
+            task.add_done_callback(self._reap)
+
+    def _reap(self, task):
+        self._stragglers.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    async def fetch(self):
+        started = time.monotonic()
+        candidates = iter(self.candidates())
+        first = self._next(candidates)
+        if first is None:
+            self.rejected += 1
+            raise RuntimeError("every upstream endpoint is out of rotation (circuit open)")
+        pending = {asyncio.ensure_future(self._attempt(first))}
+        hedges = set()
+        timeout, error = self.hedge_delay(first), None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    timeout = None
+                    i = self._next(candidates)
+                    if i is not None:
+                        self.hedged += 1
+                        hedge = asyncio.ensure_future(self._attempt(i))
+                        hedges.add(hedge)
+                        pending.add(hedge)
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        if task in hedges:
+                            self.hedge_wins += 1
+                        self._fetched(started)
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    i = self._next(candidates)
+                    if i is not None:
+                        self.failovers += 1
+                        pending.add(asyncio.ensure_future(self._attempt(i)))
+        finally:
+            self._straggle(pending)
+        raise error
+
+upstream = UpstreamPool(UPSTREAM_URLS, CONNECT_TIMEOUT, READ_TIMEOUT, UPSTREAM_POOL_SIZE, UPSTREAM_HTTP2,
+                        UPSTREAM_HEDGE)
+snapshot_cache = SnapshotCache(upstream.fetch, CACHE_TTL, CACHE_DIR)
+
+# ---------------- Track history ----------------
+# A bounded, in-memory record of where every aircraft has been, fed by the
+# poller and read by /api/history (one trail) and /api/replay (the whole
+# world at a past time). Samples are quantized to integers
+#
+#   t (0.1 s), lat/lon (1e-5 deg, ~1 m), alt (m), heading (deg), speed (kt)
+#
+# and kept per aircraft in chunks of up to HISTORY_CHUNK samples. A closed
+# chunk is one bytes object, stored column by column: the first sample as
+# six int64s, then per field the differences between consecutive samples in
+# the narrowest of int8/16/32/64 that holds them. For an aircraft polled
+# every second that is about eight bytes a sample, and decoding is a couple
+# of array/accumulate calls per column rather than a Python loop per byte.
+HISTORY_FIELDS = 6
+HISTORY_BASE = struct.Struct("<6q")
+NO_VALUE = -1  # heading/speed missing from the upstream record
+_DELTA_TYPES = [(code, 1 << (8 * array(code).itemsize - 1)) for code in "bhiq"]
+
+def encode_samples(rows):
+    """Column-wise delta encoding of a non-empty list of 6-int tuples."""
+    columns = list(zip(*rows))
+    codes, parts = [], []
+    for col in columns:
+        deltas = [b - a for a, b in zip(col, col[1:])]
+        widest = max(map(abs, deltas), default=0)
+        code = next(c for c, limit in _DELTA_TYPES if widest < limit)
+        codes.append(code)
+        parts.append(_le(array(code, deltas)).tobytes())
+    return HISTORY_BASE.pack(*rows[0]) + "".join(codes).encode() + b"".join(parts)
+
+def _delta_columns(blob):
+    """[(first value, array of deltas)] per field of an encoded chunk."""
+    base = HISTORY_BASE.unpack_from(blob)
+    offset = HISTORY_BASE.size + HISTORY_FIELDS
+    codes = blob[HISTORY_BASE.size:offset].decode()
+    count = (len(blob) - offset) // sum(array(code).itemsize for code in codes)
+    columns = []
+    for first, code in zip(base, codes):
+        deltas = array(code)
+        end = offset + count * deltas.itemsize
+        deltas.frombytes(blob[offset:end])
+        offset = end
+        columns.append((first, _le(deltas)))
+    return columns
+
+def decode_samples(blob):
+    """Inverse of encode_samples, as a tuple of rows ordered by time."""
+    return tuple(zip(*(accumulate(deltas, initial=first) for first, deltas in _delta_columns(blob))))
+
+class DecodedChunks:
+    """Decoded closed chunks within a byte budget, least recently used first out.
+
+    Trails keep asking for the same recent chunks, so each is decoded once
+    while it stays popular; TrackHistory drops a chunk's entry when it
+    evicts the chunk.
+    """
+
+    # A decoded sample is a tuple of six ints: about this many bytes.
+    ROW_BYTES = 200
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, blob):
+        with self._lock:
+            rows = self._rows.get(blob)
+            if rows is not None:
+                self._rows.move_to_end(blob)
+                return rows
+        rows = decode_samples(blob)
+        cost = len(rows) * self.ROW_BYTES
+        with self._lock:
+            if blob not in self._rows and cost <= self.max_bytes:
+                self._rows[blob] = rows
+                self.bytes += cost
+                while self.bytes > self.max_bytes:
+                    _, old = self._rows.popitem(last=False)
+                    self.bytes -= len(old) * self.ROW_BYTES
+        return rows
+
+    def discard(self, blob):
+        with self._lock:
+            rows = self._rows.pop(blob, None)
+            if rows is not None:
+                self.bytes -= len(rows) * self.ROW_BYTES
+
+def sample_at(blob, t):
+    """The last sample of an encoded chunk taken at or before `t`, or None.
+
+    Only the time column is expanded; the other fields are summed up to the
+    matching index, which is what keeps a whole-world replay cheap.
+    """
+    (t0, dt), *rest = _delta_columns(blob)
+    i = bisect_right(list(accumulate(dt, initial=t0)), t) - 1
+    if i < 0:
+        return None
+    return (t0 + sum(dt[:i]), *(first + sum(deltas[:i]) for first, deltas in rest))
+
+def quantize(u, t):
+    """One history sample (a tuple of ints) for user record `u` seen at `t`, or None."""
+    pos = position(u)
+    if pos is None:
+        return None
+    co = u["co"]
+    alt = _number(co[2]) if len(co) > 2 else math.nan
+    hdg = _number(co[3]) if len(co) > 3 else math.nan
+    st = u.get("st")
+    spd = _number(st.get("as")) if isinstance(st, dict) else math.nan
+    return (round(t * 10), round(pos[0] * 1e5), round(pos[1] * 1e5),
+            round(alt) if math.isfinite(alt) else 0,
+            round(hdg) % 360 if math.isfinite(hdg) else NO_VALUE,
+            round(spd) if math.isfinite(spd) and spd >= 0 else NO_VALUE)
+
+class Timing:
+    """Count, mean and max of a repeated operation, in milliseconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {"count": self.count, "mean": round(mean * 1000, 3), "max": round(self.max * 1000, 3)}
+
+class TrackChunk:
+    """Up to HISTORY_CHUNK consecutive samples of one aircraft.
+
+    Open chunks collect plain tuples in `rows`; closing one encodes them into
+    `blob`, after which the chunk never changes.
+    """
+    __slots__ = ("key", "start", "end", "count", "rows", "blob")
+
+    def __init__(self, key):
+        self.key = key
+        self.start = self.end = None
+        self.count = 0
+        self.rows = []
+        self.blob = None
+
+    def samples(self):
+        return decode_samples(self.blob) if self.blob is not None else tuple(self.rows)
+
+    # Rough per-chunk object overhead and per-row cost of an open chunk's
+    # plain tuples, so that caps on HISTORY_MAX_BYTES stay honest for
+    # aircraft that only flew briefly.
+    OVERHEAD = 120
+    OPEN_ROW_BYTES = 64
+
+    def size(self):
+        return self.OVERHEAD + (len(self.blob) if self.blob is not None else self.OPEN_ROW_BYTES * len(self.rows))
+
+class Track:
+    """History of one aircraft: its latest callsign/type and its chunks, oldest first."""
+    __slots__ = ("meta", "chunks")
+
+    def __init__(self):
+        self.meta = None
+        self.chunks = deque()
+
+class TrackHistory:
+    """Per-aircraft trails over the last `seconds`, using at most about `max_bytes`.
+
+    Fed one snapshot at a time by record(), from the poller thread (or a
+    worker thread in ASGI mode); queries may run concurrently from request
+    threads. An eighth of the budget goes to decoded chunks (DecodedChunks),
+    the rest to open and closed chunks. Closed chunks are evicted
+    oldest-first once they fall out of the window or the chunks go over
+    their share. A chunk closes when it is
+    full, when the aircraft misses a poll, or after `max_gap` seconds
+    without a sample, so a trail never interpolates across a gap.
+    """
+
+    def __init__(self, seconds, max_bytes, chunk=64, max_gap=10.0):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.chunk = chunk
+        self.max_gap = max_gap
+        self.tracks = {}
+        self.closed = deque()
+        self.decoded = DecodedChunks(max_bytes // 8)
+        # Bytes of closed chunks, and of the chunks still being filled.
+        self.bytes = 0
+        self.open_bytes = 0
+        self.samples = 0
+        self.evicted = 0
+        self.timings = {"record": Timing(), "history": Timing(), "replay": Timing()}
+        self._lock = threading.Lock()
+
+    def record(self, snap):
+        """Append one sample per aircraft in `snap`, then evict what is over budget."""
+        started = time.perf_counter()
+        t = snap.fetched_at
+        gap = round(self.max_gap * 10)
+        seen = set()
+        with self._lock:
+            for u in snap.valid_users:
+                key = aircraft_id(u)
+                row = quantize(u, t) if key is not None else None
+                if row is None or key in seen:
+                    continue
+                seen.add(key)
+                track = self.tracks.get(key)
+                if track is None:
+                    track = self.tracks[key] = Track()
+                track.meta = (u.get("cs"), u.get("ac"), u.get("acid"))
+                current = track.chunks[-1] if track.chunks else None
+                if current is not None and current.blob is None and row[0] - current.end > gap:
+                    self._close(current)
+                    current = None
+                if current is None or current.blob is not None:
+                    current = TrackChunk(key)
+                    current.start = row[0]
+                    track.chunks.append(current)
+                    self.open_bytes += TrackChunk.OVERHEAD
+                elif row[0] <= current.end:
+                    continue
+                current.rows.append(row)
+                self.open_bytes += TrackChunk.OPEN_ROW_BYTES
+                current.end = row[0]
+                current.count += 1
+                self.samples += 1
+                if current.count >= self.chunk:
+                    self._close(current)
+            for key, track in self.tracks.items():
+                current = track.chunks[-1] if track.chunks else None
+                if key not in seen and current is not None and current.blob is None:
+                    self._close(current)
+            self._evict(round((t - self.seconds) * 10))
+        self.timings["record"].add(time.perf_counter() - started)
+
+    def _close(self, chunk):
+        self.open_bytes -= chunk.size()
+        chunk.blob = encode_samples(chunk.rows)
+        chunk.rows = None
+        self.closed.append(chunk)
+        self.bytes += chunk.size()
+
+    def _evict(self, horizon):
+        budget = self.max_bytes - self.decoded.max_bytes
+        while self.closed and (self.bytes + self.open_bytes > budget or self.closed[0].end < horizon):
+            chunk = self.closed.popleft()
+            self.bytes -= chunk.size()
+            self.decoded.discard(chunk.blob)
+            self.samples -= chunk.count
+            self.evicted += 1
+            track = self.tracks.get(chunk.key)
+            if track is None:
+                continue
+            # Chunks close in order per aircraft, so this is the track's oldest.
+            if track.chunks and track.chunks[0] is chunk:
+                track.chunks.popleft()
+            if not track.chunks:
+                del self.tracks[chunk.key]
+
+    def _chunks(self, key):
+        """(meta, [(start, end, samples)]) for one aircraft, copied under the lock."""
+        with self._lock:
+            track = self.tracks.get(key)
+            if track is None:
+                return None, []
+            return track.meta, [(c.start, c.end, c.blob if c.blob is not None else tuple(c.rows))
+                                for c in track.chunks]
+
+    def trail(self, key, t_from, t_to):
+        """(meta, samples) of aircraft `key` with from <= t <= to (unix seconds)."""
+        started = time.perf_counter()
+        lo, hi = round(t_from * 10), round(t_to * 10)
+        meta, chunks = self._chunks(key)
+        rows = []
+        for start, end, data in chunks:
+            if end < lo or start > hi:
+                continue
+            samples = self.decoded.get(data) if isinstance(data, bytes) else data
+            rows += samples[bisect_right(samples, (lo,)):bisect_right(samples, (hi, math.inf))]
+        self.timings["history"].add(time.perf_counter() - started)
+        return meta, rows
+
+    def at(self, t):
+        """[(key, meta, sample)]: each aircraft's last sample at or before `t`.
+
+        Aircraft whose last sample is more than max_gap older than `t` (or
+        that had not appeared yet) are left out.
+        """
+        started = time.perf_counter()
+        tq = round(t * 10)
+        lo = tq - round(self.max_gap * 10)
+        picked = []
+        with self._lock:
+            for key, track in self.tracks.items():
+                for c in reversed(track.chunks):
+                    if c.start <= tq:
+                        if c.end >= lo:
+                            picked.append((key, track.meta, c.blob if c.blob is not None else tuple(c.rows)))
+                        break
+        found = []
+        for key, meta, data in picked:
+            if isinstance(data, bytes):
+                row = sample_at(data, tq)
+            else:
+                i = bisect_right(data, (tq, math.inf))
+                row = data[i - 1] if i else None
+            if row is not None and row[0] >= lo:
+                found.append((key, meta, row))
+        self.timings["replay"].add(time.perf_counter() - started)
+        return found
+
+    def replay(self, t):
+        """A Snapshot rebuilt from history as of `t`, for the usual payload encoders."""
+        users = []
+        for key, (cs, ac, acid), (_, lat, lon, alt, hdg, spd) in self.at(t):
+            users.append({
+                "id": key, "acid": acid, "cs": cs, "ac": ac,
+                "co": [lat / 1e5, lon / 1e5, alt, None if hdg == NO_VALUE else hdg],
+                "st": {"as": None if spd == NO_VALUE else spd},
+            })
+        return Snapshot(None, tuple(users), len(users), t, 0)
+
+    def oldest(self):
+        with self._lock:
+            starts = [track.chunks[0].start for track in self.tracks.values() if track.chunks]
+        return min(starts) / 10 if starts else None
+
+    def stats(self):
+        with self._lock:
+            open_rows = sum(t.chunks[-1].count for t in self.tracks.values()
+                            if t.chunks and t.chunks[-1].blob is None)
+            return {
+                "tracks": len(self.tracks),
+                "chunks": len(self.closed),
+                "samples": self.samples,
+                "open_samples": open_rows,
+                "bytes": self.bytes,
+                "open_bytes": self.open_bytes,
+                "decoded_bytes": self.decoded.bytes,
+                "max_bytes": self.max_bytes,
+                "bytes_per_sample": round(self.bytes / max(1, self.samples - open_rows), 2),
+                "evicted_chunks": self.evicted,
+                "timings_ms": {name: t.summary() for name, t in self.timings.items()},
+            }
+
+track_history = (TrackHistory(HISTORY_SECONDS, HISTORY_MAX_BYTES, HISTORY_CHUNK, HISTORY_MAX_GAP)
+                 if HISTORY_SECONDS > 0 else None)
+
+# ---------------- Track archive ----------------
+# Days of tracks on disk, for reviewing events after the in-memory history
+# has moved on. One append-only segment file per ARCHIVE_SEGMENT_SECONDS
+# window ("tracks-<window start>.seg"), written by a single worker per host
+# and read through mmap. A segment is a run of blocks:
+#
+#   header   magic "TBK1", u32 rows, u32 ids, f64 t_min, f64 t_max,
+#            u32 payload length                                    (32 bytes)
+#   f64[rows]        t (unix seconds)
+#   f32[rows] x5     lat, lon, alt (m), heading, speed (kt; NaN if missing)
+#   u16[rows]        aircraft type (0xFFFF if missing)
+#   u32[ids+1]       first row of each id; rows are sorted by (id, t)
+#   u32[2*ids+1]     string offsets: id i is strings[off[2i]:off[2i+1]],
+#                    its callsign strings[off[2i+1]:off[2i+2]]
+#   utf-8 string table
+#
+# Blocks follow each other in time order, so their (t_min, t_max) pairs are
+# a sparse time index. When its window is over a segment is sealed with a
+# JSON footer holding that index plus a per-id index of (block, first row,
+# end row), followed by u64 footer length and magic "TIX1"; an id query on a
+# sealed segment then reads only that aircraft's rows. Unsealed segments
+# (the one being written, or one left by a crash) are indexed by walking the
+# block headers, and a torn last block is ignored.
+ARCHIVE_BLOCK = struct.Struct("<4sIIddI")
+ARCHIVE_BLOCK_MAGIC = b"TBK1"
+ARCHIVE_FOOTER = struct.Struct("<Q4s")
+ARCHIVE_FOOTER_MAGIC = b"TIX1"
+ARCHIVE_COLUMNS = (("t", "d"), ("lat", "f"), ("lon", "f"), ("alt", "f"), ("hdg", "f"), ("spd", "f"),
+                   ("ac", "H"))
+
+def archive_row(u, t):
+    """(id, callsign, t, lat, lon, alt, hdg, spd, ac) for user record `u`, or None."""
+    key = aircraft_id(u)
+    pos = position(u) if key is not None else None
+    if pos is None:
+        return None
+    co = u["co"]
+    st = u.get("st")
+    ac = u.get("ac")
+    cs = u.get("cs")
+    return (key, cs.strip() if isinstance(cs, str) else "", t, pos[0], pos[1],
+            _number(co[2]) if len(co) > 2 else math.nan,
+            _number(co[3]) if len(co) > 3 else math.nan,
+            _number(st.get("as")) if isinstance(st, dict) else math.nan,
+            ac if isinstance(ac, int) and 0 <= ac < NO_U16 else NO_U16)
+
+def encode_block(rows):
+    """One block from archive rows (any order). Returns (bytes, {id: (first, end)})."""
+    rows = sorted(rows, key=lambda r: (r[0], r[2]))
+    columns = [array(code) for _, code in ARCHIVE_COLUMNS]
+    starts = array("I")
+    offsets = array("I", [0])
+    strings = bytearray()
+    ranges = {}
+    for i, row in enumerate(rows):
+        key = row[0]
+        if not starts or rows[i - 1][0] != key:
+            if starts:
+                ranges[rows[i - 1][0]] = (starts[-1], i)
+                strings += rows[i - 1][1].encode("utf-8")
+                offsets.append(len(strings))
+            starts.append(i)
+            strings += key.encode("utf-8")
+            offsets.append(len(strings))
+        for col, value in zip(columns, row[2:]):
+            col.append(value)
+    if rows:
+        ranges[rows[-1][0]] = (starts[-1], len(rows))
+        strings += rows[-1][1].encode("utf-8")
+        offsets.append(len(strings))
+    starts.append(len(rows))
+    t = columns[0]
+    payload = b"".join(_le(a).tobytes() for a in (*columns, starts, offsets)) + bytes(strings)
+    header = ARCHIVE_BLOCK.pack(ARCHIVE_BLOCK_MAGIC, len(rows), len(ranges),
+                                min(t, default=0.0), max(t, default=0.0), len(payload))
+    return header + payload, ranges
+
+class ArchiveBlock:
+    """Read-only view of one block inside a mapped segment."""
+
+    def __init__(self, buf, offset):
+        magic, self.rows, self.nids, self.t_min, self.t_max, length = ARCHIVE_BLOCK.unpack_from(buf, offset)
+        if magic != ARCHIVE_BLOCK_MAGIC:
+            raise ValueError(f"no archive block at offset {offset}")
+        self.buf = buf
+        self.offset = offset
+        self.end = offset + ARCHIVE_BLOCK.size + length
+        pos = offset + ARCHIVE_BLOCK.size
+        self._columns = {}
+        for name, code in ARCHIVE_COLUMNS:
+            self._columns[name] = (pos, code)
+            pos += self.rows * array(code).itemsize
+        self._starts = pos
+        self._offsets = pos + 4 * (self.nids + 1)
+        self._strings = self._offsets + 4 * (2 * self.nids + 1)
+
+    def _array(self, code, pos, start, end):
+        a = array(code)
+        size = a.itemsize
+        a.frombytes(self.buf[pos + start * size:pos + end * size])
+        return _le(a)
+
+    def column(self, name, start=0, end=None):
+        pos, code = self._columns[name]
+        return self._array(code, pos, start, self.rows if end is None else end)
+
+    def rows_between(self, start=0, end=None):
+        """Row tuples (t, lat, lon, alt, hdg, spd, ac) for rows [start, end)."""
+        return list(zip(*(self.column(name, start, end) for name, _ in ARCHIVE_COLUMNS)))
+
+    def callsign_at(self, row):
+        """Callsign of the aircraft whose rows start at `row`."""
+        starts = self._array("I", self._starts, 0, self.nids + 1)
+        i = bisect_right(starts, row) - 1
+        a, b = self._array("I", self._offsets, 2 * i + 1, 2 * i + 3)
+        return bytes(self.buf[self._strings + a:self._strings + b]).decode("utf-8")
+
+    def ids(self):
+        """[(id, callsign, first row, end row)] in id order."""
+        starts = self._array("I", self._starts, 0, self.nids + 1)
+        offsets = self._array("I", self._offsets, 0, 2 * self.nids + 1)
+        base = self._strings
+        text = bytes(self.buf[base:base + offsets[-1]])
+        return [(text[offsets[2 * i]:offsets[2 * i + 1]].decode("utf-8"),
+                 text[offsets[2 * i + 1]:offsets[2 * i + 2]].decode("utf-8"),
+                 starts[i], starts[i + 1]) for i in range(self.nids)]
+
+def scan_blocks(buf, start=0):
+    """[ArchiveBlock] from `start` until the footer, the end of `buf` or a torn block."""
+    blocks = []
+    pos = start
+    while pos + ARCHIVE_BLOCK.size <= len(buf) and buf[pos:pos + 4] == ARCHIVE_BLOCK_MAGIC:
+        block = ArchiveBlock(buf, pos)
+        if block.end > len(buf):
+            break
+        blocks.append(block)
+        pos = block.end
+    return blocks
+
+def read_footer(buf):
+    """The sealed index of a segment, or None if it is not sealed."""
+    if len(buf) < ARCHIVE_FOOTER.size:
+        return None
+    length, magic = ARCHIVE_FOOTER.unpack_from(buf, len(buf) - ARCHIVE_FOOTER.size)
+    if magic != ARCHIVE_FOOTER_MAGIC or length > len(buf) - ARCHIVE_FOOTER.size:
+        return None
+    end = len(buf) - ARCHIVE_FOOTER.size
+    return json.loads(bytes(buf[end - length:end]))
+
+def build_footer(start, end, blocks):
+    """Footer bytes sealing a segment of `blocks` covering [start, end)."""
+    index = {"start": start, "end": end, "blocks": [], "ids": {}}
+    for n, block in enumerate(blocks):
+        index["blocks"].append([block.offset, block.rows, block.t_min, block.t_max])
+        for key, _, first, last in block.ids():
+            index["ids"].setdefault(key, []).append([n, first, last])
+    body = json.dumps(index, separators=(",", ":")).encode()
+    return body + ARCHIVE_FOOTER.pack(len(body), ARCHIVE_FOOTER_MAGIC)
+
+def segment_start(path):
+    name = os.path.basename(path)
+    return int(name[len("tracks-"):-len(".seg")])
+
+class ArchiveSegment:
+    """Index of one segment file; sealed segments are indexed from their footer."""
+
+    def __init__(self, path, window):
+        self.path = path
+        self.start = segment_start(path)
+        self.end = self.start + window
+        self.sealed = False
+        self.blocks = []  # [(offset, rows, t_min, t_max)]
+        self.ids = None   # id -> [(block number, first row, end row)], sealed segments only
+        with self.mapped() as buf:
+            footer = read_footer(buf)
+            if footer is not None:
+                self.sealed = True
+                self.start, self.end = footer["start"], footer["end"]
+                self.blocks = [tuple(b) for b in footer["blocks"]]
+                self.ids = footer["ids"]
+            else:
+                self.blocks = [(b.offset, b.rows, b.t_min, b.t_max) for b in scan_blocks(buf)]
+
+    @contextlib.contextmanager
+    def mapped(self):
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+class ArchiveReader:
+    """Range queries over the segments in an archive directory."""
+
+    def __init__(self, directory, window=None):
+        self.directory = directory
+        self.window = window or ARCHIVE_SEGMENT_SECONDS
+        self._segments = {}  # path -> ((size, mtime), ArchiveSegment)
+
+    def segments(self, t_from=-math.inf, t_to=math.inf):
+        """ArchiveSegments overlapping [t_from, t_to], oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        found = []
+        for name in sorted(names, key=lambda n: (len(n), n)):
+            if not (name.startswith("tracks-") and name.endswith(".seg")):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+                cached = self._segments.get(path)
+                if cached is None or cached[0] != (st.st_size, st.st_mtime_ns):
+                    cached = self._segments[path] = ((st.st_size, st.st_mtime_ns),
+                                                     ArchiveSegment(path, self.window))
+            except (OSError, ValueError):
+                continue
+            seg = cached[1]
+            if seg.start <= t_to and seg.end >= t_from:
+                found.append(seg)
+        return found
+
+    def trail(self, key, t_from, t_to):
+        """(callsign, [(t, lat, lon, alt, hdg, spd, ac)]) of aircraft `key`, oldest first."""
+        cs, rows = None, []
+        for seg in self.segments(t_from, t_to):
+            with seg.mapped() as buf:
+                if seg.ids is not None:
+                    spans = [(seg.blocks[n][0], first, last) for n, first, last in seg.ids.get(key, ())
+                             if seg.blocks[n][3] >= t_from and seg.blocks[n][2] <= t_to]
+                else:
+                    spans = []
+                    for offset, _, t_min, t_max in seg.blocks:
+                        if t_max >= t_from and t_min <= t_to:
+                            spans += [(offset, first, last)
+                                      for k, _, first, last in ArchiveBlock(buf, offset).ids() if k == key]
+                for offset, first, last in spans:
+                    rows += (r for r in ArchiveBlock(buf, offset).rows_between(first, last)
+                             if t_from <= r[0] <= t_to)
+                if spans:
+                    offset, first, _ = spans[-1]
+                    cs = ArchiveBlock(buf, offset).callsign_at(first)
+        return cs, rows
+
+    def window_rows(self, t_from, t_to):
+        """Every (id, callsign, t, lat, lon, alt, hdg, spd, ac) in [t_from, t_to], block by block."""
+        for seg in self.segments(t_from, t_to):
+            with seg.mapped() as buf:
+                for offset, _, t_min, t_max in seg.blocks:
+                    if t_max < t_from or t_min > t_to:
+                        continue
+                    block = ArchiveBlock(buf, offset)
+                    rows = block.rows_between()
+                    for key, cs, first, last in block.ids():
+                        for r in rows[first:last]:
+                            if t_from <= r[0] <= t_to:
+                                yield (key, cs, *r)
+
+class TrackArchive:
+    """Appends snapshots to the segment files in `directory`, one writer per host.
+
+    Fed by the poller like TrackHistory, keeping one snapshot every `every`
+    seconds. Rows are buffered and written as one block per `flush_seconds`
+    (or `block_rows` rows). Sibling workers all call record(), but only the
+    one holding the archive lock writes; the others drop their rows and try
+    for the lock again now and then, so a new writer takes over when the old
+    one exits. Rows still buffered when the process dies are lost.
+    """
+
+    def __init__(self, directory, window, every, flush_seconds, block_rows=65536):
+        self.directory = directory
+        self.window = window
+        self.every = every
+        self.flush_seconds = flush_seconds
+        self.block_rows = block_rows
+        self.rows = 0
+        self.blocks = 0
+        self.bytes = 0
+        self.flush_timing = Timing()
+        self.last_error = None
+        self._buffer = []
+        self._segment = None   # window start of the buffered rows
+        self._last_sample = -math.inf
+        self._last_flush = time.monotonic()
+        self._lock_file = None
+        self._lock_tried = -math.inf
+        self._pid = None
+
+    def _path(self, start):
+        return os.path.join(self.directory, f"tracks-{start}.seg")
+
+    def _is_writer(self):
+        if self._pid != os.getpid():
+            # A forked worker does not own its parent's lock.
+            self._pid = os.getpid()
+            self._lock_file = None
+            self._lock_tried = -math.inf
+        if self._lock_file is not None:
+            return True
+        if time.monotonic() - self._lock_tried < 30:
+            return False
+        self._lock_tried = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        f = open(os.path.join(self.directory, "archive.lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+        self._lock_file = f
+        self.seal_finished(time.time())
+        return True
+
+    def record(self, snap):
+        t = snap.fetched_at
+        if t - self._last_sample < self.every or not self._is_writer():
+            return
+        self._last_sample = t
+        start = int(t // self.window * self.window)
+        if self._segment is not None and start != self._segment:
+            self.flush()
+            self.seal(self._segment)
+        self._segment = start
+        for u in snap.valid_users:
+            row = archive_row(u, t)
+            if row is not None:
+                self._buffer.append(row)
+        if (len(self._buffer) >= self.block_rows
+                or time.monotonic() - self._last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as one block at the end of their segment."""
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        started = time.perf_counter()
+        rows, self._buffer = self._buffer, []
+        path = self._path(self._segment)
+        try:
+            with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+                valid = self._valid_end(f)
+                if valid is None:
+                    self.last_error = f"{path} is already sealed; rows dropped"
+                    return
+                if valid != os.fstat(f.fileno()).st_size:
+                    f.truncate(valid)  # drop a block torn by a crash
+                f.seek(valid)
+                for i in range(0, len(rows), self.block_rows):
+                    data, _ = encode_block(rows[i:i + self.block_rows])
+                    f.write(data)
+                    self.blocks += 1
+                    self.bytes += len(data)
+            self.rows += len(rows)
+        except OSError as e:
+            self.last_error = str(e)
+        self.flush_timing.add(time.perf_counter() - started)
+
+    @staticmethod
+    def _valid_end(f):
+        """Offset just past the last complete block, or None for a sealed segment."""
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if read_footer(buf) is not None:
+                return None
+            blocks = scan_blocks(buf)
+            return blocks[-1].end if blocks else 0
+
+    def seal(self, start):
+        """Append the index footer to the segment for window `start`."""
+        path = self._path(start)
+        try:
+            with open(path, "r+b") as f:
+                valid = self._valid_end(f)
+                if valid is None:
+                    return
+                if valid != os.fstat(f.fileno()).st_size:
+                    f.truncate(valid)
+                f.seek(valid)
+                if valid == 0:
+                    footer = build_footer(start, start + self.window, [])
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        footer = build_footer(start, start + self.window, scan_blocks(buf))
+                f.write(footer)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.last_error = str(e)
+
+    def seal_finished(self, now):
+        """Seal segments whose window is over, e.g. left unsealed by a crashed writer."""
+        for seg in ArchiveReader(self.directory, self.window).segments():
+            if not seg.sealed and seg.end <= now:
+                self.seal(seg.start)
+
+    def stats(self):
+        return {
+            "writer": self._lock_file is not None and self._pid == os.getpid(),
+            "rows": self.rows,
+            "blocks": self.blocks,
+            "bytes": self.bytes,
+            "buffered": len(self._buffer),
+            "flush_ms": self.flush_timing.summary(),
+            "last_error": self.last_error,
+        }
+
+def compact_archive(directory, window, merge_seconds=None, keep_seconds=None,
+                    block_rows=65536, now=None):
+    """Rewrite finished segments with full blocks, merged into windows of `merge_seconds`.
+
+    Rows older than `keep_seconds` are dropped and emptied segments removed.
+    Streams block by block, so memory stays around `block_rows` rows.
+    Returns (segments read, segments written, bytes before, bytes after).
+    """
+    now = time.time() if now is None else now
+    merge_seconds = merge_seconds or window
+    horizon = now - keep_seconds if keep_seconds else -math.inf
+    reader = ArchiveReader(directory, window)
+    groups = {}
+    for seg in reader.segments():
+        if seg.end > now:
+            continue  # still being written
+        groups.setdefault(int(seg.start // merge_seconds * merge_seconds), []).append(seg)
+    read = written = before = after = 0
+    for start, segs in sorted(groups.items()):
+        end = max(seg.end for seg in segs)
+        path = os.path.join(directory, f"tracks-{start}.seg")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        blocks, buffer = [], []
+        with open(tmp, "w+b") as out:
+            def emit(rows):
+                data, _ = encode_block(rows)
+                out.write(data)
+            for seg in segs:
+                read += 1
+                before += os.path.getsize(seg.path)
+                with seg.mapped() as buf:
+                    for offset, _, _, t_max in seg.blocks:
+                        if t_max < horizon:
+                            continue
+                        block = ArchiveBlock(buf, offset)
+                        rows = block.rows_between()
+                        for key, cs, first, last in block.ids():
+                            buffer += ((key, cs, *r) for r in rows[first:last] if r[0] >= horizon)
+                        # Blocks are in time order, so a full buffer can go out
+                        # once re-sorted by time.
+                        while len(buffer) >= block_rows:
+                            buffer.sort(key=lambda r: r[2])
+                            emit(buffer[:block_rows])
+                            buffer = buffer[block_rows:]
+            if buffer:
+                buffer.sort(key=lambda r: r[2])
+                emit(buffer)
+            out.flush()
+            if out.tell():
+                with mmap.mmap(out.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    blocks = scan_blocks(buf)
+                    footer = build_footer(start, end, blocks)
+                out.write(footer)
+        if blocks:
+            os.replace(tmp, path)
+            written += 1
+            after += os.path.getsize(path)
+        else:
+            os.remove(tmp)
+        for seg in segs:
+            if seg.path != path or not blocks:
+                os.remove(seg.path)
+    return read, written, before, after
+
+track_archive = (TrackArchive(ARCHIVE_DIR, ARCHIVE_SEGMENT_SECONDS, ARCHIVE_EVERY, ARCHIVE_FLUSH_SECONDS)
+                 if ARCHIVE_DIR else None)
+
+# ---------------- Snapshot model ----------------
+FT_PER_M = 3.28084
+
+class SnapshotColumns:
+    """One snapshot's aircraft, parsed once at ingestion into columns.
+
+    Row i describes users[i]. Only aircraft with a finite, in-range
+    position and a non-empty callsign get a row, which is what the page
+    would keep anyway. lat, lon, alt (feet), hdg and speed (knots) are
+    float64 columns, NumPy arrays when NumPy is installed and array("d")
+    otherwise; missing numbers are NaN, so every comparison with them is
+    false. ac and acid are -1 where missing. Callsigns and ids are interned,
+    since the same ones come back every poll, and index maps aircraft id to
+    its first row.
+    """
+
+    def __init__(self, users):
+        kept, lat, lon, alt, hdg, speed, ac, acid, cs = ([] for _ in range(9))
+        for u in users:
+            co = u.get("co") if isinstance(u, dict) else None
+            name = callsign(u)
+            if not isinstance(co, list) or len(co) < 2 or not name:
+                continue
+            st = u.get("st")
+            a, b = u.get("ac"), u.get("acid")
+            kept.append(u)
+            lat.append(_number(co[0]))
+            lon.append(_number(co[1]))
+            alt.append(_number(co[2]) if len(co) > 2 else math.nan)
+            hdg.append(_number(co[3]) if len(co) > 3 else math.nan)
+            speed.append(_number(st.get("as")) if isinstance(st, dict) else math.nan)
+            ac.append(a if isinstance(a, int) and not isinstance(a, bool) and a >= 0 else -1)
+            acid.append(b if isinstance(b, int) and not isinstance(b, bool) and b >= 0 else -1)
+            cs.append(sys.intern(name))
+        if np is not None:
+            lat, lon = np.array(lat, dtype=np.float64), np.array(lon, dtype=np.float64)
+            valid = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+            rows = np.flatnonzero(valid).tolist()
+            self.lat, self.lon = lat[valid], lon[valid]
+            self.alt = np.array(alt, dtype=np.float64)[valid] * FT_PER_M
+            self.hdg = np.array(hdg, dtype=np.float64)[valid]
+            self.speed = np.array(speed, dtype=np.float64)[valid]
+            self.ac = np.array(ac, dtype=np.int64)[valid]
+            self.acid = np.array(acid, dtype=np.int64)[valid]
+        else:
+            rows = [i for i, (y, x) in enumerate(zip(lat, lon)) if abs(y) <= 90 and abs(x) <= 180]
+            self.lat = array("d", [lat[i] for i in rows])
+            self.lon = array("d", [lon[i] for i in rows])
+            self.alt = array("d", [alt[i] * FT_PER_M for i in rows])
+            self.hdg = array("d", [hdg[i] for i in rows])
+            self.speed = array("d", [speed[i] for i in rows])
+            self.ac = array("q", [ac[i] for i in rows])
+            self.acid = array("q", [acid[i] for i in rows])
+        self.users = [kept[i] for i in rows]
+        self.cs = [cs[i] for i in rows]
+        self.ids = []
+        self.index = {}
+        for i, u in enumerate(self.users):
+            key = aircraft_id(u)
+            key = None if key is None else sys.intern(key)
+            self.ids.append(key)
+            if key is not None:
+                self.index.setdefault(key, i)
+
+    def __len__(self):
+        return len(self.users)
+
+    @cached_property
+    def cs_upper(self):
+        return [cs.upper() for cs in self.cs]
+
+    def all_rows(self):
+        return np.arange(len(self.users)) if np is not None else range(len(self.users))
+
+    def as_rows(self, rows):
+        """A list of row numbers in the form the column filters take."""
+        return np.array(rows, dtype=np.intp) if np is not None else rows
+
+# ---------------- Background poller ----------------
+@dataclass(frozen=True)
+class Snapshot:
+    """One parsed upstream payload. Never mutated once published."""
+    raw: "Encoded"
+    users: tuple
+    user_count: int
+    fetched_at: float
+    seq: int
+
+    @classmethod
+    def parse(cls, body, fetched_at, seq, variants=None):
+        """Snapshot of upstream `body`; `variants` are compressed copies made elsewhere."""
+        data = decode_json(body)
+        users = data.get("users") if isinstance(data, dict) else None
+        users = tuple(users) if isinstance(users, list) else ()
+        count = data.get("userCount") if isinstance(data, dict) else None
+        if not isinstance(count, int):
+            count = len(users)
+        return cls(Encoded(body, variants), users, count, fetched_at, seq)
+
+    def age(self):
+        return max(0.0, time.time() - self.fetched_at)
+
+    @cached_property
+    def grid(self):
+        """Spatial index over this snapshot, built on first use."""
+        return SpatialGrid(self.columns)
+
+    @cached_property
+    def columns(self):
+        """SnapshotColumns of this snapshot; pollers build them at ingestion."""
+        return SnapshotColumns(self.users)
+
+    @property
+    def valid_users(self):
+        """The users that passed validation, in row order; every filtered answer,
+        delta, cluster and track is built from these. Only an unfiltered
+        /api/map passes the upstream body through as it came."""
+        return self.columns.users
+
+    @cached_property
+    def _matches(self):
+        return {}
+
+    def matching(self, where):
+        """Users matching the canonical ?q= query `where`, computed once per query."""
+        matches = self._matches
+        users = matches.get(where)
+        if users is None:
+            if len(matches) >= 64:
+                matches.clear()
+            users = matches[where] = compile_filter(where).apply(self.columns)
+        return users
+
+    @cached_property
+    def _cluster_indexes(self):
+        return {}
+
+    def cluster_index(self, tags, where=None):
+        """ClusterIndex over the users matching `tags` and `where`, built once per pair."""
+        indexes = self._cluster_indexes
+        index = indexes.get((tags, where))
+        if index is None:
+            if len(indexes) >= 16:
+                indexes.clear()
+            query = MapQuery(tags=tags, where=where)
+            index = indexes[tags, where] = ClusterIndex(list(select_users(self, query)))
+        return index
+
+class BasePoller:
+    """Snapshot bookkeeping shared by the thread and asyncio pollers."""
+
+    def __init__(self, cache, interval, window, tracks=None, archive=None):
+        self.cache = cache
+        self.interval = interval
+        self.snapshot = None
+        self.history = deque(maxlen=window)
+        self.tracks = tracks
+        self.archive = archive
+        # SnapshotPublisher on the ingest node (ROLE=ingest).
+        self.publisher = None
+        self.failures = 0
+        self.last_error = None
+
+    def at(self, seq):
+        """The snapshot published as `seq`, if it is still in the window."""
+        # The poller appends while request threads look up; copying the deque
+        # is a single step, iterating it is not.
+        for snap in reversed(tuple(self.history)):
+            if snap.seq == seq:
+                return snap
+        return None
+
+    def is_new(self, seq):
+        return self.snapshot is None or seq != self.snapshot.seq
+
+    def build(self, body, fetched_at, seq, variants=None):
+        started = time.perf_counter()
+        snap = Snapshot.parse(body, fetched_at, seq, variants)
+        snap.columns
+        parsed = time.perf_counter()
+        snap.raw.precompress()
+        snapshot_parse_seconds.observe(parsed - started)
+        snapshot_compress_seconds.observe(time.perf_counter() - parsed)
+        if self.tracks is not None:
+            self.tracks.record(snap)
+        if self.archive is not None:
+            self.archive.record(snap)
+        return snap
+
+    def publish(self, snap):
+        self.history.append(snap)
+        self.snapshot = snap
+        if self.publisher is not None:
+            self.publisher.send(snap)
+
+    def bus_stats(self):
+        return self.publisher.stats() if self.publisher is not None else None
+
+    def restart(self):
+        """Forget the ?since= window after the ingest node's seqs started over.
+
+        Called holding _changed. Readers may still be walking the old deque,
+        so it is replaced rather than cleared; the current snapshot keeps
+        being served until the first new one is published.
+        """
+        self.history = deque(maxlen=self.history.maxlen)
+        result_cache.clear()
+
+    def succeeded(self):
+        self.failures = 0
+        self.last_error = None
+
+    def failed(self, error):
+        self.failures += 1
+        self.last_error = str(error)
+        poll_errors.inc(type(error).__name__)
+
+    def backoff(self):
+        """Exponential backoff with full jitter, never shorter than one interval."""
+        ceiling = min(BACKOFF_MAX, self.interval * 2 ** self.failures)
+        return random.uniform(self.interval, max(self.interval, ceiling))
+
+class UpstreamPoller(BasePoller):
+    """Refreshes the snapshot on a fixed cadence, off the request path.
+
+    Every worker runs its own poller thread, but they all read through
+    snapshot_cache, so upstream still sees one request per CACHE_TTL.
+    """
+
+    def __init__(self, cache, interval, window, tracks=None, archive=None):
+        super().__init__(cache, interval, window, tracks, archive)
+        self._changed = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # Started lazily so that each forked gunicorn worker gets its own thread.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._changed = threading.Condition()
+            threading.Thread(target=self._run, name="upstream-poller", daemon=True).start()
+            self._pid = os.getpid()
+        metrics.start()
+
+    def current(self, wait=CONNECT_TIMEOUT + READ_TIMEOUT):
+        """Latest snapshot, waiting up to `wait` seconds for the first one."""
+        return self.wait_newer(None, wait)
+
+    def wait_newer(self, seq, timeout):
+        """Block until a snapshot other than `seq` is published, or `timeout`.
+
+        Returns the latest snapshot either way (None if there is none yet).
+        """
+        self.start()
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.snapshot is not None and self.snapshot.seq != seq, timeout)
+            return self.snapshot
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.poll_once()
+                delay = self.interval - (time.monotonic() - started)
+            except Exception as e:
+                self.failed(e)
+                delay = self.backoff()
+            time.sleep(max(0.0, delay))
+
+    def poll_once(self):
+        body, fetched_at, seq = self.cache.get()
+        if self.is_new(seq):
+            snap = self.build(body, fetched_at, seq)
+            with self._changed:
+                self.publish(snap)
+                self._changed.notify_all()
+        self.succeeded()
+
+class AsyncUpstreamPoller(BasePoller):
+    """UpstreamPoller as an asyncio task, for ASGI mode."""
+
+    def __init__(self, cache, client, interval, window, tracks=None, archive=None):
+        super().__init__(cache, interval, window, tracks, archive)
+        self.client = client
+        self._changed = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._changed = asyncio.Condition()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            metrics.start()
+
+    async def current(self, wait=CONNECT_TIMEOUT + READ_TIMEOUT):
+        return await self.wait_newer(None, wait)
+
+    async def wait_newer(self, seq, timeout):
+        self.start()
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait_for(
+                    lambda: self.snapshot is not None and self.snapshot.seq != seq), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return self.snapshot
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                body, fetched_at, seq = await self.cache.aget(self.client.fetch)
+                if self.is_new(seq):
+                    # Parsing and compressing take milliseconds; keep them off the loop.
+                    snap = await asyncio.to_thread(self.build, body, fetched_at, seq)
+                    async with self._changed:
+                        self.publish(snap)
+                        self._changed.notify_all()
+                self.succeeded()
+                delay = self.interval - (time.monotonic() - started)
+            except Exception as e:
+                self.failed(e)
+                delay = self.backoff()
+            await asyncio.sleep(max(0.0, delay))
+
+# ---------------- Snapshot bus ----------------
+# ROLE=ingest polls upstream once and publishes every snapshot; any number
+# of ROLE=edge processes subscribe and serve from what they receive, so
+# upstream load stays at one poller however many edges there are. A
+# message is
+#
+#   header   magic "SNP1", u64 seq, f64 fetched_at, u32 body length,
+#            u32 gzip length, u32 br length (0 if not sent),
+#            u32 messages still to come in a replay              (36 bytes)
+#   upstream body, then its gzip and br variants
+#
+# so edges neither fetch nor recompress. A new subscriber is first sent the
+# last DELTA_WINDOW snapshots so it can answer ?since= at once; it keeps
+# those as history and serves only the newest. Deltas, clusters and frames are
+# per query, so each edge builds those itself from the snapshots (and
+# shares them between its clients through result_cache); seqs are the
+# ingest node's, so ?since= stays valid when a client moves between edges.
+BUS_MAGIC = b"SNP1"
+BUS_HEADER = struct.Struct("<4sQdIIII")
+BUS_BEHIND = struct.Struct("<I")
+
+def bus_address(address):
+    """(socket family, address) for "tcp://host:port" or "unix:/path"."""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.removeprefix("tcp://").rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"bad bus address {address!r}; use tcp://host:port or unix:/path")
+    host = host.strip("[]")
+    return (socket.AF_INET6 if ":" in host else socket.AF_INET), (host, int(port))
+
+def bus_message(snap):
+    """`snap` as one bus message."""
+    variants = snap.raw.encodings()
+    gz, br = variants.get("gzip", b""), variants.get("br", b"")
+    header = BUS_HEADER.pack(BUS_MAGIC, snap.seq, snap.fetched_at, len(snap.raw.body), len(gz), len(br), 0)
+    return b"".join((header, snap.raw.body, gz, br))
+
+def replayed(message, behind):
+    """`message` marked as having `behind` more replayed messages after it."""
+    at = BUS_HEADER.size - BUS_BEHIND.size
+    return b"".join((message[:at], BUS_BEHIND.pack(behind), message[BUS_HEADER.size:]))
+
+def read_bus_header(buf):
+    """(seq, fetched_at, (body, gzip, br lengths), behind) of a message header. Raises ValueError."""
+    magic, seq, fetched_at, body, gz, br, behind = BUS_HEADER.unpack(buf)
+    if magic != BUS_MAGIC:
+        raise ValueError("not a snapshot bus message")
+    return seq, fetched_at, (body, gz, br), behind
+
+def bus_variants(gz, br):
+    return {coding: data for coding, data in (("gzip", gz), ("br", br)) if data}
+
+class BusQueue:
+    """Messages waiting for one subscriber; the oldest go first when it falls behind."""
+
+    def __init__(self, conn, size):
+        self.conn = conn
+        self.messages = deque()
+        self.size = size
+        self.closed = False
+        self._ready = threading.Condition()
+
+    def put(self, message):
+        """Queue `message`; False if an older one had to be dropped for it."""
+        with self._ready:
+            self.messages.append(message)
+            dropped = len(self.messages) > self.size
+            if dropped:
+                self.messages.popleft()
+            self._ready.notify()
+        return not dropped
+
+    def take(self):
+        with self._ready:
+            self._ready.wait_for(lambda: self.messages or self.closed)
+            return self.messages.popleft() if self.messages else None
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+
+class SnapshotPublisher:
+    """Sends every published snapshot to the edges subscribed on `address`.
+
+    Each snapshot is encoded once and queued for every subscriber, each of
+    which has its own sender thread; a new subscriber first gets a replay
+    of the last `window`. Of several ingest
+    workers only the one that binds the address publishes; the others try
+    again every BUS_REBIND seconds in case it goes away.
+    """
+
+    def __init__(self, address, window, queue_size):
+        self.address = address
+        self.recent = deque(maxlen=window)
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.published = 0
+        self.dropped = 0
+        self.last_error = None
+        self._sock = None
+        self._pid = None
+        self._tried = -math.inf
+        self._lock = threading.Lock()
+
+    def _listen(self):
+        self._tried = time.monotonic()
+        family, addr = bus_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family == socket.AF_UNIX:
+                # Only clear a stale socket file, never one still being served.
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(addr)
+                    raise OSError(f"{addr} is already being published on")
+                except (FileNotFoundError, ConnectionRefusedError):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(addr)
+                finally:
+                    probe.close()
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(addr)
+            sock.listen()
+        except OSError as e:
+            sock.close()
+            self.last_error = str(e)
+            return
+        self._sock, self._pid, self.last_error = sock, os.getpid(), None
+        threading.Thread(target=self._accept, args=(sock,), name="bus-accept", daemon=True).start()
+
+    def _accept(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError as e:
+                self.last_error = str(e)
+                return
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sub = BusQueue(conn, self.queue_size)
+            with self._lock:
+                for n, message in enumerate(self.recent, 1):
+                    sub.put(replayed(message, len(self.recent) - n))
+                self.subscribers.add(sub)
+            threading.Thread(target=self._feed, args=(sub,), name="bus-send", daemon=True).start()
+
+    def _feed(self, sub):
+        try:
+            while True:
+                message = sub.take()
+                if message is None:
+                    break
+                sub.conn.sendall(message)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self.subscribers.discard(sub)
+            sub.conn.close()
+
+    def send(self, snap):
+        """Publish `snap` to every subscriber (binding the address first if need be)."""
+        if self._pid != os.getpid():
+            self._sock = None
+            if time.monotonic() - self._tried >= BUS_REBIND:
+                self._listen()
+        message = bus_message(snap)
+        with self._lock:
+            self.recent.append(message)
+            self.published += 1
+            for sub in self.subscribers:
+                if not sub.put(message):
+                    self.dropped += 1
+
+    def stats(self):
+        return {"role": "ingest", "address": self.address, "listening": self._pid == os.getpid(),
+                "subscribers": len(self.subscribers), "published": self.published,
+                "dropped": self.dropped, "last_error": self.last_error}
+
+class BusLink:
+    """An edge's subscription to the ingest node: what it has seen, and counters."""
+
+    def __init__(self, address):
+        self.address = address
+        self.connected = False
+        self.connects = 0
+        self.received = 0
+        self.resets = 0
+        # seq and fetch time of the last snapshot accepted off the bus.
+        self.seq = None
+        self.fetched_at = None
+
+    def verdict(self, seq, fetched_at):
+        """What to do with the snapshot `seq` just received.
+
+        "new" to build it; "seen" when a reconnect replays one the edge
+        already has; "restart" when the seq went back with a newer fetch
+        time, i.e. the ingest node started over and every old seq is void.
+        """
+        if self.seq is not None and seq <= self.seq:
+            if seq == self.seq or fetched_at <= self.fetched_at:
+                return "seen"
+            self.resets += 1
+            verdict = "restart"
+        else:
+            verdict = "new"
+        self.seq, self.fetched_at = seq, fetched_at
+        return verdict
+
+    def stats(self, source):
+        return {"role": "edge", "address": self.address, "connected": self.connected,
+                "connects": self.connects, "received": self.received, "resets": self.resets,
+                "last_error": source.last_error}
+
+class EdgePoller(UpstreamPoller):
+    """UpstreamPoller fed by the ingest node's snapshot bus (ROLE=edge)."""
+
+    def __init__(self, address, interval, window, tracks=None):
+        super().__init__(None, interval, window, tracks)
+        self.link = BusLink(address)
+
+    def bus_stats(self):
+        return self.link.stats(self)
+
+    def _run(self):
+        while True:
+            try:
+                self._subscribe()
+            except Exception as e:
+                self.failed(e)
+            self.link.connected = False
+            time.sleep(self.backoff())
+
+    def _subscribe(self):
+        family, addr = bus_address(self.link.address)
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(addr)
+            sock.settimeout(BUS_IDLE_TIMEOUT)
+            stream = sock.makefile("rb")
+            self.link.connected = True
+            self.link.connects += 1
+            self.succeeded()
+            while True:
+                seq, fetched_at, sizes, behind = read_bus_header(self._read(stream, BUS_HEADER.size))
+                body, gz, br = (self._read(stream, n) for n in sizes)
+                self.link.received += 1
+                verdict = self.link.verdict(seq, fetched_at)
+                if verdict == "restart":
+                    with self._changed:
+                        self.restart()
+                if verdict != "seen":
+                    snap = self.build(body, fetched_at, seq, bus_variants(gz, br))
+                    if behind:
+                        self.history.append(snap)
+                        continue
+                    with self._changed:
+                        self.publish(snap)
+                        self._changed.notify_all()
+
+    @staticmethod
+    def _read(stream, n):
+        data = stream.read(n)
+        if len(data) < n:
+            raise ConnectionError("snapshot bus closed")
+        return data
+
+class AsyncEdgePoller(AsyncUpstreamPoller):
+    """EdgePoller as an asyncio task, for ASGI mode."""
+
+    def __init__(self, address, interval, window, tracks=None):
+        super().__init__(None, None, interval, window, tracks)
+        self.link = BusLink(address)
+
+    def bus_stats(self):
+        return self.link.stats(self)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._subscribe()
+            except Exception as e:
+                self.failed(e)
+            self.link.connected = False
+            await asyncio.sleep(self.backoff())
+
+    async def _subscribe(self):
+        family, addr = bus_address(self.link.address)
+        if family == socket.AF_UNIX:
+            opening = asyncio.open_unix_connection(addr)
+        else:
+            opening = asyncio.open_connection(*addr)
+        reader, writer = await asyncio.wait_for(opening, CONNECT_TIMEOUT)
+        try:
+            self.link.connected = True
+            self.link.connects += 1
+            self.succeeded()
+            while True:
+                header = await asyncio.wait_for(reader.readexactly(BUS_HEADER.size), BUS_IDLE_TIMEOUT)
+                seq, fetched_at, sizes, behind = read_bus_header(header)
+                body, gz, br = [await reader.readexactly(n) for n in sizes]
+                self.link.received += 1
+                verdict = self.link.verdict(seq, fetched_at)
+                if verdict == "restart":
+                    async with self._changed:
+                        self.restart()
+                if verdict != "seen":
+                    snap = await asyncio.to_thread(self.build, body, fetched_at, seq, bus_variants(gz, br))
+                    if behind:
+                        self.history.append(snap)
+                        continue
+                    async with self._changed:
+                        self.publish(snap)
+                        self._changed.notify_all()
+        finally:
+            writer.close()
+
+if ROLE == "edge":
+    poller = EdgePoller(BUS_ADDRESS, POLL_INTERVAL, DELTA_WINDOW, track_history)
+else:
+    poller = UpstreamPoller(snapshot_cache, POLL_INTERVAL, DELTA_WINDOW, track_history, track_archive)
+    if ROLE == "ingest":
+        poller.publisher = SnapshotPublisher(BUS_ADDRESS, DELTA_WINDOW, BUS_QUEUE)
+
+# ---------------- Aircraft types ----------------
+# GeoFS aircraft type id (`ac`) -> name, for type: queries and the page's popups.
+AIRCRAFT_DB = {
+    1: 'Piper Cub',
+    2: 'Cessna 172',
+    3: 'Alphajet PAF',
+    4: 'Boeing 737-700',
+    5: 'Embraer Phenom 100',
+    6: 'de Havilland DHC6 Twin Otter',
+    7: 'F-16 Fighting Falcon',
+    8: 'Pitts Special S1',
+    9: 'Eurocopter EC135',
+    10: 'Airbus A380',
+    11: 'Alisport Silent 2 Electro',
+    12: 'Pilatus PC-7 Mk-I',
+    13: 'de Havilland Canada DHC-2 Beaver',
+    14: 'Colomban MC-15 Cri-cri',
+    15: 'Lockheed P-38 Lightning F-5B',
+    16: 'Douglas DC-3',
+    18: 'Sukhoi Su-35',
+    20: 'Concorde',
+    21: 'Zlin Z-50',
+    22: 'Cessna 152',
+    23: 'Piper PA-28 161 Warrior II Aerobility',
+    24: 'Airbus A350',
+    25: 'Boeing 777-300ER',
+    26: 'Antonov An-140',
+    27: 'Boeing F/A-18F Super Hornet',
+    28: 'Beechcraft Baron B55',
+    29: 'Dassault Rafale',
+    31: 'Potez 25',
+    32: 'Northrop T-38 Talon',
+    40: 'Evektor Sportstar',
+    41: 'szd-48-3 Jantar',
+    50: 'Paraglider',
+    51: 'Major Tom (hot air balloon)',
+    52: 'Hughes 269a/TH-55 Osage',
+    53: 'Goat Airchair',
+    102: 'Citroen 2CV',
+    103: 'Wingsuit',
+    235: 'Boeing 787-8 (by GX Development)',
+    236: 'Embraer E190 (by GX Development)',
+    237: 'Boeing 767-300ER (by GX Development)',
+    238: 'Boeing 757-200 (by GX Development)',
+    239: 'Airbus A350-900 (by GX Development)',
+    240: 'Boeing 777-300ER (by LRX)',
+    242: 'Airbus A321neo (by LRX)',
+    244: 'Airbus A330-300 (by LRX)',
+    247: 'Bombardier Dash 8 Q400 (by LRX)',
+    252: 'Boeing 747-8 Freighter (by LRX)',
+    1069: 'Cirrus SR22 GTS Turbo (by LRX)',
+    2000: 'Retro 172',
+    2003: 'Boeing 737-800 (by King Solomon)',
+    2004: 'CRJ-900 (by King Solomon)',
+    2153: 'Airbus A340-600 (by LRX)',
+    2310: 'A-10C Thunderbolt II (by Eco[LAC])',
+    2364: 'Lockheed SR-71A Blackbird (by BritishPilot[GeoAD])',
+    2386: 'Boeing 787-9 Dreamliner (by LRX)',
+    2395: 'BAe 146-300/Avro RJ100 (by Eco[LAC])',
+    2418: 'ATR 72-600 (HOP!) (by JAaMDG)',
+    2420: 'ATR 72-600 (Silver) (by JAaMDG)',
+    2426: 'ATR 72-600 (UTair) (by JAaMDG)',
+    2461: 'Cirrus Vision Jet/SF50 G2 (by Eco[LAC])',
+    2556: 'Northrop Grumman B-2 Spirit (by NS-Studios)',
+    2581: 'F-14B Tomcat (by Eco[LAC])',
+    2700: 'Embraer ERJ-195AR (Breeze) (by Featherway[UAE232])',
+    2706: 'Bombardier CRJ 200 (by Aero281)',
+    2726: 'Scaled 339 "SpaceShipTwo" (by JAaMDG)',
+    2750: 'Caproni Stipa (by Echo_3)',
+    2752: 'Scaled 348 "WhiteKnightTwo" (by JAaMDG)',
+    2769: 'Boeing 737 Max 8 (TUI) (by Spice_9)',
+    2772: 'Boeing 737 Max 8 (SpiceJet) (by Spice_9)',
+    2786: 'Grumman JF2-5 Duck (by Echo_3)',
+    2788: 'Antonov An-225 Mriya (by NS-Studios)',
+    2806: 'Sikorsky S-97 Raider (by JAaMDG)',
+    2808: 'Supermarine Spitfire Mk XIV (by Eco[LAC])',
+    2840: 'Bell UH-1H Iroquois (by ElonMusk(VrA)(LAC))',
+    2843: 'Airbus A220-300 (Air Tanzania) (by GT-VRA)',
+    2844: 'Falcon 9 (by Echo_3)',
+    2852: 'Cameron R-650 Rozière Balloon (by JAaMDG)',
+    2856: 'Airbus a330-200 (by Aero281)',
+    2857: 'F-22 Raptor (by SpaceRage)',
+    2864: 'AgustaWestland AW609 (by JAaMDG)',
+    2865: 'Airbus a320neo(Air India) (by Spice_9)',
+    2870: 'Airbus a320neo (Flynas) (by Spice_9)',
+    2871: 'Airbus a320neo (Iberia) (by Spice_9)',
+    2878: 'Airbus A319 (Air China) (by GT-VRA)',
+    2879: 'Airbus A319 (Finnair) (by GT-VRA)',
+    2892: 'SAAB 340 (by Spice_9)',
+    2899: 'Airbus A220-300 (Swiss) (by GT-VRA)',
+    2943: 'Embraer EMB120 Brasillia (by GT-VRA)',
+    2948: '(JAaMDG) North American XB-70 Valkyrie (by Johani_(NeoAD))',
+    2951: 'Airbus a340-300 (by Aero281)',
+    2953: 'Space Shuttle Atlantis (OV-104) (by JAaMDG)',
+    2968: 'Windward Performance Perlan II (by JAaMDG)',
+    2973: 'Airbus A350-1000 XWB (by NS-Studios)',
+    2976: 'Pilatus PC12 (by GT-VRA)',
+    2988: '(TBSG, GeoAD) North American X-15 (by Johani_(NeoAD))',
+    2989: 'MQ9B Reaper (by Aero281)',
+    3011: 'Airbus a320-232 (by Spice_9)',
+    3036: 'Embraer E195-E2 (by GT-VRA)',
+    3049: 'Lockheed Martin P-791 (LMH-1) (by JAaMDG)',
+    3054: 'Boeing 737-800 [Spice9] (by Spice_9)',
+    3109: 'Pilatus PC24 (by GT-VRA)',
+    3140: 'Airbus A319 (United) (by GT-VRA)',
+    3179: 'Boeing 787-10 Dreamliner (British Airways) (by Spice_9)',
+    3180: 'Boeing 787-10 Dreamliner (Etihad) (by Spice_9)',
+    3211: 'UTVA75 (by GT-VRA)',
+    3289: 'Dornier 228-200 (by Spice_9)',
+    3292: 'Boeing p8I Neptune (by Spice_9)',
+    3307: 'Bombardier CRJ-700 (by AriakimTaiyo)',
+    3341: 'Embraer ERJ-170 (by AriakimTaiyo)',
+    3436: 'Dornier do228-100 (Coast Gaurd) (by Spice_9)',
+    3460: 'Grumman E-2C Hawkeye (by ElonMusk(VrA)(LAC))',
+    3534: 'airbus a320-214(Easyjet) (by Spice_9)',
+    3575: 'Boeing 787-9(Spice9) (by Spice_9)',
+    3591: 'F-15C Eagle (by AriakimTaiyo)',
+    3617: 'Dassault Mirage 2000-5 (by ElonMusk(VrA)(LAC))',
+    4017: 'Embraer ERJ145LR (by Spice 9) & (by GT-VRA)',
+    4090: 'Robinson R-44 (by (CCDev)DevHunter77)',
+    4140: 'Boeing 737-200 (by AriakimTaiyo)',
+    4197: 'Robinson R22 (by (CCDev)DevHunter77)',
+    4251: 'Chance Vought F4U-1D Corsair (by JAaMDG)',
+    4341: 'Spirit of St louis (by Echo_3)',
+    4390: 'Piper PA-28 Floatplane (by coolpilot11)',
+    4398: 'Britten-Norman BN-2 Islander (Loganair) (by coolpilot11)',
+    4401: 'Britten-Norman BN-2 Islander (St. Barth Commuter) (by coolpilot11)',
+    4402: 'Boeing 777 Freighter (by LRX)',
+    4409: 'Zenith Stol CH701 (by coolpilot11)',
+    4596: 'Vans RV6 (by coolpilot11)',
+    4631: 'Airbus A330-900neo (Virgin Atlantic) (by GT-VRA)',
+    4646: 'Airbus a321neo (spice9) (by Spice_9)',
+    4743: 'Boeing 757-300 (by GT-VRA)',
+    4745: 'Boeing 757-300wl (by GT-VRA)',
+    4764: 'Boeing 767-400 (by GT-VRA)',
+    4949: 'Goodyear Blimp (by BritishPilot[GeoAD])',
+    5002: 'Beta Alia Prototype (N250UT) (by coolpilot11)',
+    5038: 'Lockheed L-1011-1 (by AriakimTaiyo)',
+    5061: 'Sonex-B Kit (Jabiru 3300) (by TurboMaximus)',
+    5073: 'Bombardier Learjet 45 XR (by Spice_9)',
+    5086: 'Airbus a321-211 (by Spice_9)',
+    5156: 'Airbus a318-112 by Luca & (by Spice_9)',
+    5193: 'Boeing 747-8i (by JAaMDG)',
+    5203: 'Boeing 737-600 by Luca & (by Spice_9)',
+    5229: 'F-35B Lightning II (by JAaMDG)',
+    5314: 'Boeing 747-100 SCA by JAaMDG & (by Jeffa)',
+    5316: 'Boeing 717-200 (by Plane2222222)',
+    5347: 'Dassault Mirage F1 (by MirageModels)',
+    5405: 'Chengdu J-20 (by MirageModels)',
+    5409: 'Boeing 747-400D by JAaMDG & (by BOA93(EAA))',
+    5431: 'Northrop YF-23 (by MirageModels)',
+    5486: 'Aviat A-1B Husky (by coolpilot11)',
+    5499: 'CubCrafters CC19 XCub (by AriakimTaiyo)',
+    5516: 'Boeing 747-400 LCF by Luca & (by JAaMDG)',
+}
+
+# ---------------- Filtering / projection ----------------
+class TagMatcher:
+    """Aho-Corasick automaton over uppercased tags.
+
+    One pass over a callsign answers "does it contain any tag?", instead of
+    one substring scan per tag.
+    """
+
+    def __init__(self, tags):
+        self.tags = tuple(tags)
+        goto = [{}]
+        out = [frozenset()]
+        for tag in self.tags:
+            node = 0
+            for ch in tag:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(frozenset())
+                node = nxt
+            out[node] = out[node] | {tag}
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                queue.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] | out[fail[nxt]]
+        self._goto, self._fail, self._out = goto, fail, out
+
+    def _walk(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text.upper():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                yield out[node]
+
+    def matches(self, text):
+        """True if `text` contains at least one tag (case-insensitive)."""
+        for _ in self._walk(text):
+            return True
+        return False
+
+    def find(self, text):
+        """All tags contained in `text`."""
+        found = set()
+        for tags in self._walk(text):
+            found |= tags
+        return found
+
+class TagClassifier:
+    """Callsign -> the tags it contains, over DEFAULT_TAGS plus the custom tags seen.
+
+    Known tags sit in one TagMatcher, so a callsign is scanned once whatever
+    tag set a client asked for, and the answer is memoized per callsign,
+    since callsigns rarely change from one poll to the next. A query's own
+    tags are then a set intersection (see matched_tags).
+
+    New tags are compiled in, at most `learn_max` per query and `max_tags`
+    in all. The automaton is never reset, so clients cannot make it
+    recompile on every request; tags beyond the caps get a small matcher
+    of their own, kept per tag set.
+    """
+
+    def __init__(self, base, cache_size, max_tags, learn_max):
+        self.base = frozenset(t.upper() for t in base)
+        self.cache_size = cache_size
+        self.max_tags = len(self.base) + max_tags
+        self.learn_max = learn_max
+        self.recompiles = 0
+        self._lock = threading.Lock()
+        # (tags, classify), swapped in one assignment so that readers never
+        # pair a tag set with an automaton built for another.
+        self._current = (self.base, self._classifier(self.base, cache_size))
+        self._extra = lru_cache(maxsize=64)(lambda tags: self._classifier(tags, 4096))
+
+    @staticmethod
+    def _classifier(tags, cache_size):
+        matcher = TagMatcher(sorted(tags))
+
+        @lru_cache(maxsize=cache_size)
+        def classify(cs):
+            """Frozenset of the matcher's tags contained in callsign `cs`."""
+            return frozenset(matcher.find(cs))
+
+        return classify
+
+    @property
+    def tags(self):
+        return self._current[0]
+
+    def learn(self, tags):
+        """A classify function (callsign -> frozenset of tags) covering every tag of `tags`.
+
+        Use the returned function rather than a later learn()'s: it is the
+        one guaranteed to know these tags.
+        """
+        known, classify = self._current
+        missing = tag_set(tags) - known
+        if not missing:
+            return classify
+        with self._lock:
+            known, classify = self._current
+            missing -= known
+            room = min(self.learn_max, self.max_tags - len(known))
+            if missing and room > 0:
+                known = known.union(sorted(missing)[:room])
+                classify = self._classifier(known, self.cache_size)
+                self._current = (known, classify)
+                self.recompiles += 1
+                missing -= known
+        if not missing:
+            return classify
+        extra = self._extra(frozenset(missing))
+        return lambda cs: classify(cs) | extra(cs)
+
+    def stats(self):
+        tags, classify = self._current
+        info = classify.cache_info()
+        return {"tags": len(tags), "recompiles": self.recompiles, "callsigns": info.currsize,
+                "hits": info.hits, "misses": info.misses, "overflow_sets": self._extra.cache_info().currsize}
+
+classifier = TagClassifier(DEFAULT_TAGS, CLASSIFY_CACHE_SIZE, CLASSIFY_MAX_TAGS, CLASSIFY_LEARN_PER_QUERY)
+
+@lru_cache(maxsize=256)
+def tag_set(tags):
+    return frozenset(tags)
+
+def matched_tags(cs, tags, classify):
+    """Sorted tags of the query tag tuple `tags` that callsign `cs` contains.
+
+    `classify` is what classifier.learn(tags) returned (see MapQuery.classify).
+    """
+    return sorted(classify(cs) & tag_set(tags))
+
+def parse_tags(args):
+    """`?tags=[U],[PMC]` (repeatable) -> sorted tuple of uppercased tags, or None."""
+    if "tags" not in args:
+        return None
+    tags = {t.strip().upper() for v in args.getlist("tags") for t in v.split(",")}
+    tags.discard("")
+    return tuple(sorted(tags))
+
+def parse_fields(args):
+    """`?fields=id,cs,st.as` -> sorted tuple of dotted paths, or None."""
+    raw = args.get("fields")
+    paths = {p.strip().strip(".") for p in raw.split(",")} if raw else set()
+    paths.discard("")
+    return tuple(sorted(paths)) or None
+
+@lru_cache(maxsize=64)
+def field_tree(paths):
+    """Dotted paths -> nested projection tree for project()."""
+    tree = {}
+    for path in paths:
+        parts = [p for p in path.split(".") if p]
+        node = tree
+        for i, part in enumerate(parts):
+            if i == len(parts) - 1:
+                node[part] = None
+            else:
+                child = node.get(part)
+                if child is None:
+                    child = node[part] = {}
+                node = child
+    return tree
+
+def parse_bbox(args):
+    """`?bbox=minLat,minLon,maxLat,maxLon` -> (min_lat, max_lat, lon_ranges), or None.
+
+    Latitudes are clamped to [-90, 90] and longitudes wrapped into
+    [-180, 180]; a box whose west edge ends up east of its east edge crosses
+    the antimeridian and becomes two ranges. Raises ValueError for a
+    malformed box, including one whose minLat is above its maxLat.
+    """
+    raw = args.get("bbox")
+    if not raw:
+        return None
+    try:
+        parts = [float(v) for v in raw.split(",")]
+    except ValueError:
+        parts = ()
+    if len(parts) != 4 or not all(math.isfinite(v) for v in parts):
+        raise ValueError("bbox must be minLat,minLon,maxLat,maxLon")
+    min_lat, min_lon, max_lat, max_lon = parts
+    if min_lat > max_lat:
+        raise ValueError("bbox minLat is above maxLat")
+    min_lat, max_lat = max(-90.0, min_lat), min(90.0, max_lat)
+    if max_lon - min_lon >= 360:
+        return (min_lat, max_lat, ((-180.0, 180.0),))
+    west = (min_lon + 180) % 360 - 180
+    east = (max_lon + 180) % 360 - 180
+    if max_lon > min_lon and east == -180.0:
+        east = 180.0
+    if west <= east:
+        return (min_lat, max_lat, ((west, east),))
+    return (min_lat, max_lat, ((west, 180.0), (-180.0, east)))
+
+def parse_zoom(args):
+    """`?zoom=3` -> map zoom if it is low enough to cluster at, else None."""
+    raw = args.get("zoom")
+    if not raw:
+        return None
+    try:
+        zoom = int(raw)
+    except ValueError:
+        raise ValueError("zoom must be an integer") from None
+    return max(0, zoom) if zoom < CLUSTER_MAX_ZOOM else None
+
+@dataclass(frozen=True)
+class MapQuery:
+    """What one client asked for: tag filter, field projection, viewport, zoom, ?q= filter."""
+    tags: tuple = None
+    fields: tuple = None
+    bbox: tuple = None
+    zoom: int = None
+    where: str = None
+
+    @classmethod
+    def parse(cls, args):
+        """Raises ValueError for malformed parameters."""
+        return cls(parse_tags(args), parse_fields(args), parse_bbox(args), parse_zoom(args),
+                   parse_filter(args))
+
+    def is_raw(self):
+        """True if the upstream payload can be passed through untouched."""
+        return (self.tags is None and self.fields is None and self.bbox is None and self.zoom is None
+                and self.where is None)
+
+    def clustered(self):
+        return self.zoom is not None
+
+    @cached_property
+    def classify(self):
+        """The classifier function that knows this query's tags."""
+        return classifier.learn(self.tags or ())
+
+    def project(self, u):
+        """`u` cut down to the requested fields, plus "tags": the query tags its callsign matched."""
+        rec = u if self.fields is None else project(u, field_tree(self.fields))
+        if self.tags and (self.fields is None or "tags" in self.fields):
+            if rec is u:
+                rec = dict(u)
+            rec["tags"] = matched_tags(callsign(u), self.tags, self.classify)
+        return rec
+
+def project(obj, tree):
+    out = {}
+    for key, sub in tree.items():
+        if key not in obj:
+            continue
+        val = obj[key]
+        if sub is None:
+            out[key] = val
+        elif isinstance(val, dict):
+            out[key] = project(val, sub)
+    return out
+
+def is_excluded(cs):
+    return cs in EXCLUDED_CALLSIGNS or cs.lower() in EXCLUDED_CALLSIGNS_CI
+
+def callsign(u):
+    cs = u.get("cs") if isinstance(u, dict) else None
+    return cs.strip() if isinstance(cs, str) else ""
+
+def filter_users(users, tags):
+    """Users with a usable callsign that contains one of `tags` (all if empty)."""
+    classify = classifier.learn(tags)
+    wanted = tag_set(tags)
+    for u in users:
+        cs = callsign(u)
+        if not cs or is_excluded(cs):
+            continue
+        if not wanted or classify(cs) & wanted:
+            yield u
+
+def select_users(snap, query):
+    """Users of `snap` inside the query's viewport, ?q= filter and tag filter (unprojected)."""
+    if query.where is not None:
+        users = snap.matching(query.where)
+        if query.bbox is not None:
+            users = [u for u in users if in_bbox(query.bbox, *position(u))]
+    else:
+        users = snap.valid_users if query.bbox is None else snap.grid.query(query.bbox)
+    return users if query.tags is None else filter_users(users, query.tags)
+
+# ---------------- Query language ----------------
+# ?q= filters, e.g.  tag:[PMC] alt>20000 type:F-16 speed>400 near:51.5,-0.1,200nm
+#
+#   tag:[PMC],[U]         callsign contains one of the tags (case-insensitive)
+#   cs:text               callsign contains text; a bare word means the same
+#   type:F-16 / type:7    aircraft type whose name contains the text, or its id
+#   alt>20000             altitude in feet (or alt>6000m); also <, >=, <=, =, !=
+#   speed>400             airspeed in knots
+#   hdg>=90               heading in degrees
+#   near:lat,lon,radius   within radius of a point: nm (default), km or mi
+#
+# Terms are ANDed and any term can be negated with a leading "-". A query is
+# compiled once (compile_filter is cached by the query string) and its result
+# is cached per snapshot (Snapshot.matching), so each distinct query costs one
+# pass per snapshot however many clients share it. Each term narrows a list of
+# row indices over the snapshot's columns, cheapest terms first.
+def _known_ne(a, b):
+    # Missing numbers are NaN, which != would match; like every other
+    # comparison it must be false for them.
+    return (a == a) & (a != b)
+
+NM_PER = {"nm": 1.0, "km": 1 / 1.852, "mi": 1.609344 / 1.852}
+EARTH_RADIUS_NM = 3440.065
+COMPARISONS = {">=": operator.ge, "<=": operator.le, "!=": _known_ne,
+               ">": operator.gt, "<": operator.lt, "=": operator.eq}
+NUMERIC_FIELDS = {"alt": "alt", "altitude": "alt", "speed": "speed", "spd": "speed",
+                  "hdg": "hdg", "heading": "hdg"}
+_COMPARISON = re.compile(r"^([a-z]+)(>=|<=|!=|>|<|=)(-?\d+(?:\.\d+)?)([a-z]*)$")
+_RADIUS = re.compile(r"^(\d+(?:\.\d+)?)([a-z]*)$")
+
+class Compare:
+    cost = 0
+
+    def __init__(self, column, op, value):
+        self.column, self.op, self.value = column, op, value
+
+    def select(self, cols, rows):
+        col, op, value = getattr(cols, self.column), self.op, self.value
+        if np is not None:
+            return rows[op(col[rows], value)]
+        if len(rows) == len(col):
+            return list(itertools.compress(rows, map(op, col, repeat(value))))
+        return [i for i in rows if op(col[i], value)]
+
+class TypeIs:
+    cost = 0
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    @cached_property
+    def id_array(self):
+        return np.array(sorted(self.ids), dtype=np.int64)
+
+    def select(self, cols, rows):
+        ac, ids = cols.ac, self.ids
+        if np is not None:
+            return rows[np.isin(ac[rows], self.id_array)]
+        if len(rows) == len(ac):
+            return list(itertools.compress(rows, map(ids.__contains__, ac)))
+        return [i for i in rows if ac[i] in ids]
+
+class Near:
+    cost = 1
+
+    def __init__(self, lat, lon, radius_nm):
+        self.lat, self.lon, self.radius = lat, lon, radius_nm
+        # Haversine term of the radius; past the antipode everything is in range.
+        self.limit = (math.sin(radius_nm / EARTH_RADIUS_NM / 2) ** 2
+                      if radius_nm < EARTH_RADIUS_NM * math.pi else 1.0)
+
+    def select(self, cols, rows):
+        lat0, lon0 = math.radians(self.lat), math.radians(self.lon)
+        if np is not None:
+            phi = np.radians(cols.lat[rows])
+            dl = np.radians(cols.lon[rows]) - lon0
+            h = np.sin((phi - lat0) / 2) ** 2 + math.cos(lat0) * np.cos(phi) * np.sin(dl / 2) ** 2
+            return rows[h <= self.limit]
+        # A lat/lon box first, then the great-circle distance for what is in it.
+        # The box is widest in longitude at its poleward edge.
+        dlat = self.radius / 60
+        coslat = math.cos(math.radians(min(90.0, abs(self.lat) + dlat)))
+        dlon = 180.0 if coslat * 60 * 180 <= self.radius else self.radius / (60 * coslat)
+        lats, lons = cols.lat, cols.lon
+        out = []
+        for i in rows:
+            lat = lats[i]
+            if abs(lat - self.lat) > dlat:
+                continue
+            dl = (lons[i] - self.lon + 180) % 360 - 180
+            if abs(dl) > dlon:
+                continue
+            phi = math.radians(lat)
+            h = (math.sin((phi - lat0) / 2) ** 2
+                 + math.cos(lat0) * math.cos(phi) * math.sin(math.radians(dl) / 2) ** 2)
+            if h <= self.limit:
+                out.append(i)
+        return out
+
+class HasTag:
+    cost = 2
+
+    def __init__(self, tags):
+        self.tags = tags
+
+    def select(self, cols, rows):
+        wanted, classify, cs = tag_set(self.tags), classifier.learn(self.tags), cols.cs
+        return cols.as_rows([i for i in rows if classify(cs[i]) & wanted])
+
+class CallsignHas:
+    cost = 2
+
+    def __init__(self, text):
+        self.text = text
+
+    def select(self, cols, rows):
+        text, cs = self.text, cols.cs_upper
+        return cols.as_rows([i for i in rows if text in cs[i]])
+
+class Not:
+    def __init__(self, term):
+        self.term = term
+        self.cost = term.cost + 3
+
+    def select(self, cols, rows):
+        drop = self.term.select(cols, rows)
+        if np is not None:
+            return rows[~np.isin(rows, drop)]
+        drop = set(drop)
+        return [i for i in rows if i not in drop]
+
+class Filter:
+    """A compiled ?q= query: terms applied in order of cost."""
+
+    def __init__(self, key, terms):
+        self.key = key
+        self.terms = sorted(terms, key=lambda t: t.cost)
+
+    def apply(self, cols):
+        """Users of `cols` matching every term, in upstream order."""
+        rows = cols.all_rows()
+        for term in self.terms:
+            rows = term.select(cols, rows)
+            if not len(rows):
+                break
+        users = cols.users
+        return tuple(users[i] for i in (rows.tolist() if np is not None else rows))
+
+def _number_arg(text, what):
+    try:
+        value = float(text)
+    except ValueError:
+        raise ValueError(f"{what} must be a number, got {text!r}") from None
+    if not math.isfinite(value):
+        raise ValueError(f"{what} must be a number, got {text!r}")
+    return value
+
+def compile_term(token):
+    """(canonical text, term) for one query word. Raises ValueError."""
+    key, sep, value = token.partition(":")
+    key = key.lower()
+    if sep and key == "tag":
+        tags = tuple(sorted({t.strip().upper() for t in value.split(",")} - {""}))
+        if not tags:
+            raise ValueError("tag: needs at least one tag")
+        return f"tag:{','.join(tags)}", HasTag(tags)
+    if sep and key == "cs":
+        if not value:
+            raise ValueError("cs: needs some text")
+        return f"cs:{value.upper()}", CallsignHas(value.upper())
+    if sep and key == "type":
+        wanted = value.strip().lower()
+        if wanted and all(p.isdigit() for p in wanted.split(",")):
+            ids = frozenset(int(p) for p in wanted.split(","))
+        else:
+            ids = frozenset(ac for ac, name in AIRCRAFT_DB.items() if wanted and wanted in name.lower())
+            if not ids:
+                raise ValueError(f"no aircraft type matches {value!r}")
+        return f"type:{','.join(map(str, sorted(ids)))}", TypeIs(ids)
+    if sep and key == "near":
+        parts = value.split(",")
+        if len(parts) != 3:
+            raise ValueError("near: takes lat,lon,radius")
+        lat = _number_arg(parts[0], "near: latitude")
+        lon = _number_arg(parts[1], "near: longitude")
+        m = _RADIUS.match(parts[2].strip().lower())
+        if not m or (m.group(2) or "nm") not in NM_PER:
+            raise ValueError(f"near: radius must be a number with an optional unit ({', '.join(NM_PER)})")
+        nm = float(m.group(1)) * NM_PER[m.group(2) or "nm"]
+        if not (abs(lat) <= 90 and abs(lon) <= 180 and nm > 0):
+            raise ValueError("near: point out of range or radius not positive")
+        return f"near:{lat:.10g},{lon:.10g},{nm:.10g}nm", Near(lat, lon, nm)
+    if sep:
+        raise ValueError(f"unknown filter {key}:")
+    m = _COMPARISON.match(token.lower())
+    if m:
+        name, op, number, unit = m.groups()
+        field = NUMERIC_FIELDS.get(name)
+        if field is None:
+            raise ValueError(f"cannot compare {name!r}; use alt, speed or hdg")
+        value = float(number)
+        if field == "alt" and unit == "m":
+            value *= FT_PER_M
+        elif unit and unit != {"alt": "ft", "speed": "kt", "hdg": "deg"}[field]:
+            raise ValueError(f"unknown unit {unit!r} for {name}")
+        return f"{field}{op}{value:.10g}", Compare(field, COMPARISONS[op], value)
+    if any(op in token for op in "<>="):
+        raise ValueError(f"cannot parse {token!r}")
+    return f"cs:{token.upper()}", CallsignHas(token.upper())
+
+@lru_cache(maxsize=256)
+def compile_filter(q):
+    """Filter for query string `q`, or None if it has no terms. Raises ValueError."""
+    try:
+        tokens = shlex.split(q)
+    except ValueError as e:
+        raise ValueError(f"q: {e}") from None
+    parts = {}
+    for token in tokens:
+        negate = token.startswith("-") and len(token) > 1
+        text, term = compile_term(token[1:] if negate else token)
+        if negate:
+            text, term = "-" + text, Not(term)
+        parts[text] = term
+    if not parts:
+        return None
+    return Filter(" ".join(shlex.quote(text) for text in sorted(parts)), list(parts.values()))
+
+def parse_filter(args):
+    """`?q=` -> canonical query text (equal for equivalent queries), or None."""
+    q = args.get("q")
+    if q is None or not q.strip():
+        return None
+    flt = compile_filter(q)
+    return None if flt is None else flt.key
+
+# ---------------- Spatial index ----------------
+def position(u):
+    """(lat, lon) of a user record, or None if missing or out of range."""
+    co = u.get("co") if isinstance(u, dict) else None
+    if not isinstance(co, list) or len(co) < 2:
+        return None
+    lat, lon = _number(co[0]), _number(co[1])
+    if not (abs(lat) <= 90 and abs(lon) <= 180):
+        return None
+    return lat, lon
+
+class SpatialGrid:
+    """Uniform lat/lon grid over one snapshot's aircraft.
+
+    Built once per snapshot from its SnapshotColumns (see Snapshot.grid); a
+    viewport query only visits the cells the box overlaps.
+    """
+
+    def __init__(self, columns, cell_deg=GRID_CELL_DEG):
+        self.users = columns.users
+        self.cell = cell_deg
+        self.cols = int(math.ceil(360 / cell_deg))
+        self.rows = int(math.ceil(180 / cell_deg))
+        self.lat = columns.lat.tolist()
+        self.lon = columns.lon.tolist()
+        cells = {}
+        for i, (lat, lon) in enumerate(zip(self.lat, self.lon)):
+            cells.setdefault(self._row(lat) * self.cols + self._col(lon), []).append(i)
+        self.cells = cells
+
+    def _row(self, lat):
+        return min(self.rows - 1, int((lat + 90) // self.cell))
+
+    def _col(self, lon):
+        return min(self.cols - 1, int((lon + 180) // self.cell))
+
+    def query(self, bbox):
+        """Users inside `bbox` (as returned by parse_bbox), in upstream order."""
+        min_lat, max_lat, lon_ranges = bbox
+        r0, r1 = self._row(min_lat), self._row(max_lat)
+        hits = []
+        for west, east in lon_ranges:
+            c0, c1 = self._col(west), self._col(east)
+            if (r1 - r0 + 1) * (c1 - c0 + 1) <= len(self.cells):
+                keys = (r * self.cols + c for r in range(r0, r1 + 1) for c in range(c0, c1 + 1))
+                candidates = (self.cells.get(k, ()) for k in keys)
+            else:
+                candidates = (idx for k, idx in self.cells.items()
+                              if r0 <= k // self.cols <= r1 and c0 <= k % self.cols <= c1)
+            for idx in candidates:
+                for i in idx:
+                    if min_lat <= self.lat[i] <= max_lat and west <= self.lon[i] <= east:
+                        hits.append(i)
+        hits.sort()
+        return [self.users[i] for i in hits]
+
+def in_bbox(bbox, lat, lon):
+    min_lat, max_lat, lon_ranges = bbox
+    return min_lat <= lat <= max_lat and any(w <= lon <= e for w, e in lon_ranges)
+
+# ---------------- Clustering ----------------
+def cluster_cell_deg(zoom):
+    """Cluster cell size in degrees at a map zoom (256 px world tiles)."""
+    return 360.0 * CLUSTER_CELL_PX / (256 << zoom)
+
+class ClusterIndex:
+    """Grid pyramid of aircraft clusters, one level per zoom below CLUSTER_MAX_ZOOM.
+
+    The finest level is binned from positions; each coarser level merges
+    2x2 cells of the one below, so building every level costs one pass over
+    the aircraft plus a pass over the (far fewer) cells. A cell is
+    [count, lat sum, lon sum, Counter of aircraft types, index of the first
+    aircraft].
+    """
+
+    def __init__(self, users, max_zoom=CLUSTER_MAX_ZOOM):
+        self.users = users
+        deg = cluster_cell_deg(max_zoom - 1)
+        finest = {}
+        for i, u in enumerate(users):
+            pos = position(u)
+            if pos is None:
+                continue
+            key = (int((pos[0] + 90) // deg), int((pos[1] + 180) // deg))
+            cell = finest.get(key)
+            if cell is None:
+                finest[key] = [1, pos[0], pos[1], Counter((u.get("ac"),)), i]
+            else:
+                cell[0] += 1
+                cell[1] += pos[0]
+                cell[2] += pos[1]
+                cell[3][u.get("ac")] += 1
+        self.levels = [finest]
+        for _ in range(max_zoom - 1):
+            parent = {}
+            for (row, col), cell in self.levels[0].items():
+                key = (row >> 1, col >> 1)
+                merged = parent.get(key)
+                if merged is None:
+                    parent[key] = [cell[0], cell[1], cell[2], Counter(cell[3]), cell[4]]
+                else:
+                    merged[0] += cell[0]
+                    merged[1] += cell[1]
+                    merged[2] += cell[2]
+                    merged[3].update(cell[3])
+            self.levels.insert(0, parent)
+
+    def query(self, zoom, bbox=None):
+        """(single aircraft, cluster rows) at `zoom`, cut to `bbox` by position.
+
+        A cluster row is [lat, lon, count, dominant aircraft type] with the
+        centroid as position; cells holding one aircraft come back as that
+        aircraft instead.
+        """
+        singles, clusters = [], []
+        for count, lat_sum, lon_sum, types, first in self.levels[min(zoom, len(self.levels) - 1)].values():
+            lat, lon = lat_sum / count, lon_sum / count
+            if bbox is not None and not in_bbox(bbox, lat, lon):
+                continue
+            if count == 1:
+                singles.append(first)
+            else:
+                clusters.append([round(lat, 4), round(lon, 4), count, types.most_common(1)[0][0]])
+        singles.sort()
+        return [self.users[i] for i in singles], clusters
+
+def cluster_payload(snap, query):
+    """Clustered view of `snap` for a low-zoom query; always a full list."""
+    singles, clusters = snap.cluster_index(query.tags, query.where).query(query.zoom, query.bbox)
+    users = [query.project(u) for u in singles]
+    return {"seq": snap.seq, "userCount": snap.user_count, "zoom": query.zoom,
+            "users": users, "clusters": clusters}
+
+# ---------------- Deltas ----------------
+def aircraft_id(u):
+    """Stable per-aircraft key, the same one the page uses for its aircraft store."""
+    key = u.get("id") or u.get("acid")
+    return None if key is None else str(key)
+
+def keyed_view(snap, query):
+    """id -> (filtered, projected) user record for one snapshot."""
+    view = {}
+    for u in select_users(snap, query):
+        if not isinstance(u, dict):
+            continue
+        key = aircraft_id(u)
+        if key is not None:
+            view[key] = query.project(u)
+    return view
+
+def delta_payload(old, new, query):
+    """Aircraft added, changed and removed between two snapshots.
+
+    `added` holds whole records. `changed` maps aircraft id to just the
+    top-level fields whose value differs, since callsign, acid, ac and id
+    rarely change between ticks.
+    """
+    before = keyed_view(old, query)
+    after = keyed_view(new, query)
+    added, changed = [], {}
+    for key, u in after.items():
+        prev = before.get(key)
+        if prev is None or prev.keys() - u.keys():
+            added.append(u)
+        elif prev != u:
+            changed[key] = {k: v for k, v in u.items() if prev.get(k) != v}
+    removed = [key for key in before if key not in after]
+    return {
+        "seq": new.seq, "since": old.seq, "delta": True, "userCount": new.user_count,
+        "added": added, "changed": changed, "removed": removed,
+    }
+
+def full_payload(snap, query):
+    users = select_users(snap, query)
+    if query.fields is not None or query.tags:
+        users = (query.project(u) for u in users if isinstance(u, dict))
+    return {"seq": snap.seq, "userCount": snap.user_count, "users": list(users)}
+
+# ---------------- Binary frames ----------------
+# Columnar alternative to the JSON user list, served to clients that send
+# `Accept: application/x-geofs-frame`. Little-endian throughout:
+#
+#   header   magic "GFR1", u16 version, u16 reserved, u32 seq, u32 count,
+#            u32 userCount, u32 string table length                (24 bytes)
+#   f32[count] x5   lat, lon, alt (ft), heading, speed (st.as; NaN if missing)
+#   u32[count]      acid (0xFFFFFFFF if missing)
+#   u32[3*count+1]  string offsets: callsign i is strings[off[3i]:off[3i+1]],
+#                   id i is strings[off[3i+1]:off[3i+2]], and the query tags
+#                   it matched, comma-separated, strings[off[3i+2]:off[3i+3]]
+#   u16[count]      aircraft type (`ac`; 0xFFFF if missing), padded to 4 bytes
+#   utf-8 string table
+FRAME_MIME = "application/x-geofs-frame"
+FRAME_MAGIC = b"GFR1"
+FRAME_VERSION = 3
+FRAME_HEADER = struct.Struct("<4sHHIIII")
+NO_U32 = 0xFFFFFFFF
+NO_U16 = 0xFFFF
+
+def _le(arr):
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+def _number(v, default=math.nan):
+    return float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else default
+
+_FRAME_TYPES = {"f": "<f4", "I": "<u4", "H": "<u2"}
+
+def _packed(col, rows, code, missing=None):
+    """Little-endian bytes of col[rows] as array type `code`; negative or
+    too large integers become `missing`."""
+    if np is not None:
+        values = col[rows]
+        if missing is not None:
+            values = np.where((values < 0) | (values >= missing), missing, values)
+        return values.astype(_FRAME_TYPES[code]).tobytes()
+    values = [col[i] for i in rows]
+    if missing is not None:
+        values = [v if 0 <= v < missing else missing for v in values]
+    return _le(array(code, values)).tobytes()
+
+def encode_frame(snap, query):
+    """Encode the users of `snap` selected by `query` as one binary frame.
+
+    Columns come straight from the snapshot's SnapshotColumns, so only
+    aircraft that passed its validation are sent. The frame has fixed
+    columns, so the query's field projection is ignored.
+    """
+    cols = snap.columns
+    index = cols.index
+    rows = []
+    for u in select_users(snap, query):
+        row = index.get(aircraft_id(u)) if isinstance(u, dict) else None
+        if row is not None:
+            rows.append(row)
+    offsets = array("I", [0])
+    strings = bytearray()
+    for i in rows:
+        cs = cols.cs[i]
+        strings += cs.encode("utf-8")
+        offsets.append(len(strings))
+        strings += cols.ids[i].encode("utf-8")
+        offsets.append(len(strings))
+        if query.tags:
+            strings += ",".join(matched_tags(cs, query.tags, query.classify)).encode("utf-8")
+        offsets.append(len(strings))
+    count = len(rows)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, 0, snap.seq, count,
+                               snap.user_count, len(strings))
+    parts = [header]
+    parts += (_packed(col, rows, "f") for col in (cols.lat, cols.lon, cols.alt, cols.hdg, cols.speed))
+    parts.append(_packed(cols.acid, rows, "I", NO_U32))
+    parts.append(_le(offsets).tobytes())
+    parts.append(_packed(cols.ac, rows, "H", NO_U16))
+    if count % 2:
+        parts.append(_le(array("H", [NO_U16])).tobytes())
+    parts.append(bytes(strings))
+    return b"".join(parts)
+
+def decode_frame(buf):
+    """Inverse of encode_frame, for tools and debugging. Returns a dict of columns."""
+    magic, version, _, seq, count, user_count, strings_len = FRAME_HEADER.unpack_from(buf)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError(f"not a GFR1 version {FRAME_VERSION} frame")
+    view = memoryview(buf)
+    pos = FRAME_HEADER.size
+    cols = {"seq": seq, "count": count, "userCount": user_count}
+    for name, code, n in (("lat", "f", count), ("lon", "f", count), ("alt", "f", count),
+                          ("hdg", "f", count), ("speed", "f", count), ("acid", "I", count),
+                          ("offsets", "I", 3 * count + 1), ("ac", "H", count + count % 2)):
+        col = array(code)
+        col.frombytes(view[pos:pos + n * col.itemsize])
+        cols[name] = _le(col)
+        pos += n * col.itemsize
+    del cols["ac"][count:]
+    strings = bytes(view[pos:pos + strings_len])
+    off = cols.pop("offsets")
+    cols["cs"] = [strings[off[3 * i]:off[3 * i + 1]].decode("utf-8") for i in range(count)]
+    cols["id"] = [strings[off[3 * i + 1]:off[3 * i + 2]].decode("utf-8") for i in range(count)]
+    cols["tags"] = [strings[off[3 * i + 2]:off[3 * i + 3]].decode("utf-8") for i in range(count)]
+    return cols
+
+# ---------------- Compression / ETags ----------------
+class Encoded:
+    """A response body with its strong ETag and compressed variants.
+
+    Each variant is compressed at most once; precompress() does them all up
+    front so that requests never pay for it.
+    """
+
+    def __init__(self, body, variants=None):
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.etag = hashlib.blake2b(self.body, digest_size=8).hexdigest()
+        self._variants = dict(variants) if variants else {}
+
+    def precompress(self, best=False):
+        if len(self.body) >= COMPRESS_MIN_BYTES:
+            for coding in CODINGS:
+                self.variant(coding, best)
+        return self
+
+    def variant(self, coding, best=False):
+        """The body in `coding` ("gzip", "br" or None for identity)."""
+        if coding is None:
+            return self.body
+        out = self._variants.get(coding)
+        if out is None:
+            out = self._variants[coding] = compress(self.body, coding, best)
+        return out
+
+    def encodings(self):
+        """coding -> compressed body, for the variants made so far."""
+        return dict(self._variants)
+
+def compress(body, coding, best=False):
+    if coding == "br":
+        return brotli.compress(body, quality=11 if best else 5)
+    return gzip.compress(body, 9 if best else 6, mtime=0)
+
+# Preferred first.
+CODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+def pick_coding(req, enc):
+    if len(enc.body) < COMPRESS_MIN_BYTES:
+        return None
+    accepted = req.accept_encodings
+    best, best_q = None, 0
+    for coding in CODINGS:
+        q = accepted[coding]
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def send_encoded(req, enc, content_type, cache_control, vary="Accept-Encoding"):
+    """Respond with the best variant of `enc`, or 304 if the client has it."""
+    coding = pick_coding(req, enc)
+    etag = enc.etag if coding is None else f"{enc.etag}-{coding}"
+    if any(req.if_none_match.contains(t) for t in [enc.etag] + [f"{enc.etag}-{c}" for c in CODINGS]):
+        resp = Response(status=304)
+    else:
+        resp = Response(enc.variant(coding), 200, content_type=content_type)
+        if coding is not None:
+            resp.headers["Content-Encoding"] = coding
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    resp.headers["Vary"] = vary
+    return resp
+
+# ---------------- Result cache ----------------
+class ResultCache:
+    """LRU of encoded answers, keyed by (kind, snapshot seq(s), MapQuery).
+
+    MapQuery is already canonical (sorted tags and fields, normalized bbox,
+    canonical ?q=), so every client asking the same question of the same
+    snapshot gets the same Encoded, compressed once, instead of filtering
+    and serializing it again. A thread that finds the answer being built
+    by another waits for it rather than building it twice.
+    """
+
+    def __init__(self, size, max_bytes):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = self.waits = self.evictions = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """The cached value for `key`, calling build() to make it on a miss."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+                self.waits += 1
+            # Another thread is building it; if that one fails, try again.
+            pending.wait()
+        try:
+            value = build()
+            self._store(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    def _store(self, key, value):
+        cost = len(value.body) if isinstance(value, Encoded) else len(value)
+        if self.size <= 0 or cost > self.max_bytes:
+            return
+        with self._lock:
+            self._entries[key] = (value, cost)
+            self.bytes += cost
+            while len(self._entries) > self.size or self.bytes > self.max_bytes:
+                _, (_, old) = self._entries.popitem(last=False)
+                self.bytes -= old
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "bytes": self.bytes, "hits": self.hits,
+                "misses": self.misses, "waits": self.waits, "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None}
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_BYTES)
+
+# ---------------- Request handling ----------------
+# Shared by the Flask (WSGI) routes and the ASGI app below. Each handler takes
+# a werkzeug Request plus the poller it should read from.
+def error_response(message, status=502):
+    return Response(encode_json({"error": message}), status, content_type="application/json")
+
+def wants_frame(req):
+    """True if the client explicitly asks for binary frames and prefers them over JSON."""
+    accept = req.accept_mimetypes
+    listed = any(mime == FRAME_MIME and q > 0 for mime, q in accept)
+    return listed and accept[FRAME_MIME] >= accept["application/json"]
+
+JSON_TYPE = "application/json; charset=utf-8"
+
+def encode_snapshot(req, snap, query, raw_ok=False, cache=None):
+    """(Encoded, content type) of everything in `snap` that `query` selects.
+
+    Clusters below CLUSTER_MAX_ZOOM, else a binary frame if the client
+    prefers one, else JSON. With `raw_ok` an unfiltered query is answered
+    with the upstream body itself. Answers are shared through `cache`
+    (a ResultCache) when given; only pass one for live snapshots, whose
+    seq identifies them.
+    """
+    if query.clustered():
+        kind, content_type = "clusters", JSON_TYPE
+        build = lambda: Encoded(encode_json(cluster_payload(snap, query)))
+    elif wants_frame(req):
+        # Frames have fixed columns, so queries differing only in fields share one.
+        kind, content_type, query = "frame", FRAME_MIME, replace(query, fields=None)
+        build = lambda: Encoded(encode_frame(snap, query))
+    elif raw_ok and query.is_raw() and snap.raw is not None:
+        return snap.raw, JSON_TYPE
+    else:
+        kind, content_type = "full", JSON_TYPE
+        build = lambda: Encoded(encode_json(full_payload(snap, query)))
+    if cache is None:
+        return build(), content_type
+    return cache.get((kind, snap.seq, query), build), content_type
+
+def map_response(req, source, snap):
+    """Serve the latest GeoFS map snapshot from memory.
+
+    Optional query parameters:
+      tags=[U],[PMC]      only callsigns containing one of the tags
+      fields=id,cs,st.as  return only these (dotted) fields per aircraft
+      bbox=minLat,minLon,maxLat,maxLon
+                          only aircraft inside the box (may cross the antimeridian)
+      q=<query>           filter expression, e.g. "alt>20000 type:F-16 near:51.5,-0.1,200nm"
+                          (see "Query language")
+      zoom=<z>            map zoom; below CLUSTER_MAX_ZOOM the answer is a
+                          full list of "clusters" ([lat, lon, count, ac] rows)
+                          plus the aircraft that sit alone in their cell
+      since=<seq>         only what changed since snapshot <seq>; a full
+                          list (no "delta" key) if <seq> is no longer kept
+
+    Full lists are sent as a binary frame (see encode_frame) instead of JSON
+    when the Accept header asks for FRAME_MIME; deltas and clusters are
+    always JSON.
+    Bodies are gzip/brotli-compressed and carry a strong ETag, so a poll
+    that would return the same bytes again gets a 304. Every client sending
+    the same query for the same snapshot is served the same cached bytes.
+    """
+    if snap is None:
+        return error_response(source.last_error or "upstream snapshot not available yet")
+    try:
+        query = MapQuery.parse(req.args)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    since = req.args.get("since", type=int)
+    base = source.at(since) if since is not None else None
+    if base is not None and not query.clustered():
+        enc = result_cache.get(("delta", base.seq, snap.seq, query),
+                               lambda: Encoded(encode_json(delta_payload(base, snap, query))))
+        content_type = JSON_TYPE
+    else:
+        enc, content_type = encode_snapshot(req, snap, query, raw_ok=since is None, cache=result_cache)
+    resp = send_encoded(req, enc, content_type, "no-cache", vary="Accept, Accept-Encoding")
+    resp.headers["X-Snapshot-Age"] = f"{snap.age():.3f}"
+    resp.headers["X-Snapshot-Seq"] = str(snap.seq)
+    return resp
+
+def parse_time(req, name, default):
+    """Unix seconds from query parameter `name`; negative values count back from now."""
+    value = req.args.get(name)
+    if value is None:
+        return default
+    try:
+        t = float(value)
+    except ValueError:
+        t = math.nan
+    if not math.isfinite(t):
+        raise ValueError(f"{name} must be unix seconds, or negative seconds before now")
+    return time.time() + t if t < 0 else t
+
+def history_response(req, tracks):
+    """Recorded trail of one aircraft.
+
+    Query parameters:
+      id=<aircraft id>    required; the "id" of the /api/map records
+      from=<t>, to=<t>    unix seconds, or negative for seconds before now;
+                          default to the whole HISTORY_SECONDS window
+
+    Answers {"id", "cs", "ac", "from", "to", "points"} where each point is
+    [t, lat, lon, alt (m), heading, speed (kt)], oldest first; heading and
+    speed are null when upstream did not report them.
+    """
+    if tracks is None:
+        return error_response("history is disabled (HISTORY_SECONDS=0)", 404)
+    key = req.args.get("id")
+    if not key:
+        return error_response("id is required", 400)
+    now = time.time()
+    try:
+        t_from = parse_time(req, "from", now - tracks.seconds)
+        t_to = parse_time(req, "to", now)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    meta, rows = tracks.trail(key, t_from, t_to)
+    if meta is None:
+        return error_response(f"no history for id {key}", 404)
+    cs, ac, _ = meta
+    points = [[t / 10, lat / 1e5, lon / 1e5, alt,
+               None if hdg == NO_VALUE else hdg, None if spd == NO_VALUE else spd]
+              for t, lat, lon, alt, hdg, spd in rows]
+    payload = {"id": key, "cs": cs, "ac": ac, "from": t_from, "to": t_to, "points": points}
+    return send_encoded(req, Encoded(encode_json(payload)), JSON_TYPE, "no-cache")
+
+def replay_response(req, tracks):
+    """Every aircraft as it was at t=<unix seconds, or negative seconds before now>.
+
+    Takes the tags/fields/bbox/zoom parameters and Accept header of
+    /api/map and answers in the same formats (seq is always 0). Each
+    aircraft is placed at its last recorded sample at or before t; those
+    not seen within HISTORY_MAX_GAP seconds before t are left out.
+    """
+    if tracks is None:
+        return error_response("history is disabled (HISTORY_SECONDS=0)", 404)
+    try:
+        t = parse_time(req, "t", None)
+        query = MapQuery.parse(req.args)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    if t is None:
+        return error_response("t is required", 400)
+    enc, content_type = encode_snapshot(req, tracks.replay(t), query)
+    resp = send_encoded(req, enc, content_type, "no-cache", vary="Accept, Accept-Encoding")
+    resp.headers["X-Replay-Time"] = f"{t:.1f}"
+    return resp
+
+class StreamSlots:
+    """Counts live /api/stream subscribers in this worker."""
+
+    def __init__(self):
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, limit):
+        with self._lock:
+            if self.active >= limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+stream_slots = StreamSlots()
+
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# Sent first so the browser sees the stream open right away.
+STREAM_HELLO = b": connected\n\n"
+STREAM_KEEPALIVE_EVENT = b": keep-alive\n\n"
+
+def stream_params(req):
+    """(query, since, every) for /api/stream; `since` may come from Last-Event-ID.
+
+    `every` is the minimum number of seconds between events, at most
+    STREAM_KEEPALIVE. Raises ValueError for malformed parameters.
+    """
+    since = req.args.get("since", type=int)
+    if since is None:
+        since = req.headers.get("Last-Event-ID", type=int)
+    every = req.args.get("every", 0.0, type=float)
+    if not math.isfinite(every):
+        raise ValueError("every must be a number of seconds")
+    return MapQuery.parse(req.args), since, min(max(every, 0.0), STREAM_KEEPALIVE)
+
+def stream_event(last, snap, query):
+    """The SSE event (bytes) taking a subscriber from snapshot `last` (or nothing) to `snap`.
+
+    Subscribers with the same query move between the same snapshots in
+    lockstep, so the event is built once and shared through result_cache.
+    """
+    if query.clustered():
+        key = ("event", None, snap.seq, query)
+        build = lambda: cluster_payload(snap, query)
+    elif last is not None:
+        key = ("event", last.seq, snap.seq, query)
+        build = lambda: delta_payload(last, snap, query)
+    else:
+        key = ("event", None, snap.seq, query)
+        build = lambda: full_payload(snap, query)
+    stream_events.inc()
+    return result_cache.get(
+        key, lambda: b"id: %d\nevent: map\ndata: %s\n\n" % (snap.seq, encode_json(build())))
+
+def stats_response(source, client):
+    """Per-worker state of the upstream connection pool and poller."""
+    snap = source.snapshot
+    payload = {
+        "pid": os.getpid(),
+        "role": ROLE,
+        "upstream": client.stats() if client is not None else None,
+        "poller": {
+            "seq": snap.seq if snap else None,
+            "age": round(snap.age(), 3) if snap else None,
+            "failures": source.failures,
+            "last_error": source.last_error,
+        },
+        "bus": source.bus_stats(),
+        "streams": stream_slots.active,
+        "classifier": classifier.stats(),
+        "results": result_cache.stats(),
+        "json": JSON_BACKEND,
+        "history": source.tracks.stats() if source.tracks is not None else None,
+        "archive": source.archive.stats() if source.archive is not None else None,
+    }
+    return Response(encode_json(payload), 200, {"Cache-Control": "no-store"}, content_type="application/json")
+
+def serving():
+    """(poller, upstream pool or None) this worker serves from, in either server mode."""
+    if AsgiState.poller is not None:
+        return AsgiState.poller, AsgiState.client
+    return poller, (upstream if ROLE != "edge" else None)
+
+def snapshot_gauge(read):
+    def gauge():
+        snap = serving()[0].snapshot
+        return {(): read(snap)} if snap is not None else {}
+    return gauge
+
+def pool_counter(key):
+    def counter():
+        client = serving()[1]
+        return {(): client.stats()[key]} if client is not None else {}
+    return counter
+
+def circuits_open():
+    client = serving()[1]
+    if client is None:
+        return {}
+    return {(c.url,): int(h.state() == "open") for c, h in zip(client.clients, client.health)}
+
+metrics.add(Sampled("radar_snapshot_age_seconds", "Age of the snapshot being served",
+                    snapshot_gauge(lambda snap: round(snap.age(), 3)), host_wide=True))
+metrics.add(Sampled("radar_snapshot_seq", "Seq of the snapshot being served",
+                    snapshot_gauge(lambda snap: snap.seq), host_wide=True))
+metrics.add(Sampled("radar_aircraft", "Aircraft in the snapshot being served",
+                    snapshot_gauge(lambda snap: len(snap.valid_users)), host_wide=True))
+metrics.add(Sampled("radar_streams_active", "Open /api/stream subscriptions",
+                    lambda: {(): stream_slots.active}))
+metrics.add(Sampled("radar_result_cache_hits_total", "Answers served from the result cache",
+                    lambda: {(): result_cache.hits}, "counter"))
+metrics.add(Sampled("radar_result_cache_misses_total", "Answers the result cache had to build",
+                    lambda: {(): result_cache.misses}, "counter"))
+metrics.add(Sampled("radar_result_cache_bytes", "Bytes held by the result cache",
+                    lambda: {(): result_cache.bytes}))
+metrics.add(Sampled("radar_upstream_hedged_total", "Upstream fetches that were hedged",
+                    pool_counter("hedged"), "counter"))
+metrics.add(Sampled("radar_upstream_hedge_wins_total", "Hedged fetches the hedge answered first",
+                    pool_counter("hedge_wins"), "counter"))
+metrics.add(Sampled("radar_upstream_failovers_total", "Upstream requests retried on another endpoint",
+                    pool_counter("failovers"), "counter"))
+metrics.add(Sampled("radar_upstream_rejected_total", "Fetches not sent because every circuit was open",
+                    pool_counter("rejected"), "counter"))
+metrics.add(Sampled("radar_upstream_circuit_open", "Workers whose circuit breaker for the endpoint is open",
+                    circuits_open, labels=("endpoint",)))
+
+# Every route serves GET (and so HEAD and OPTIONS) only.
+ROUTES = {"/", "/api/map", "/api/stream", "/api/history", "/api/replay", "/api/stats", "/metrics"}
+ROUTE_METHODS = "GET, HEAD, OPTIONS"
+
+def route_label(path):
+    """Endpoint label of `path` for metrics, whatever the method: its route, or
+    "other" for a path no route matches. Both serving modes label this way."""
+    if path in ROUTES:
+        return path
+    name = path[len("/assets/"):] if path.startswith("/assets/") else ""
+    return "/assets/<name>" if name and "/" not in name else "other"
+
+def observe_response(endpoint, status, elapsed=None, size=0):
+    """Count a response; its time and size too unless it is a stream."""
+    http_requests.inc(endpoint, status)
+    if elapsed is not None:
+        http_request_seconds.observe(elapsed, endpoint)
+        http_response_bytes.observe(size, endpoint)
+
+def metrics_response():
+    return Response(metrics.render(), 200, {"Cache-Control": "no-store"},
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def index_response(req):
+    return send_encoded(req, INDEX_ASSET, "text/html; charset=utf-8", "no-cache")
+
+def asset_response(req, name):
+    """Content-hashed static files, safe to cache forever."""
+    entry = ASSETS.get(name)
+    if entry is None:
+        return Response("not found", 404)
+    enc, content_type = entry
+    return send_encoded(req, enc, content_type, "public, max-age=31536000, immutable")
 
 # ---------------- Flask / proxy ----------------
 app = Flask(__name__)
 
 @app.route("/api/map", methods=["GET"])
 def proxy_map():
-    """Proxy GeoFS map API."""
+    return map_response(request, poller, poller.current())
+
+@app.route("/api/stream", methods=["GET"])
+def stream_map():
+    """Push each new snapshot as a Server-Sent Event.
+
+    Takes the same tags/fields/since parameters as /api/map, plus
+    every=<seconds> to get at most one event per interval. The first event
+    is a full list (or a delta from `since`), every later one a delta from the
+    previous event. A slow client is never queued up: when it is ready for
+    the next event it gets one delta straight to the newest snapshot, skipping
+    whatever it was too slow to receive.
+    """
     try:
-        r = requests.post(UPSTREAM_URL, data={}, timeout=TIMEOUT)
-        r.raise_for_status()
-        resp = make_response(r.content, 200)
-        resp.headers["Content-Type"] = "application/json; charset=utf-8"
-        return resp
-    except Exception as e:
-        return make_response(json.dumps({"error": str(e)}), 502, {"Content-Type": "application/json"})
+        query, since, every = stream_params(request)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    if not stream_slots.acquire(WSGI_MAX_STREAMS):
+        return error_response("too many stream subscribers", 503)
+    poller.start()
+
+    def events():
+        last = poller.at(since) if since is not None else None
+        due = 0.0
+        yield STREAM_HELLO
+        while True:
+            pause = due - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            snap = poller.wait_newer(last.seq if last else None, STREAM_KEEPALIVE)
+            if snap is None or (last is not None and snap.seq == last.seq):
+                yield STREAM_KEEPALIVE_EVENT
+                continue
+            yield stream_event(last, snap, query)
+            last = snap
+            due = time.monotonic() + every
+
+    resp = Response(events(), mimetype="text/event-stream", headers=STREAM_HEADERS)
+    # Runs when the server closes the response, even if the client left
+    # before the first event.
+    resp.call_on_close(stream_slots.release)
+    return resp
+
+@app.route("/api/history", methods=["GET"])
+def history():
+    poller.start()
+    return history_response(request, track_history)
+
+@app.route("/api/replay", methods=["GET"])
+def replay():
+    poller.start()
+    return replay_response(request, track_history)
+
+@app.route("/api/stats", methods=["GET"])
+def stats():
+    return stats_response(poller, upstream if ROLE != "edge" else None)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return metrics_response()
+
+@app.before_request
+def start_timer():
+    request.environ["radar.started"] = time.perf_counter()
+
+@app.after_request
+def observe_request(resp):
+    # A method the route does not allow leaves url_rule unset; count it
+    # against the route all the same.
+    endpoint = request.url_rule.rule if request.url_rule is not None else route_label(request.path)
+    if endpoint == "/api/stream":
+        observe_response(endpoint, resp.status_code)
+    else:
+        elapsed = time.perf_counter() - request.environ["radar.started"]
+        observe_response(endpoint, resp.status_code, elapsed, resp.content_length or 0)
+    return resp
 
 @app.route("/", methods=["GET"])
 def index():
-    return Response(HTML_PAGE, mimetype="text/html")
+    return index_response(request)
+
+@app.route("/assets/<name>", methods=["GET"])
+def asset(name):
+    return asset_response(request, name)
+
+# ---------------- ASGI mode ----------------
+# `uvicorn geofs_live_radar:asgi_app` serves the same routes from one event
+# loop: upstream is fetched with httpx.AsyncClient by an asyncio poller, and
+# every poller or stream subscriber is a coroutine instead of a thread.
+class AsgiState:
+    client = None
+    poller = None
+
+def asgi_start():
+    if AsgiState.poller is None and ROLE == "edge":
+        AsgiState.poller = AsyncEdgePoller(BUS_ADDRESS, POLL_INTERVAL, DELTA_WINDOW, track_history)
+    elif AsgiState.poller is None:
+        AsgiState.client = AsyncUpstreamPool(
+            UPSTREAM_URLS, CONNECT_TIMEOUT, READ_TIMEOUT, UPSTREAM_POOL_SIZE, UPSTREAM_HTTP2, UPSTREAM_HEDGE)
+        AsgiState.poller = AsyncUpstreamPoller(
+            snapshot_cache, AsgiState.client, POLL_INTERVAL, DELTA_WINDOW, track_history, track_archive)
+        if ROLE == "ingest":
+            AsgiState.poller.publisher = SnapshotPublisher(BUS_ADDRESS, DELTA_WINDOW, BUS_QUEUE)
+    AsgiState.poller.start()
+    return AsgiState.poller
+
+def asgi_request(scope):
+    """A werkzeug Request for an ASGI HTTP scope (GET only, so no body)."""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return Request(environ)
+
+async def asgi_send(send, resp, head=False):
+    await send({
+        "type": "http.response.start",
+        "status": resp.status_code,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in resp.headers.items()],
+    })
+    await send({"type": "http.response.body", "body": b"" if head else resp.get_data()})
+
+async def asgi_stream(req, receive, send, source):
+    """/api/stream as a coroutine; same events as the Flask route."""
+    try:
+        query, since, every = stream_params(req)
+    except ValueError as e:
+        observe_response("/api/stream", 400)
+        await asgi_send(send, error_response(str(e), 400))
+        return
+    if not stream_slots.acquire(MAX_STREAMS):
+        observe_response("/api/stream", 503)
+        await asgi_send(send, error_response("too many stream subscribers", 503))
+        return
+    observe_response("/api/stream", 200)
+    gone = asyncio.ensure_future(asgi_disconnected(receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream; charset=utf-8")]
+                       + [(k.lower().encode(), v.encode()) for k, v in STREAM_HEADERS.items()],
+        })
+        last = source.at(since) if since is not None else None
+        due = 0.0
+        event = STREAM_HELLO
+        while not gone.done():
+            # Waits while the transport is paused, so a slow client simply
+            # skips ahead to the newest snapshot when it catches up.
+            await send({"type": "http.response.body", "body": event, "more_body": True})
+            wait = asyncio.ensure_future(
+                asgi_next_snapshot(source, last.seq if last else None, due - time.monotonic()))
+            await asyncio.wait([wait, gone], return_when=asyncio.FIRST_COMPLETED)
+            if not wait.done():
+                wait.cancel()
+                break
+            snap = wait.result()
+            if snap is None or (last is not None and snap.seq == last.seq):
+                event = STREAM_KEEPALIVE_EVENT
+            else:
+                event = stream_event(last, snap, query)
+                last = snap
+                due = time.monotonic() + every
+    finally:
+        gone.cancel()
+        stream_slots.release()
+
+async def asgi_next_snapshot(source, seq, pause):
+    if pause > 0:
+        await asyncio.sleep(pause)
+    return await source.wait_newer(seq, STREAM_KEEPALIVE)
+
+async def asgi_disconnected(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def asgi_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            asgi_start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point exposing /, /assets/*, /api/map, /api/stream, /api/history,
+    /api/replay, /api/stats and /metrics."""
+    if scope["type"] == "lifespan":
+        await asgi_lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    started = time.perf_counter()
+    path = scope["path"]
+    endpoint = route_label(path)
+    # Answered like Flask answers them: 404 for any method on an unknown path,
+    # then the automatic OPTIONS, then 405 for other methods.
+    if endpoint == "other":
+        resp = Response("not found", 404)
+    elif scope["method"] == "OPTIONS":
+        resp = Response("", 200, {"Allow": ROUTE_METHODS})
+    elif scope["method"] not in ("GET", "HEAD"):
+        resp = Response("method not allowed", 405, {"Allow": ROUTE_METHODS})
+    else:
+        resp = None
+    if resp is not None:
+        await asgi_send(send, resp, head=scope["method"] == "HEAD")
+        if endpoint == "/api/stream":
+            observe_response(endpoint, resp.status_code)
+        else:
+            observe_response(endpoint, resp.status_code, time.perf_counter() - started, resp.content_length or 0)
+        return
+    source = asgi_start()
+    req = asgi_request(scope)
+    if path == "/api/stream":
+        await asgi_stream(req, receive, send, source)
+        return
+    elif path == "/api/map":
+        resp = map_response(req, source, await source.current())
+    elif path == "/api/history":
+        resp = history_response(req, track_history)
+    elif path == "/api/replay":
+        resp = replay_response(req, track_history)
+    elif path == "/api/stats":
+        resp = stats_response(source, AsgiState.client)
+    elif path == "/metrics":
+        resp = metrics_response()
+    elif path == "/":
+        resp = index_response(req)
+    elif path.startswith("/assets/"):
+        resp = asset_response(req, path[len("/assets/"):])
+    else:
+        resp = Response("not found", 404)
+    elapsed = time.perf_counter() - started
+    await asgi_send(send, resp, head=scope["method"] == "HEAD")
+    observe_response(endpoint, resp.status_code, elapsed, resp.content_length or 0)
 
 # ---------------- HTML/JS UI ----------------
 HTML_PAGE = r"""<!doctype html>
@@ -99,16 +4271,11 @@ HTML_PAGE = r"""<!doctype html>
     background:rgba(0,0,0,0.65); color:#fff; padding:8px 10px; border-radius:8px;
     font-family: system-ui, -apple-system, 'Segoe UI', Roboto, Helvetica, Arial; font-size:13px;
   }
-  .label {
-    background: transparent;
-    padding: 3px 7px;
-    border-radius: 4px;
-    font-weight: 700;
-    font-size: 12px;
-    color: var(--label-text);
-    width: fit-content;
-    pointer-events: none;
-    box-shadow: 0 4px 12px rgba(0, 0, 0, 0.15);
+  .cluster {
+    display:flex; align-items:center; justify-content:center;
+    width:100%; height:100%; border-radius:50%;
+    background:rgba(10,132,255,0.75); border:2px solid #003a6b;
+    color:#fff; font:700 12px system-ui, -apple-system, 'Segoe UI', Roboto, Helvetica, Arial;
   }
   
   body {
@@ -319,7 +4486,8 @@ HTML_PAGE = r"""<!doctype html>
     margin: 10px 0;
   }
 
-  #tagInput {
+  #tagInput,
+  #queryInput {
     flex: 1;
     padding: 6px;
     border-radius: 6px;
@@ -370,6 +4538,11 @@ HTML_PAGE = r"""<!doctype html>
   }
 
 
+  .query-error {
+    color: #e5484d;
+    font-size: 12px;
+  }
+
   .tag-list {
     margin-top: 8px;
     display: flex;
@@ -464,6 +4637,12 @@ HTML_PAGE = r"""<!doctype html>
 
   <div id="tagList" class="tag-list"></div>
 
+  <div class="tag-input-row">
+    <input id="queryInput" type="text" placeholder="Query: alt>20000 type:F-16 near:51.5,-0.1,200nm">
+    <button id="applyQueryBtn" class="add-btn">Apply</button>
+  </div>
+  <div id="queryError" class="query-error"></div>
+
   <button id="resetBtn" class="add-btn" style="margin-top:10px; width:100%;"> Reset </button>
 
 </div>
@@ -473,20 +4652,21 @@ HTML_PAGE = r"""<!doctype html>
 
 
 <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js" crossorigin=""></script>
-<script>
-(async function(){
-  const REFRESH_MS = 2000;
-  const ANIMATE_MS = REFRESH_MS;
-  const STALE_MS = 15000;
+<script src="__APP_JS_URL__"></script>
+</body>
+</html>
+"""
+
+APP_JS = r"""(async function(){
   const LABEL_ZOOM_MIN = 0;
 
-  const DEFAULT_TAGS = [
-    "[U]","[UTP]","[P]","[PMC]","[NKG-KG]","[SHL]","[NFS]","[AEF]", "lasallian", "butter", "ek-069", "tarun", "massiv4515", "walch", "ljf", "ek-1", "notipa", "est201", "raptor4001", "speedbird",
-    "[WANK]", "[NIUF]", "[TBD]", "[Luftwaffe]", "[BPYR]", "[Luftwafe]", "[MAC]", "[PRC]", "xavier", "tassin",
-    "[TASC]", "[UAC]", "[USSR]", "[JASDF]", "[EVKS]", "[VKS]", "[ACP]", "[PYR]", "[FFL]", "[IOA]", "AF]"
-  ];
+  // DEFAULT_TAGS on the server.
+  const DEFAULT_TAGS = __DEFAULT_TAGS__;
 
   const TAGS_KEY = "geofs_radar_tags";
+  // Filter expression sent as ?q= (see "Query language" on the server).
+  const QUERY_KEY = "geofs_radar_query";
+  let activeQuery = localStorage.getItem(QUERY_KEY) || "";
 
   let activeTags;
   try {
@@ -495,166 +4675,17 @@ HTML_PAGE = r"""<!doctype html>
     activeTags = [...DEFAULT_TAGS];
   }
 
-  const AIRCRAFT_DB = {
-    1: "Piper Cub",
-    2: "Cessna 172",
-    3: "Alphajet PAF",
-    4: "Boeing 737-700",
-    5: "Embraer Phenom 100",
-    6: "de Havilland DHC6 Twin Otter",
-    7: "F-16 Fighting Falcon",
-    8: "Pitts Special S1",
-    9: "Eurocopter EC135",
-    10: "Airbus A380",
-    11: "Alisport Silent 2 Electro",
-    12: "Pilatus PC-7 Mk-I",
-    13: "de Havilland Canada DHC-2 Beaver",
-    14: "Colomban MC-15 Cri-cri",
-    15: "Lockheed P-38 Lightning F-5B",
-    16: "Douglas DC-3",
-    18: "Sukhoi Su-35",
-    20: "Concorde",
-    21: "Zlin Z-50",
-    22: "Cessna 152",
-    23: "Piper PA-28 161 Warrior II Aerobility",
-    24: "Airbus A350",
-    25: "Boeing 777-300ER",
-    26: "Antonov An-140",
-    27: "Boeing F/A-18F Super Hornet",
-    28: "Beechcraft Baron B55",
-    29: "Dassault Rafale",
-    31: "Potez 25",
-    32: "Northrop T-38 Talon",
-    40: "Evektor Sportstar",
-    41: "szd-48-3 Jantar",
-    50: "Paraglider",
-    51: "Major Tom (hot air balloon)",
-    52: "Hughes 269a/TH-55 Osage",
-    53: "Goat Airchair",
-    102: "Citroen 2CV",
-    103: "Wingsuit",
-    235: "Boeing 787-8 (by GX Development)",
-    236: "Embraer E190 (by GX Development)",
-    237: "Boeing 767-300ER (by GX Development)",
-    238: "Boeing 757-200 (by GX Development)",
-    239: "Airbus A350-900 (by GX Development)",
-    240: "Boeing 777-300ER (by LRX)",
-    242: "Airbus A321neo (by LRX)",
-    244: "Airbus A330-300 (by LRX)",
-    247: "Bombardier Dash 8 Q400 (by LRX)",
-    252: "Boeing 747-8 Freighter (by LRX)",
-    1069: "Cirrus SR22 GTS Turbo (by LRX)",
-    2000: "Retro 172",
-    2003: "Boeing 737-800 (by King Solomon)",
-    2004: "CRJ-900 (by King Solomon)",
-    2153: "Airbus A340-600 (by LRX)",
-    2310: "A-10C Thunderbolt II (by Eco[LAC])",
-    2364: "Lockheed SR-71A Blackbird (by BritishPilot[GeoAD])",
-    2386: "Boeing 787-9 Dreamliner (by LRX)",
-    2395: "BAe 146-300/Avro RJ100 (by Eco[LAC])",
-    2418: "ATR 72-600 (HOP!) (by JAaMDG)",
-    2420: "ATR 72-600 (Silver) (by JAaMDG)",
-    2426: "ATR 72-600 (UTair) (by JAaMDG)",
-    2461: "Cirrus Vision Jet/SF50 G2 (by Eco[LAC])",
-    2556: "Northrop Grumman B-2 Spirit (by NS-Studios)",
-    2581: "F-14B Tomcat (by Eco[LAC])",
-    2700: "Embraer ERJ-195AR (Breeze) (by Featherway[UAE232])",
-    2706: "Bombardier CRJ 200 (by Aero281)",
-    2726: 'Scaled 339 "SpaceShipTwo" (by JAaMDG)',
-    2750: "Caproni Stipa (by Echo_3)",
-    2752: 'Scaled 348 "WhiteKnightTwo" (by JAaMDG)',
-    2769: "Boeing 737 Max 8 (TUI) (by Spice_9)",
-    2772: "Boeing 737 Max 8 (SpiceJet) (by Spice_9)",
-    2786: "Grumman JF2-5 Duck (by Echo_3)",
-    2788: "Antonov An-225 Mriya (by NS-Studios)",
-    2806: "Sikorsky S-97 Raider (by JAaMDG)",
-    2808: "Supermarine Spitfire Mk XIV (by Eco[LAC])",
-    2840: "Bell UH-1H Iroquois (by ElonMusk(VrA)(LAC))",
-    2843: "Airbus A220-300 (Air Tanzania) (by GT-VRA)",
-    2844: "Falcon 9 (by Echo_3)",
-    2852: "Cameron R-650 Rozière Balloon (by JAaMDG)",
-    2856: "Airbus a330-200 (by Aero281)",
-    2857: "F-22 Raptor (by SpaceRage)",
-    2864: "AgustaWestland AW609 (by JAaMDG)",
-    2865: "Airbus a320neo(Air India) (by Spice_9)",
-    2870: "Airbus a320neo (Flynas) (by Spice_9)",
-    2871: "Airbus a320neo (Iberia) (by Spice_9)",
-    2878: "Airbus A319 (Air China) (by GT-VRA)",
-    2879: "Airbus A319 (Finnair) (by GT-VRA)",
-    2892: "SAAB 340 (by Spice_9)",
-    2899: "Airbus A220-300 (Swiss) (by GT-VRA)",
-    2943: "Embraer EMB120 Brasillia (by GT-VRA)",
-    2948: "(JAaMDG) North American XB-70 Valkyrie (by Johani_(NeoAD))",
-    2951: "Airbus a340-300 (by Aero281)",
-    2953: "Space Shuttle Atlantis (OV-104) (by JAaMDG)",
-    2968: "Windward Performance Perlan II (by JAaMDG)",
-    2973: "Airbus A350-1000 XWB (by NS-Studios)",
-    2976: "Pilatus PC12 (by GT-VRA)",
-    2988: "(TBSG, GeoAD) North American X-15 (by Johani_(NeoAD))",
-    2989: "MQ9B Reaper (by Aero281)",
-    3011: "Airbus a320-232 (by Spice_9)",
-    3036: "Embraer E195-E2 (by GT-VRA)",
-    3049: "Lockheed Martin P-791 (LMH-1) (by JAaMDG)",
-    3054: "Boeing 737-800 [Spice9] (by Spice_9)",
-    3109: "Pilatus PC24 (by GT-VRA)",
-    3140: "Airbus A319 (United) (by GT-VRA)",
-    3179: "Boeing 787-10 Dreamliner (British Airways) (by Spice_9)",
-    3180: "Boeing 787-10 Dreamliner (Etihad) (by Spice_9)",
-    3211: "UTVA75 (by GT-VRA)",
-    3289: "Dornier 228-200 (by Spice_9)",
-    3292: "Boeing p8I Neptune (by Spice_9)",
-    3307: "Bombardier CRJ-700 (by AriakimTaiyo)",
-    3341: "Embraer ERJ-170 (by AriakimTaiyo)",
-    3436: "Dornier do228-100 (Coast Gaurd) (by Spice_9)",
-    3460: "Grumman E-2C Hawkeye (by ElonMusk(VrA)(LAC))",
-    3534: "airbus a320-214(Easyjet) (by Spice_9)",
-    3575: "Boeing 787-9(Spice9) (by Spice_9)",
-    3591: "F-15C Eagle (by AriakimTaiyo)",
-    3617: "Dassault Mirage 2000-5 (by ElonMusk(VrA)(LAC))",
-    4017: "Embraer ERJ145LR (by Spice 9) & (by GT-VRA)",
-    4090: "Robinson R-44 (by (CCDev)DevHunter77)",
-    4140: "Boeing 737-200 (by AriakimTaiyo)",
-    4197: "Robinson R22 (by (CCDev)DevHunter77)",
-    4251: "Chance Vought F4U-1D Corsair (by JAaMDG)",
-    4341: "Spirit of St louis (by Echo_3)",
-    4390: "Piper PA-28 Floatplane (by coolpilot11)",
-    4398: "Britten-Norman BN-2 Islander (Loganair) (by coolpilot11)",
-    4401: "Britten-Norman BN-2 Islander (St. Barth Commuter) (by coolpilot11)",
-    4402: "Boeing 777 Freighter (by LRX)",
-    4409: "Zenith Stol CH701 (by coolpilot11)",
-    4596: "Vans RV6 (by coolpilot11)",
-    4631: "Airbus A330-900neo (Virgin Atlantic) (by GT-VRA)",
-    4646: "Airbus a321neo (spice9) (by Spice_9)",
-    4743: "Boeing 757-300 (by GT-VRA)",
-    4745: "Boeing 757-300wl (by GT-VRA)",
-    4764: "Boeing 767-400 (by GT-VRA)",
-    4949: "Goodyear Blimp (by BritishPilot[GeoAD])",
-    5002: "Beta Alia Prototype (N250UT) (by coolpilot11)",
-    5038: "Lockheed L-1011-1 (by AriakimTaiyo)",
-    5061: "Sonex-B Kit (Jabiru 3300) (by TurboMaximus)",
-    5073: "Bombardier Learjet 45 XR (by Spice_9)",
-    5086: "Airbus a321-211 (by Spice_9)",
-    5156: "Airbus a318-112 by Luca & (by Spice_9)",
-    5193: "Boeing 747-8i (by JAaMDG)",
-    5203: "Boeing 737-600 by Luca & (by Spice_9)",
-    5229: "F-35B Lightning II (by JAaMDG)",
-    5314: "Boeing 747-100 SCA by JAaMDG & (by Jeffa)",
-    5316: "Boeing 717-200 (by Plane2222222)",
-    5347: "Dassault Mirage F1 (by MirageModels)",
-    5405: "Chengdu J-20 (by MirageModels)",
-    5409: "Boeing 747-400D by JAaMDG & (by BOA93(EAA))",
-    5431: "Northrop YF-23 (by MirageModels)",
-    5486: "Aviat A-1B Husky (by coolpilot11)",
-    5499: "CubCrafters CC19 XCub (by AriakimTaiyo)",
-    5516: "Boeing 747-400 LCF by Luca & (by JAaMDG)"
-  };
+  // AIRCRAFT_DB on the server.
+  const AIRCRAFT_DB = __AIRCRAFT_DB__;
 
   function getAircraftName(ac) {
     if (ac == null) return "Unknown Aircraft";
     return AIRCRAFT_DB[ac] || `Unknown Aircraft (ID ${ac})`;
   }
 
-  const AC = {};
+  // __STORE_JS__
+
+  const store = new AircraftStore();
   let LOCKED_ID = null;
 
   const map = L.map('map', { 
@@ -682,225 +4713,451 @@ HTML_PAGE = r"""<!doctype html>
   );
 
 lightTiles.addTo(map);
-  map.on('click', function () {
-    if (LOCKED_ID) {
-        const it = AC[LOCKED_ID];
-        if (it && it.marker) it.marker.closePopup();
-        LOCKED_ID = null;
-    }
-  });
 
   function nowMs(){ return Date.now(); }
 
   document.getElementById("resetBtn").onclick = () => {
     activeTags = [...DEFAULT_TAGS];
+    activeQuery = "";
     renderTags();
     applyFilterNow();
     localStorage.removeItem(TAGS_KEY);
+    localStorage.removeItem(QUERY_KEY);
     location.reload(); 
   };
 
-  function svgArrow(deg){
-    return `<div style="transform: rotate(${deg}deg); display:block;">
-      <svg width="22" height="22" viewBox="0 0 24 24" xmlns="http://www.w3.org/2000/svg" style="display:block;">
-        <path d="M12 2 L16 14 L12 11 L8 14 Z" fill="#0a84ff" stroke="#003a6b" stroke-width="0.6"/>
-        <rect x="11" y="11" width="2" height="8" fill="#0a84ff" stroke="#003a6b" stroke-width="0.4"/>
-      </svg>
-    </div>`;
+  // All aircraft are drawn by one canvas layer in a single pass per animation
+  // frame: arrows are one pre-rendered sprite rotated by the canvas transform,
+  // labels are sprites cached per callsign. Hover and click are resolved
+  // against a screen-space grid of the last drawn positions.
+  const ARROW_PX = 22;
+  const LABEL_H = 18;
+  const HIT_RADIUS_PX = 12;
+  const HIT_CELL_PX = 32;
+  const MAX_MERC_LAT = 85.0511287798;
+
+  function arrowSprite(dpr){
+    const c = document.createElement('canvas');
+    c.width = c.height = Math.ceil(ARROW_PX * dpr);
+    const g = c.getContext('2d');
+    g.scale(c.width / 24, c.height / 24);
+    g.fillStyle = '#0a84ff';
+    g.strokeStyle = '#003a6b';
+    const head = new Path2D('M12 2 L16 14 L12 11 L8 14 Z');
+    g.lineWidth = 0.6;
+    g.fill(head);
+    g.stroke(head);
+    g.lineWidth = 0.4;
+    g.fillRect(11, 11, 2, 8);
+    g.strokeRect(11, 11, 2, 8);
+    return c;
   }
 
-  function makeIcon(bearing){
-    return L.divIcon({ className:'', html: svgArrow(bearing), iconSize:[22,22], iconAnchor:[11,11] });
+  const AircraftLayer = L.Layer.extend({
+    onAdd(map){
+      this._canvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide', this.getPane());
+      this._canvas.style.pointerEvents = 'none';
+      this._ctx = this._canvas.getContext('2d');
+      this._slots = new Int32Array(1024);
+      this._count = 0;
+      this._xy = new Float32Array(2048);
+      this._grid = null;
+      this.restyle();
+    },
+
+    onRemove(){
+      L.DomUtil.remove(this._canvas);
+    },
+
+    // Sprites depend on the theme and the screen's pixel ratio.
+    restyle(){
+      const style = getComputedStyle(document.body);
+      this._dpr = window.devicePixelRatio || 1;
+      this._arrow = arrowSprite(this._dpr);
+      this._labels = new Map();
+      this._labelColor = style.getPropertyValue('--label-text').trim() || '#000';
+      this._labelFont = `700 12px ${getComputedStyle(this._map.getContainer()).fontFamily}`;
+    },
+
+    _label(text){
+      let sprite = this._labels.get(text);
+      if (sprite) return sprite;
+      if (this._labels.size > 4 * store.size + 256) this._labels.clear();
+      const dpr = this._dpr;
+      const g = document.createElement('canvas').getContext('2d');
+      g.font = this._labelFont;
+      const w = Math.ceil(g.measureText(text).width) + 14;
+      g.canvas.width = Math.ceil(w * dpr);
+      g.canvas.height = Math.ceil(LABEL_H * dpr);
+      g.scale(dpr, dpr);
+      g.font = this._labelFont;
+      g.fillStyle = this._labelColor;
+      g.textBaseline = 'middle';
+      g.fillText(text, 7, LABEL_H / 2);
+      sprite = { canvas: g.canvas, w };
+      this._labels.set(text, sprite);
+      return sprite;
+    },
+
+    // Draw every aircraft in the store at its current interpolated position.
+    draw(){
+      const map = this._map, canvas = this._canvas, ctx = this._ctx, dpr = this._dpr;
+      if (!map) return;
+      const size = map.getSize();
+      if (canvas.width !== Math.round(size.x * dpr) || canvas.height !== Math.round(size.y * dpr)){
+        canvas.width = Math.round(size.x * dpr);
+        canvas.height = Math.round(size.y * dpr);
+        canvas.style.width = size.x + 'px';
+        canvas.style.height = size.y + 'px';
+      }
+      const topLeft = map.containerPointToLayerPoint([0, 0]);
+      L.DomUtil.setPosition(canvas, topLeft);
+      ctx.setTransform(1, 0, 0, 1, 0, 0);
+      ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+      // Spherical Mercator by hand, relative to the container's top-left
+      // world pixel, so projecting an aircraft allocates nothing.
+      const zoom = map.getZoom();
+      const scale = 256 * Math.pow(2, zoom);
+      const origin = topLeft.add(map.getPixelOrigin());
+      const labels = zoom >= LABEL_ZOOM_MIN;
+      const half = ARROW_PX / 2, margin = ARROW_PX + 200;
+      if (this._slots.length < store.capacity){
+        this._slots = new Int32Array(store.capacity);
+        this._xy = new Float32Array(2 * store.capacity);
+      }
+      let n = 0;
+      for (let i = 0; i < store.high; i++){
+        if (!store.live[i]) continue;
+        const lat = Math.max(-MAX_MERC_LAT, Math.min(MAX_MERC_LAT, store.lat[i]));
+        const sin = Math.sin(lat * Math.PI / 180);
+        const x = scale * (store.lon[i] + 180) / 360 - origin.x;
+        const y = scale * (0.5 - Math.log((1 + sin) / (1 - sin)) / (4 * Math.PI)) - origin.y;
+        if (x < -margin || y < -margin || x > size.x + margin || y > size.y + margin) continue;
+        this._xy[2 * n] = x;
+        this._xy[2 * n + 1] = y;
+        this._slots[n++] = i;
+
+        const rad = (store.drawHdg[i] || 0) * Math.PI / 180;
+        const c = Math.cos(rad) * dpr, s = Math.sin(rad) * dpr;
+        ctx.setTransform(c, s, -s, c, x * dpr, y * dpr);
+        ctx.drawImage(this._arrow, -half, -half, ARROW_PX, ARROW_PX);
+        if (labels){
+          const label = this._label(store.callsign[i]);
+          ctx.setTransform(dpr, 0, 0, dpr, 0, 0);
+          ctx.drawImage(label.canvas, x + 2, y + 7, label.w, LABEL_H);
+        }
+      }
+      this._count = n;
+      this._grid = null;
+    },
+
+    // Id of the drawn aircraft nearest to a container point, if one is close enough.
+    hit(point){
+      if (!this._grid) this._buildGrid();
+      const cx = Math.floor(point.x / HIT_CELL_PX), cy = Math.floor(point.y / HIT_CELL_PX);
+      let best = null, bestD = HIT_RADIUS_PX * HIT_RADIUS_PX;
+      for (let gx = cx - 1; gx <= cx + 1; gx++){
+        for (let gy = cy - 1; gy <= cy + 1; gy++){
+          const cell = this._grid.get(gx * 65536 + gy);
+          if (!cell) continue;
+          for (const i of cell){
+            const dx = this._xy[2 * i] - point.x, dy = this._xy[2 * i + 1] - point.y;
+            const d = dx * dx + dy * dy;
+            if (d <= bestD){
+              bestD = d;
+              best = store.ids[this._slots[i]];
+            }
+          }
+        }
+      }
+      return best;
+    },
+
+    _buildGrid(){
+      const grid = new Map();
+      for (let i = 0; i < this._count; i++){
+        const key = Math.floor(this._xy[2 * i] / HIT_CELL_PX) * 65536 + Math.floor(this._xy[2 * i + 1] / HIT_CELL_PX);
+        const cell = grid.get(key);
+        if (cell) cell.push(i); else grid.set(key, [i]);
+      }
+      this._grid = grid;
+    },
+  });
+
+  const aircraftLayer = new AircraftLayer().addTo(map);
+
+  // One popup, shown for the hovered aircraft or pinned to a clicked one.
+  const popup = L.popup({ closeButton: true, autoClose: false, closeOnClick: false, offset: [0, -6] });
+  let POPUP_ID = null;
+
+  function openPopupFor(id){
+    const i = store.slot(id);
+    if (i < 0) return;
+    POPUP_ID = id;
+    popup.setLatLng([store.lat[i], store.lon[i]]).setContent(popupHTML(i));
+    if (!map.hasLayer(popup)) popup.openOn(map);
   }
-  function makeLabel(text){
-    return L.divIcon({ className:'', html:`<div class="label">${text}</div>`, iconSize:[10,10], iconAnchor:[-2,-7] });
+
+  function closePopup(){
+    POPUP_ID = null;
+    LOCKED_ID = null;
+    if (map.hasLayer(popup)) map.closePopup(popup);
   }
 
-  function bearingFromTo(lat1, lon1, lat2, lon2){
-    const φ1 = lat1 * Math.PI/180, φ2 = lat2 * Math.PI/180;
-    const Δλ = (lon2 - lon1) * Math.PI/180;
-    const y = Math.sin(Δλ) * Math.cos(φ2);
-    const x = Math.cos(φ1)*Math.sin(φ2) - Math.sin(φ1)*Math.cos(φ2)*Math.cos(Δλ);
-    const θ = Math.atan2(y, x);
-    return (θ * 180/Math.PI + 360) % 360;
+  map.on('popupclose', (e) => {
+    if (e.popup === popup){
+      POPUP_ID = null;
+      LOCKED_ID = null;
+    }
+  });
+
+  map.on('mousemove', (e) => {
+    const id = aircraftLayer.hit(e.containerPoint);
+    map.getContainer().style.cursor = id ? 'pointer' : '';
+    if (LOCKED_ID) return;
+    if (id){
+      if (id !== POPUP_ID) openPopupFor(id);
+    } else if (POPUP_ID){
+      closePopup();
+    }
+  });
+
+  map.on('click', (e) => {
+    const id = aircraftLayer.hit(e.containerPoint);
+    if (id && id !== LOCKED_ID){
+      openPopupFor(id);
+      LOCKED_ID = id;
+    } else {
+      closePopup();
+    }
+  });
+
+  // Dead reckoning: between fixes each aircraft flies on from its last fix
+  // at the reported speed, heading and observed turn rate. When a new fix
+  // arrives, the gap between where the aircraft was drawn and where the fix
+  // puts it is blended out over CORRECT_MS instead of jumping.
+  const KT_TO_DEG_PER_MS = 1852 / 3600 / 111320 / 1000;
+  const DR_MAX_MS = 30000;
+  const CORRECT_MS = 1500;
+
+  function wrapLon(lon){
+    return lon < -180 || lon >= 180 ? ((lon + 540) % 360 + 360) % 360 - 180 : lon;
+  }
+
+  // Where slot i is at time t: sets lat, lon and drawHdg.
+  function reckon(S, i, t){
+    const dt = Math.min(Math.max(t - S.t0[i], 0), DR_MAX_MS);
+    let lat = S.nextLat[i], lon = S.nextLon[i], hdg = S.bearing[i];
+    const v = S.speed[i];
+    if (v > 0 && dt > 0 && isFinite(hdg)){
+      const turn = S.turn[i] || 0;
+      const mid = (hdg + turn * dt / 2000) * Math.PI / 180;
+      const d = v * dt * KT_TO_DEG_PER_MS;
+      lat = Math.max(-89.9, Math.min(89.9, lat + d * Math.cos(mid)));
+      lon = wrapLon(lon + d * Math.sin(mid) / Math.cos(lat * Math.PI / 180));
+      hdg = (hdg + turn * dt / 1000 + 360) % 360;
+    }
+    const k = Math.max(0, 1 - (t - S.t0[i]) / CORRECT_MS);
+    const blend = k * k * (3 - 2 * k);
+    S.lat[i] = lat + S.errLat[i] * blend;
+    S.lon[i] = wrapLon(lon + S.errLon[i] * blend);
+    S.drawHdg[i] = hdg;
   }
 
   let animating = false;
+  let drawMs = 0;
   function startAnimationLoop(){
     if (animating) return;
     animating = true;
     function frame(){
       const t = nowMs();
-      for (const id in AC){
-        const item = AC[id];
-        if (t - item.lastSeen > STALE_MS){
-          if (item.marker) map.removeLayer(item.marker);
-          if (item.label) map.removeLayer(item.label);
-          delete AC[id];
-          continue;
-        }
-        if (item.prevPos && item.nextPos && item.t0 != null && item.t1 != null){
-          const p = Math.min(1, Math.max(0, (t - item.t0) / (item.t1 - item.t0)));
-          const lat = item.prevPos.lat + (item.nextPos.lat - item.prevPos.lat) * p;
-          const lon = item.prevPos.lon + (item.nextPos.lon - item.prevPos.lon) * p;
-          if (item.marker) item.marker.setLatLng([lat, lon]);
-          if (item.label) item.label.setLatLng([lat, lon]);
-        }
+      const started = performance.now();
+      const S = store;
+      for (let i = 0; i < S.high; i++){
+        if (S.live[i]) reckon(S, i, t);
       }
+      const open = POPUP_ID ? S.slot(POPUP_ID) : -1;
+      if (open >= 0) popup.setLatLng([S.lat[open], S.lon[open]]);
+      aircraftLayer.draw();
+      // Smoothed time spent per frame on dead reckoning and drawing, in the HUD.
+      drawMs += (performance.now() - started - drawMs) * 0.05;
       requestAnimationFrame(frame);
     }
     requestAnimationFrame(frame);
   }
 
-  function popupHTML(it){
+  function popupHTML(i){
+    const S = store;
     return `
       <div style="font-size:13px; line-height:1.45; min-width:200px">
-        <div><b>Callsign:</b> ${it.callsign}</div>
-        <div><b>User ID:</b> ${it.uid ?? '—'}</div>
-        <div><b>ACID:</b> ${it.acid ?? '—'}</div>
-        <div><b>Aircraft Type:</b> ${it.aircraft ?? '—'}</div>
-        <div><b>Altitude:</b> ${it.alt != null ? Math.round(it.alt) + ' ft' : '—'}</div>
-        <div><b>Speed:</b> ${it.speed != null ? Math.round(it.speed) + ' kt' : '—'}</div>
-        <div><b>Heading:</b> ${it.lastBearing != null ? Math.round(it.lastBearing) + '°' : '—'}</div>
+        <div><b>Callsign:</b> ${S.callsign[i]}</div>
+        <div><b>User ID:</b> ${S.uid[i] ?? '—'}</div>
+        <div><b>ACID:</b> ${S.acid[i] ?? '—'}</div>
+        <div><b>Tags:</b> ${S.tags[i] || '—'}</div>
+        <div><b>Aircraft Type:</b> ${getAircraftName(S.ac[i])}</div>
+        <div><b>Altitude:</b> ${isFinite(S.alt[i]) ? Math.round(S.alt[i]) + ' ft' : '—'}</div>
+        <div><b>Speed:</b> ${isFinite(S.speed[i]) ? Math.round(S.speed[i]) + ' kt' : '—'}</div>
+        <div><b>Heading:</b> ${isFinite(S.bearing[i]) ? Math.round(S.bearing[i]) + '°' : '—'}</div>
       </div>
     `;
   }
 
-  function normalizeHeading(hdg){
-    if (typeof hdg !== 'number' || !isFinite(hdg)) return null;
-    return (hdg + 360) % 360;
+  // Tag matching, exclusions and the viewport cut happen on the server; only
+  // the fields the page uses are requested. "tags" is the list of our tags
+  // each callsign matched, so nothing here scans callsigns again.
+  const MAP_FIELDS = "id,acid,cs,co,ac,st.as,tags";
+  function mapQuery(){
+    const tags = encodeURIComponent(activeTags.join(','));
+    if (!viewBox) viewBox = viewBBox();
+    const q = activeQuery ? `&q=${encodeURIComponent(activeQuery)}` : '';
+    return `tags=${tags}&fields=${MAP_FIELDS}&bbox=${viewBox.join(',')}&zoom=${viewZoom}${q}`;
   }
 
-  async function refreshLoop(){
-    try {
-        const r = await fetch('/api/map', {cache:'no-store'});
-        if (!r.ok) throw new Error('upstream status ' + r.status);
-        const data = await r.json();
-        const users = Array.isArray(data.users) ? data.users : [];
-        const reported = (typeof data.userCount === 'number') ? data.userCount : users.length;
-        const t_fetch = nowMs();
-        for (const u of users){
-            if (!u || !Array.isArray(u.co) || u.co.length < 4) continue;
-
-            const lat = u.co[0], lon = u.co[1], alt_in_meters = u.co[2], hdgServer = u.co[3];
-            const alt = alt_in_meters * 3.28084;
-
-            if (typeof lat !== 'number' || typeof lon !== 'number') continue;
-            if (!isFinite(lat) || !isFinite(lon)) continue;
-            if (Math.abs(lat) > 90 || Math.abs(lon) > 180) continue;
-
-            const csRaw = (typeof u.cs === 'string') ? u.cs.trim() : '';
-            if (!csRaw) continue;
-
-            if (csRaw.toLowerCase() === 'randomassguy[u]') continue;
-            if (csRaw === 'EventHorizon[USAF]') continue;
-
-            const callsign = csRaw;
-
-            const show = activeTags.length === 0 || activeTags.some(k => callsign.toUpperCase().includes(k.toUpperCase()));
-            if (!show) continue;
-
-            const id = String(u.id || u.acid || Math.random());
-            const prevItem = AC[id];
-
-            if (!prevItem){
-                const m = L.marker([lat, lon], { icon: makeIcon(hdgServer || 0), riseOnHover: true }).addTo(map);
-
-                m.bindPopup('Loading...', { closeButton: true, autoClose: false, closeOnClick: false,});
-
-                m.on('mouseover', function () {
-                    if (LOCKED_ID && LOCKED_ID !== id) return;
-                    this.openPopup();
-                });
-
-                m.on('mouseout', function () {
-                    if (LOCKED_ID) return;
-                    this.closePopup();
-                });
-
-                m.on('click', function (e) {
-                    e.originalEvent.stopPropagation();
-                   if (LOCKED_ID === id) {
-                        LOCKED_ID = null;
-                        this.closePopup();
-                        return;
-                    }
-                    LOCKED_ID = id;
-                    this.openPopup();
-                });
-                const lab = L.marker([lat, lon], { icon: makeLabel(callsign), interactive:false });
-                if (map.getZoom() >= LABEL_ZOOM_MIN) lab.addTo(map);
-                AC[id] = {
-                    marker: m,
-                    label: lab,
-                    prevPos: {lat, lon},
-                    nextPos: {lat, lon},
-                    t0: t_fetch,
-                    t1: t_fetch + ANIMATE_MS,
-                    lastSeen: t_fetch,
-                    lastBearing: hdgServer || 0,
-                    callsign,
-                    uid: u.id ?? null,
-                    acid: u.acid ?? null,
-                    alt,
-                    speed: u.st?.as ?? null,
-                    aircraft: getAircraftName(u.ac),
-                };
-                m.setPopupContent(popupHTML(AC[id]));
-            } else {
-                prevItem.prevPos = prevItem.nextPos || { lat: prevItem.prevPos.lat, lon: prevItem.prevPos.lon };
-                prevItem.nextPos = { lat, lon };
-                prevItem.t0 = t_fetch; prevItem.t1 = t_fetch + ANIMATE_MS;
-                
-                let cog = hdgServer != null ? hdgServer : prevItem.lastBearing || 0;
-                const moved = Math.abs(lat - prevItem.prevPos.lat) + Math.abs(lon - prevItem.prevPos.lon);
-                if (moved > 1e-5 && hdgServer == null) {
-                    cog = bearingFromTo(prevItem.prevPos.lat, prevItem.prevPos.lon, lat, lon);
-                }
-                prevItem.lastBearing = normalizeHeading(cog);
-                if (prevItem.marker) prevItem.marker.setIcon(makeIcon(prevItem.lastBearing));
-                if (prevItem.label) prevItem.label.setIcon(makeLabel(callsign));
-
-
-                prevItem.alt = alt;
-                prevItem.speed = u.st?.as ?? prevItem.speed;
-                prevItem.aircraft = getAircraftName(u.ac);
-                prevItem.uid = u.id ?? prevItem.uid;
-                prevItem.acid = u.acid ?? prevItem.acid;
-                if (prevItem.marker){
-                    prevItem.marker.setPopupContent(popupHTML(prevItem));
-                }
-                prevItem.lastSeen = t_fetch;
-                prevItem.callsign = callsign;
-            }
-        }
-        document.getElementById('stats').textContent = `Showing ${Object.keys(AC).length} markers • Reported total: ${reported}`;
-        document.getElementById('last').textContent = `Last fetch: ${new Date().toLocaleTimeString()}`;
-    } catch(err){
-        console.error("Fetch error:", err);
-        document.getElementById('stats').textContent = 'Fetch error';
-    } finally {
-        setTimeout(refreshLoop, REFRESH_MS);
+  // Fetching, decoding, delta merging and stale eviction run in a Worker
+  // (WORKER_JS). It owns the authoritative store and posts each update as
+  // typed arrays indexed by the same slots as `store`; this thread only
+  // interpolates and draws.
+  const worker = new Worker("__WORKER_JS_URL__");
+  let reported = 0;
+
+  worker.onmessage = (e) => {
+    const m = e.data;
+    if (m.type === 'sync') applySync(m);
+    else if (m.type === 'status'){
+      document.getElementById('stats').textContent = m.text;
+      if (m.queryError) document.getElementById('queryError').textContent = m.queryError;
     }
+  };
+
+  // Send the current query; the worker drops aircraft the new tags exclude
+  // and starts over from a full list.
+  function sendQuery(){
+    worker.postMessage({ type: 'query', query: mapQuery(), tags: activeTags });
   }
-  function applyFilterNow() {
-    for (const id in AC) {
-        const it = AC[id];
-        const cs = it.callsign || "";
-
-        const show =
-            activeTags.length === 0 ||
-            activeTags.some(k =>
-                cs.toUpperCase().includes(k.toUpperCase())
-            );
-        if (!show) {
-            if (it.marker) map.removeLayer(it.marker);
-            if (it.label) map.removeLayer(it.label);
-            delete AC[id];
-        }
+
+  // Zoom and tab visibility feed the worker's update cadence.
+  function sendView(){
+    worker.postMessage({ type: 'view', zoom: map.getZoom(), hidden: document.visibilityState === 'hidden' });
+  }
+  map.on('zoomend', sendView);
+  document.addEventListener('visibilitychange', sendView);
+
+  function applySync(m){
+    const S = store, t = nowMs();
+    for (const i of m.removed) removeSlot(i);
+    for (const [i, id, callsign, uid, acid, ac, tags, fresh] of m.meta){
+      if (fresh){
+        // Starts exactly at its first fix, whatever the slot held before.
+        S.put(i, id);
+        S.nextLat[i] = m.lat[i];
+        S.nextLon[i] = m.lon[i];
+        S.errLat[i] = S.errLon[i] = 0;
+        S.speed[i] = NaN;
+        S.t0[i] = t;
+      }
+      S.callsign[i] = callsign;
+      S.uid[i] = uid;
+      S.acid[i] = acid;
+      S.ac[i] = ac;
+      S.tags[i] = tags;
+    }
+    // A new fix restarts dead reckoning from it; the offset from where the
+    // aircraft is drawn right now is kept as an error that fades out.
+    for (let i = 0; i < m.count; i++){
+      if (!m.moved[i] || !S.live[i]) continue;
+      reckon(S, i, t);
+      S.errLat[i] = S.lat[i] - m.lat[i];
+      S.errLon[i] = wrapLon(S.lon[i] - m.lon[i]);
+      S.nextLat[i] = m.lat[i];
+      S.nextLon[i] = m.lon[i];
+      S.t0[i] = t;
+      S.bearing[i] = m.bearing[i];
+      S.turn[i] = m.turn[i];
+      S.alt[i] = m.alt[i];
+      S.speed[i] = m.speed[i];
+    }
+    if (m.clusters) renderClusters(m.clusters);
+    const open = POPUP_ID ? S.slot(POPUP_ID) : -1;
+    if (open >= 0 && m.moved[open]) popup.setContent(popupHTML(open));
+    if (m.fetched){
+      reported = m.userCount;
+      document.getElementById('queryError').textContent = '';
+      updateHud();
+    }
+  }
+
+  // At low zoom the server sends per-cell clusters instead of every aircraft;
+  // they are redrawn wholesale on each update.
+  const clusterLayer = L.layerGroup().addTo(map);
+  let clusterTotal = 0;
+
+  function clusterIcon(count){
+    const size = Math.round(26 + 8 * Math.log10(count));
+    return L.divIcon({ className:'', html:`<div class="cluster">${count}</div>`,
+                       iconSize:[size,size], iconAnchor:[size/2,size/2] });
+  }
+
+  function renderClusters(rows){
+    clusterLayer.clearLayers();
+    clusterTotal = 0;
+    for (const [lat, lon, count, ac] of rows){
+      clusterTotal += count;
+      const m = L.marker([lat, lon], { icon: clusterIcon(count) })
+        .bindTooltip(`${count} aircraft • mostly ${getAircraftName(ac)}`);
+      m.on('click', () => map.setView([lat, lon], Math.min(map.getZoom() + 2, map.getMaxZoom())));
+      clusterLayer.addLayer(m);
     }
   }
 
+  // The requested box is padded around the visible map so that small pans
+  // stay inside it and need no new query.
+  const VIEW_PAD = 0.5;
+  const VIEW_DEBOUNCE_MS = 300;
+  let viewBox = null;
+  let viewZoom = null;
+  let viewTimer = null;
+
+  function viewBBox(){
+    const b = map.getBounds().pad(VIEW_PAD);
+    let w = b.getWest(), e = b.getEast();
+    if (e - w >= 360) { w = -180; e = 180; }
+    viewZoom = map.getZoom();
+    return [Math.max(-90, b.getSouth()), w, Math.min(90, b.getNorth()), e].map(v => +v.toFixed(3));
+  }
+
+  function viewInsideBox(){
+    const b = map.getBounds();
+    return viewBox && map.getZoom() === viewZoom &&
+      b.getSouth() >= viewBox[0] && b.getWest() >= viewBox[1] &&
+      b.getNorth() <= viewBox[2] && b.getEast() <= viewBox[3];
+  }
+
+  map.on('moveend', () => {
+    clearTimeout(viewTimer);
+    viewTimer = setTimeout(() => {
+      if (viewInsideBox()) return;
+      viewBox = viewBBox();
+      sendQuery();
+    }, VIEW_DEBOUNCE_MS);
+  });
+
+  function removeSlot(i){
+    if (POPUP_ID === store.ids[i]) closePopup();
+    store.remove(i);
+  }
+
+  function updateHud(){
+    const clustered = clusterTotal ? ` + ${clusterTotal} clustered` : '';
+    document.getElementById('stats').textContent =
+      `Showing ${store.size} markers${clustered} • Reported total: ${reported} • Frame ${drawMs.toFixed(1)} ms`;
+    document.getElementById('last').textContent = `Last fetch: ${new Date().toLocaleTimeString()}`;
+  }
+
+  function applyFilterNow() {
+    sendQuery();
+  }
+
   const panel = document.getElementById("filterPanel");
   const openBtn = document.getElementById("openFilter");
   const closeBtn = document.getElementById("closeFilter");
@@ -940,6 +5197,23 @@ lightTiles.addTo(map);
     applyFilterNow();
   };
 
+  const queryInput = document.getElementById("queryInput");
+  queryInput.value = activeQuery;
+
+  document.getElementById("applyQueryBtn").onclick = () => {
+    activeQuery = queryInput.value.trim();
+    localStorage.setItem(QUERY_KEY, activeQuery);
+    document.getElementById('queryError').textContent = '';
+    applyFilterNow();
+  };
+
+  queryInput.addEventListener("keydown", (e) => {
+    if (e.key === "Enter") {
+      e.preventDefault();
+      document.getElementById("applyQueryBtn").click();
+    }
+  });
+
   const tagInput = document.getElementById("tagInput");
 
   tagInput.addEventListener("keydown", (e) => {
@@ -969,20 +5243,8 @@ lightTiles.addTo(map);
   renderTags();
 
   startAnimationLoop();
-  refreshLoop();
-
-  map.on('zoomend', ()=>{
-    const z = map.getZoom();
-    for (const id in AC){
-      const it = AC[id];
-      if (!it.label) continue;
-      if (z >= LABEL_ZOOM_MIN){
-        if (!map.hasLayer(it.label)) map.addLayer(it.label);
-      } else {
-        if (map.hasLayer(it.label)) map.removeLayer(it.label);
-      }
-    }
-  });
+  sendView();
+  sendQuery();
 
   const toggleBtn = document.getElementById("themeToggle");
 
@@ -1000,6 +5262,7 @@ lightTiles.addTo(map);
         map.removeLayer(darkTiles);
         lightTiles.addTo(map);
     }
+    aircraftLayer.restyle();
   }
 
   const saved = localStorage.getItem("theme");  
@@ -1009,11 +5272,558 @@ lightTiles.addTo(map);
     setTheme(!document.body.classList.contains("dark"));
   });
 })();
-</script>
-</body>
-</html>
 """
 
+# Spliced into APP_JS and WORKER_JS where they say `// __STORE_JS__`.
+STORE_JS = r"""  // Structure-of-arrays aircraft store, shared by the page and the worker.
+  // Per-aircraft numbers live in typed columns indexed by slot, `index` maps
+  // id -> slot and released slots are reused, so neither an update nor an
+  // animation frame allocates per aircraft. Strings and ids sit in plain
+  // arrays beside the columns. Missing speed and heading are NaN. The worker
+  // hands out slots with add()/release(); the page mirrors them with put().
+  const NUM_COLUMNS = ['nextLat', 'nextLon', 'lat', 'lon', 'errLat', 'errLon', 't0',
+                       'lastSeen', 'bearing', 'turn', 'drawHdg', 'alt', 'speed'];
+
+  class AircraftStore {
+    constructor(capacity = 1024){
+      this.index = new Map();
+      this.free = [];
+      this.size = 0;
+      // Slots below `high` have been used; live[slot] says which still are.
+      this.high = 0;
+      this.capacity = 0;
+      this._grow(capacity);
+    }
+
+    _grow(capacity){
+      for (const name of NUM_COLUMNS){
+        const col = new Float64Array(capacity);
+        if (this[name]) col.set(this[name]);
+        this[name] = col;
+      }
+      const live = new Uint8Array(capacity);
+      if (this.live) live.set(this.live);
+      this.live = live;
+      for (const name of ['ids', 'callsign', 'uid', 'acid', 'ac', 'tags']){
+        if (!this[name]) this[name] = [];
+        this[name].length = capacity;
+      }
+      this.capacity = capacity;
+    }
+
+    slot(id){
+      const i = this.index.get(id);
+      return i === undefined ? -1 : i;
+    }
+
+    add(id){
+      let i = this.free.pop();
+      if (i === undefined){
+        if (this.high === this.capacity) this._grow(this.capacity * 2);
+        i = this.high++;
+      }
+      this.live[i] = 1;
+      this.ids[i] = id;
+      this.index.set(id, i);
+      this.size++;
+      return i;
+    }
+
+    put(i, id){
+      while (i >= this.capacity) this._grow(this.capacity * 2);
+      if (this.live[i]) this.index.delete(this.ids[i]); else this.size++;
+      this.live[i] = 1;
+      this.ids[i] = id;
+      this.index.set(id, i);
+      if (i >= this.high) this.high = i + 1;
+    }
+
+    remove(i){
+      if (!this.live[i]) return;
+      this.live[i] = 0;
+      this.index.delete(this.ids[i]);
+      this.ids[i] = this.callsign[i] = this.uid[i] = this.acid[i] = this.ac[i] = this.tags[i] = null;
+      this.size--;
+    }
+
+    release(i){
+      if (!this.live[i]) return;
+      this.remove(i);
+      this.free.push(i);
+    }
+  }
+"""
+
+WORKER_JS = r"""(function(){
+  // Data side of the page, run in a dedicated Worker so that none of it
+  // competes with panning and the animation loop: it streams or polls
+  // /api/map, decodes frames, merges deltas, works out headings and evicts
+  // stale aircraft. The authoritative store lives here; after each update
+  // the changed slots are posted to the page as transferable typed arrays.
+  const REFRESH_MS = 2000;
+  const STALE_MS = 15000;
+  const STALE_CHECK_MS = 1000;
+  // Observed turn rates are clamped to this many degrees per second.
+  const MAX_TURN_DEG_S = 10;
+
+  // __STORE_JS__
+
+  const store = new AircraftStore();
+  // Query string for /api/map and /api/stream, set by the page.
+  let query = null;
+
+  function mapURL(path = '/api/map'){
+    return `${path}?${query}`;
+  }
+
+  function nowMs(){ return Date.now(); }
+
+  function bearingFromTo(lat1, lon1, lat2, lon2){
+    const φ1 = lat1 * Math.PI/180, φ2 = lat2 * Math.PI/180;
+    const Δλ = (lon2 - lon1) * Math.PI/180;
+    const y = Math.sin(Δλ) * Math.cos(φ2);
+    const x = Math.cos(φ1)*Math.sin(φ2) - Math.sin(φ1)*Math.cos(φ2)*Math.cos(Δλ);
+    const θ = Math.atan2(y, x);
+    return (θ * 180/Math.PI + 360) % 360;
+  }
+
+  function normalizeHeading(hdg){
+    if (typeof hdg !== 'number' || !isFinite(hdg)) return null;
+    return (hdg + 360) % 360;
+  }
+
+  // Changes collected while applying one payload; flush() posts them.
+  // meta rows are [slot, id, callsign, uid, acid, ac, tags, fresh].
+  let removed = [];
+  let meta = [];
+  const moved = new Set();
+
+  function removeAircraft(id){
+    const i = store.slot(id);
+    if (i >= 0) removeSlot(i);
+  }
+
+  function removeSlot(i){
+    if (!store.live[i]) return;
+    store.release(i);
+    moved.delete(i);
+    removed.push(i);
+  }
+
+  function flush(fetched, clusters){
+    const S = store, n = S.high;
+    const mask = new Uint8Array(n);
+    const lat = new Float64Array(n), lon = new Float64Array(n);
+    const bearing = new Float64Array(n), turn = new Float64Array(n);
+    const alt = new Float64Array(n), speed = new Float64Array(n);
+    for (const i of moved){
+      mask[i] = 1;
+      lat[i] = S.nextLat[i];
+      lon[i] = S.nextLon[i];
+      bearing[i] = S.bearing[i];
+      turn[i] = S.turn[i];
+      alt[i] = S.alt[i];
+      speed[i] = S.speed[i];
+    }
+    self.postMessage({
+      type: 'sync', fetched, userCount: reported, count: n, removed, meta,
+      moved: mask, lat, lon, bearing, turn, alt, speed, clusters,
+    }, [mask.buffer, lat.buffer, lon.buffer, bearing.buffer, turn.buffer, alt.buffer, speed.buffer]);
+    removed = [];
+    meta = [];
+    moved.clear();
+  }
+
+  function upsertAircraft(u, t_fetch){
+    if (!u || !Array.isArray(u.co) || u.co.length < 4) return null;
+    const callsign = (typeof u.cs === 'string') ? u.cs.trim() : '';
+    const id = String(u.id || u.acid || Math.random());
+    const tags = Array.isArray(u.tags) ? u.tags.join(',') : '';
+    return upsertFix(id, u.co[0], u.co[1], u.co[2] * 3.28084, u.co[3], callsign,
+                     u.id ?? null, u.acid ?? null, u.st?.as ?? null, u.ac, tags, t_fetch);
+  }
+
+  // Create or move one aircraft. Takes plain values so binary frames can be
+  // applied straight from their typed arrays (which the server already
+  // validated and converted to feet). `tags` is the server's comma-separated
+  // list of our tags the callsign matched.
+  function upsertFix(id, lat, lon, alt, hdgServer, callsign, uid, acid, speed, ac, tags, t_fetch){
+    if (typeof lat !== 'number' || typeof lon !== 'number') return null;
+    if (!isFinite(lat) || !isFinite(lon)) return null;
+    if (Math.abs(lat) > 90 || Math.abs(lon) > 180) return null;
+    if (!callsign) return null;
+
+    const S = store;
+    let i = S.slot(id);
+    const fresh = i < 0;
+    if (fresh){
+        i = S.add(id);
+        S.bearing[i] = hdgServer || 0;
+        S.turn[i] = 0;
+        S.speed[i] = speed ?? NaN;
+    } else {
+        let cog = hdgServer != null ? hdgServer : S.bearing[i] || 0;
+        const moved = Math.abs(lat - S.nextLat[i]) + Math.abs(lon - S.nextLon[i]);
+        if (moved > 1e-5 && hdgServer == null) {
+            cog = bearingFromTo(S.nextLat[i], S.nextLon[i], lat, lon);
+        }
+        const before = S.bearing[i];
+        S.bearing[i] = normalizeHeading(cog) ?? NaN;
+        const dt = (t_fetch - S.lastSeen[i]) / 1000;
+        if (dt > 0.2 && isFinite(before) && isFinite(S.bearing[i])){
+            const dh = ((S.bearing[i] - before + 540) % 360) - 180;
+            S.turn[i] = Math.max(-MAX_TURN_DEG_S, Math.min(MAX_TURN_DEG_S, dh / dt));
+        }
+        if (speed != null) S.speed[i] = speed;
+        uid = uid ?? S.uid[i];
+        acid = acid ?? S.acid[i];
+    }
+    if (fresh || S.callsign[i] !== callsign || S.uid[i] !== uid || S.acid[i] !== acid || S.ac[i] !== ac
+        || S.tags[i] !== tags){
+        meta.push([i, id, callsign, uid, acid, ac, tags, fresh]);
+    }
+    S.nextLat[i] = lat;
+    S.nextLon[i] = lon;
+    S.lastSeen[i] = t_fetch;
+    S.alt[i] = alt;
+    S.ac[i] = ac;
+    S.uid[i] = uid;
+    S.acid[i] = acid;
+    S.callsign[i] = callsign;
+    S.tags[i] = tags;
+    moved.add(i);
+    return id;
+  }
+
+  // Binary full-list frames (see encode_frame on the server). Columns are
+  // typed-array views over the response buffer; strings are decoded on demand.
+  // Frames are little-endian and typed arrays use host byte order, which is
+  // little-endian on every platform browsers ship on.
+  const FRAME_MIME = "application/x-geofs-frame";
+  const FRAME_HEADER_BYTES = 24;
+  const utf8 = new TextDecoder();
+
+  function decodeFrame(buf){
+    const dv = new DataView(buf);
+    const magic = String.fromCharCode(dv.getUint8(0), dv.getUint8(1), dv.getUint8(2), dv.getUint8(3));
+    if (magic !== 'GFR1' || dv.getUint16(4, true) !== 3) throw new Error('bad frame');
+    const seq = dv.getUint32(8, true), count = dv.getUint32(12, true);
+    const userCount = dv.getUint32(16, true), stringsLen = dv.getUint32(20, true);
+    let pos = FRAME_HEADER_BYTES;
+    const col = (Type, n) => { const a = new Type(buf, pos, n); pos += n * Type.BYTES_PER_ELEMENT; return a; };
+    const lat = col(Float32Array, count), lon = col(Float32Array, count), alt = col(Float32Array, count);
+    const hdg = col(Float32Array, count), speed = col(Float32Array, count), acid = col(Uint32Array, count);
+    const off = col(Uint32Array, 3 * count + 1), ac = col(Uint16Array, count + count % 2);
+    const strings = new Uint8Array(buf, pos, stringsLen);
+    const str = (k) => utf8.decode(strings.subarray(off[k], off[k + 1]));
+    return {
+      seq, count, userCount, lat, lon, alt, hdg, speed, acid, ac,
+      callsign: (i) => str(3 * i),
+      id: (i) => str(3 * i + 1),
+      tags: (i) => str(3 * i + 2),
+    };
+  }
+
+  function applyFrame(f, t_fetch){
+    const seen = new Set();
+    for (let i = 0; i < f.count; i++){
+        const id = f.id(i);
+        const speed = isNaN(f.speed[i]) ? null : f.speed[i];
+        const acid = f.acid[i] === 0xFFFFFFFF ? null : f.acid[i];
+        const ac = f.ac[i] === 0xFFFF ? null : f.ac[i];
+        const hdg = isNaN(f.hdg[i]) ? null : f.hdg[i];
+        if (upsertFix(id, f.lat[i], f.lon[i], f.alt[i], hdg, f.callsign(i), id, acid, speed, ac, f.tags(i), t_fetch)){
+          seen.add(id);
+        }
+    }
+    return seen;
+  }
+
+  // Snapshot sequence the aircraft store reflects; 0 asks the server for a full list.
+  let lastSeq = 0;
+  // Last record received per aircraft id, so field-level patches can be merged.
+  let RAW = {};
+  let lastSync = 0;
+  let reported = 0;
+
+  // Apply a /api/map response: either a delta against lastSeq or a full list.
+  // Returns false for a delta against some other seq, which is dropped.
+  function applyMapPayload(data, t_fetch){
+    if (data.delta && data.since !== lastSeq) return false;
+    if (typeof data.userCount === 'number') reported = data.userCount;
+    if (data.delta){
+        for (const id of data.removed || []){
+            removeAircraft(id);
+            delete RAW[id];
+        }
+        for (const u of data.added || []){
+            const id = upsertAircraft(u, t_fetch);
+            if (id) RAW[id] = u;
+        }
+        const changed = data.changed || {};
+        for (const id in changed){
+            const base = RAW[id] || recordOf(store.slot(id));
+            if (!base) continue;
+            RAW[id] = Object.assign({}, base, changed[id]);
+            upsertAircraft(RAW[id], t_fetch);
+        }
+    } else if (data.frame){
+        const seen = applyFrame(data.frame, t_fetch);
+        RAW = {};
+        removeUnseen(seen);
+    } else {
+        const users = Array.isArray(data.users) ? data.users : [];
+        if (typeof data.userCount !== 'number') reported = users.length;
+        const seen = new Set();
+        RAW = {};
+        for (const u of users){
+            const id = upsertAircraft(u, t_fetch);
+            if (id){
+                seen.add(id);
+                RAW[id] = u;
+            }
+        }
+        removeUnseen(seen);
+    }
+    if (typeof data.seq === 'number') lastSeq = data.seq;
+    lastSync = t_fetch;
+    flush(true, data.delta ? null : (data.clusters || []));
+    retune();
+    return true;
+  }
+
+  // Rebuild a server-shaped record for an aircraft that arrived in a binary
+  // frame, so a later JSON patch has something to merge into.
+  function recordOf(i){
+    if (i < 0) return null;
+    const S = store;
+    return {
+      id: S.uid[i], acid: S.acid[i], cs: S.callsign[i], ac: S.ac[i],
+      tags: S.tags[i] ? S.tags[i].split(',') : [],
+      co: [S.nextLat[i], S.nextLon[i], S.alt[i] / 3.28084, isFinite(S.bearing[i]) ? S.bearing[i] : null],
+      st: { as: isFinite(S.speed[i]) ? S.speed[i] : null },
+    };
+  }
+
+  function removeUnseen(seen){
+    for (let i = 0; i < store.high; i++){
+      if (store.live[i] && !seen.has(store.ids[i])) removeSlot(i);
+    }
+  }
+
+
+  // Updates arrive over /api/stream (Server-Sent Events) when possible.
+  // Polling /api/map only runs while no stream is delivering.
+  const STREAM_RETRY_MS = 30000;
+  let stream = null;
+  let streamLive = false;
+  let pollTimer = null;
+  // Bumped on every query change; a poll started for an earlier query is
+  // aborted, and anything it still returns is dropped.
+  let queryGen = 0;
+  let pollAbort = null;
+
+  function openStream(){
+    if (!self.EventSource || stream || view.hidden) return;
+    const es = new EventSource(`${mapURL('/api/stream')}&since=${lastSeq}&every=${cadenceMs / 1000}`);
+    stream = es;
+    // Covers proxies that hold the stream open but buffer it: polling keeps
+    // going until the first event actually arrives.
+    schedulePoll(cadenceMs);
+    es.addEventListener('map', (e) => {
+      streamLive = true;
+      if (!applyMapPayload(JSON.parse(e.data), nowMs())) restartStream();
+    });
+    es.onerror = () => {
+      es.close();
+      if (stream !== es) return;
+      stream = null;
+      streamLive = false;
+      schedulePoll(0);
+      setTimeout(openStream, STREAM_RETRY_MS);
+    };
+  }
+
+  function restartStream(){
+    if (!stream) return;
+    stream.close();
+    stream = null;
+    streamLive = false;
+    openStream();
+  }
+
+  function schedulePoll(delay){
+    if (pollTimer == null) pollTimer = setTimeout(refreshLoop, delay);
+  }
+
+  async function refreshLoop(){
+    pollTimer = null;
+    if (streamLive) return;
+    const gen = queryGen;
+    const abort = new AbortController();
+    pollAbort = abort;
+    try {
+        const r = await fetch(`${mapURL()}&since=${lastSeq}`, {
+          cache:'no-cache',
+          headers: { 'Accept': `${FRAME_MIME}, application/json;q=0.9` },
+          signal: abort.signal,
+        });
+        if (gen !== queryGen) return;
+        if (r.status === 400){
+          // A query the server could not parse; show why, keep polling.
+          const body = await r.json().catch(() => ({}));
+          self.postMessage({ type: 'status', text: 'Query error', queryError: body.error || 'bad query' });
+          return;
+        }
+        if (!r.ok) throw new Error('upstream status ' + r.status);
+        let data;
+        if ((r.headers.get('Content-Type') || '').startsWith(FRAME_MIME)){
+          const frame = decodeFrame(await r.arrayBuffer());
+          data = { seq: frame.seq, userCount: frame.userCount, frame };
+        } else {
+          data = await r.json();
+        }
+        if (!streamLive && gen === queryGen) applyMapPayload(data, nowMs());
+    } catch(err){
+        if (gen !== queryGen) return;
+        console.error("Fetch error:", err);
+        self.postMessage({ type: 'status', text: 'Fetch error' });
+    } finally {
+        if (pollAbort === abort) pollAbort = null;
+        // A superseded poll leaves the schedule to the new query's loop.
+        if (!streamLive && gen === queryGen) schedulePoll(cadenceMs);
+    }
+  }
+
+  // Update cadence. The page dead-reckons between fixes, so fixes only need
+  // to come often enough to correct turns before the drift shows: the
+  // interval is the step at which fast aircraft (90th percentile speed)
+  // drift about DRIFT_BUDGET_PX at the page's zoom, and a hidden tab
+  // drops the stream and polls rarely.
+  const CADENCE_STEPS_MS = [1000, 2000, 4000, 8000];
+  const HIDDEN_POLL_MS = 30000;
+  const DRIFT_BUDGET_PX = 24;
+  const EARTH_CIRCUMFERENCE_M = 40075016;
+  let view = { zoom: 2, hidden: false };
+  let cadenceMs = REFRESH_MS;
+
+  function pickCadence(){
+    if (view.hidden) return HIDDEN_POLL_MS;
+    const speeds = [];
+    for (let i = 0; i < store.high; i++){
+      if (store.live[i] && store.speed[i] > 0) speeds.push(store.speed[i]);
+    }
+    if (!speeds.length) return REFRESH_MS;
+    speeds.sort((a, b) => a - b);
+    const mps = speeds[Math.floor(speeds.length * 0.9)] * 1852 / 3600;
+    const pxPerMs = mps * 256 * Math.pow(2, view.zoom) / EARTH_CIRCUMFERENCE_M / 1000;
+    const ideal = DRIFT_BUDGET_PX / pxPerMs;
+    let pick = CADENCE_STEPS_MS[0];
+    for (const step of CADENCE_STEPS_MS) if (step <= ideal) pick = step;
+    return pick;
+  }
+
+  // Reopen the stream (from lastSeq, so it resumes with a delta) or move the
+  // poll timer when the cadence changes.
+  function retune(){
+    const next = pickCadence();
+    if (next === cadenceMs) return;
+    cadenceMs = next;
+    if (view.hidden && stream){
+      stream.close();
+      stream = null;
+      streamLive = false;
+    }
+    if (stream){
+      restartStream();
+    } else if (!view.hidden && query !== null && self.EventSource){
+      openStream();
+    } else {
+      clearTimeout(pollTimer);
+      pollTimer = null;
+      schedulePoll(cadenceMs);
+    }
+  }
+
+  // Deltas only carry aircraft that changed, so a successful sync counts as
+  // seeing everything still in the store.
+  setInterval(() => {
+    const t = nowMs();
+    for (let i = 0; i < store.high; i++){
+      if (store.live[i] && t - Math.max(store.lastSeen[i], lastSync) > STALE_MS) removeSlot(i);
+    }
+    if (removed.length) flush(false, null);
+  }, STALE_CHECK_MS);
+
+  // Drop aircraft the page's tag list no longer matches, going by the tags
+  // the server matched (uppercased, like the server's tag set); the next
+  // full list is filtered the same way.
+  function dropUntagged(tags){
+    if (!tags.length) return;
+    const keys = new Set(tags.map(k => k.trim().toUpperCase()));
+    for (let i = 0; i < store.high; i++){
+      if (!store.live[i]) continue;
+      const matched = store.tags[i] ? store.tags[i].split(',') : [];
+      if (!matched.some(k => keys.has(k))) removeSlot(i);
+    }
+  }
+
+  self.onmessage = (e) => {
+    const m = e.data;
+    if (m.type === 'view'){
+      view = { zoom: m.zoom, hidden: m.hidden };
+      if (query !== null) retune();
+      return;
+    }
+    if (m.type !== 'query') return;
+    const first = query === null;
+    query = m.query;
+    dropUntagged(m.tags || []);
+    if (removed.length) flush(false, null);
+    // Deltas are relative to the previous query; start over from a full list,
+    // and drop whatever a poll for the old query still brings back.
+    lastSeq = 0;
+    queryGen++;
+    if (pollAbort) pollAbort.abort();
+    if (first){
+      if (self.EventSource) openStream(); else refreshLoop();
+    } else if (stream){
+      restartStream();
+    } else {
+      // Polling: fetch the new query now rather than at the next tick.
+      clearTimeout(pollTimer);
+      pollTimer = null;
+      refreshLoop();
+    }
+  };
+})();
+"""
+
+# ---------------- Static assets ----------------
+# Compressed once at import. The script URL carries its content hash, so it
+# can be cached for a year; the page itself is revalidated with its ETag.
+def _with_store(js):
+    return js.replace("  // __STORE_JS__\n", STORE_JS)
+
+WORKER_JS_ASSET = Encoded(_with_store(WORKER_JS)).precompress(best=True)
+WORKER_JS_URL = f"/assets/worker.{WORKER_JS_ASSET.etag}.js"
+APP_JS_ASSET = Encoded(_with_store(APP_JS).replace("__WORKER_JS_URL__", WORKER_JS_URL)
+                      .replace("__DEFAULT_TAGS__", json.dumps(DEFAULT_TAGS))
+                      .replace("__AIRCRAFT_DB__", json.dumps(AIRCRAFT_DB))).precompress(best=True)
+APP_JS_URL = f"/assets/app.{APP_JS_ASSET.etag}.js"
+INDEX_ASSET = Encoded(HTML_PAGE.replace("__APP_JS_URL__", APP_JS_URL)).precompress(best=True)
+ASSETS = {
+    APP_JS_URL.rsplit("/", 1)[1]: (APP_JS_ASSET, "application/javascript; charset=utf-8"),
+    WORKER_JS_URL.rsplit("/", 1)[1]: (WORKER_JS_ASSET, "application/javascript; charset=utf-8"),
+}
+
 if __name__ == "__main__": 
     print(f"GeoFS Live Radar running on http://0.0.0.0:{PORT}")
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+    if SERVER_MODE == "asgi" or "--asgi" in sys.argv[1:]:
+        import uvicorn
+        uvicorn.run(asgi_app, host="0.0.0.0", port=PORT, log_level="warning")
+    else:
+        if ROLE != "standalone":
+            # Publish or subscribe from the start rather than after the first request.
+            poller.start()
+        app.run(host="0.0.0.0", port=PORT, debug=False)
@@ -0,0 +1,13 @@
+"""Builders for upstream user records and snapshots shared by the tests."""
+import geofs_live_radar as radar
+
+
+def user(uid, cs, lat, lon, alt_m=1000.0, hdg=90.0, speed=250.0, acid=None, ac=7):
+    """An upstream user record as GeoFS sends it (altitude in metres)."""
+    return {"id": uid, "acid": uid if acid is None else acid, "cs": cs, "ac": ac,
+            "co": [lat, lon, alt_m, hdg], "st": {"as": speed}}
+
+
+def snapshot(users, seq=1, fetched_at=1000.0):
+    body = radar.json.dumps({"userCount": len(users), "users": users}).encode()
+    return radar.Snapshot.parse(body, fetched_at, seq)
@@ -0,0 +1,68 @@
+"""On-disk track archive: segments, sealing, torn blocks and compaction."""
+import os
+
+import pytest
+
+import geofs_live_radar as radar
+from helpers import snapshot, user
+
+
+def archive_snapshot(t, step):
+    return snapshot([user(1, "Alpha", 10.0 + step, 20.0, 1000.0 + step, 90.0, 300.0),
+                     user(2, "Bravo", -5.0, 40.0 - step, 200.0, 180.0, 150.0, ac=3)], fetched_at=t)
+
+
+def test_archive_round_trip_and_compaction(tmp_path):
+    directory = str(tmp_path)
+    archive = radar.TrackArchive(directory, window=100, every=1, flush_seconds=0, block_rows=3)
+    for step in range(10):
+        archive.record(archive_snapshot(1000.0 + 10 * step, step))   # window [1000, 1100)
+    archive.record(archive_snapshot(1100.0, 10))                     # seals the first window
+    archive.flush()
+    reader = radar.ArchiveReader(directory, 100)
+    first, second = reader.segments()
+    assert first.sealed and (first.start, first.end) == (1000, 1100)
+    assert not second.sealed
+
+    cs, rows = reader.trail("1", 0, 2000)
+    assert cs == "Alpha"
+    assert [r[0] for r in rows] == [1000.0 + 10 * step for step in range(11)]
+    assert rows[3][1:4] == pytest.approx((13.0, 20.0, 1003.0))
+    assert rows[3][6] == 7
+    window = list(reader.window_rows(1000, 1020))
+    assert sorted((r[0], r[2]) for r in window) == [(k, t) for k in "12" for t in (1000.0, 1010.0, 1020.0)]
+
+    archive.seal(1100)
+    read, written, before, after = radar.compact_archive(directory, 100, merge_seconds=1000, now=5000)
+    assert (read, written) == (2, 1)
+    assert after < before
+    assert sorted(os.listdir(directory)) == ["archive.lock", "tracks-1000.seg"]
+    compacted = radar.ArchiveReader(directory, 100)
+    (seg,) = compacted.segments()
+    assert seg.sealed and (seg.start, seg.end) == (1000, 1200)
+    assert compacted.trail("1", 0, 2000) == (cs, rows)
+
+
+def test_compaction_drops_rows_past_keep_seconds(tmp_path):
+    directory = str(tmp_path)
+    archive = radar.TrackArchive(directory, window=100, every=1, flush_seconds=0)
+    for step in range(20):
+        archive.record(archive_snapshot(1000.0 + 10 * step, step))
+    archive.flush()
+    archive.seal(1100)
+    radar.compact_archive(directory, 100, keep_seconds=4850, now=6000)
+    _, rows = radar.ArchiveReader(directory, 100).trail("1", 0, 2000)
+    assert [r[0] for r in rows] == [1150.0 + 10 * step for step in range(5)]
+
+
+def test_archive_ignores_a_torn_block(tmp_path):
+    directory = str(tmp_path)
+    archive = radar.TrackArchive(directory, window=100, every=1, flush_seconds=0)
+    archive.record(archive_snapshot(1000.0, 0))
+    path = os.path.join(directory, "tracks-1000.seg")
+    with open(path, "ab") as f:
+        f.write(radar.encode_block([radar.archive_row(user(9, "Zulu", 0.0, 0.0), 1001.0)])[0][:-5])
+    assert [r[0] for r in radar.ArchiveReader(directory, 100).trail("1", 0, 2000)[1]] == [1000.0]
+    archive.record(archive_snapshot(1010.0, 1))
+    _, rows = radar.ArchiveReader(directory, 100).trail("1", 0, 2000)
+    assert [r[0] for r in rows] == [1000.0, 1010.0]
@@ -0,0 +1,109 @@
+"""The ingest-to-edge snapshot bus: SNP1 messages, replay, BusLink verdicts, slow subscribers."""
+import gzip
+import os
+import socket
+
+import pytest
+
+import geofs_live_radar as radar
+
+BODY = b'{"userCount":1,"users":[{"id":1,"cs":"Alpha","co":[1,2,3,4]}]}'
+
+
+def snap(seq, fetched_at=1000.0, variants=None):
+    return radar.Snapshot.parse(BODY, fetched_at, seq, variants)
+
+
+def parse(message):
+    seq, fetched_at, sizes, behind = radar.read_bus_header(message[:radar.BUS_HEADER.size])
+    parts, pos = [], radar.BUS_HEADER.size
+    for n in sizes:
+        parts.append(message[pos:pos + n])
+        pos += n
+    assert pos == len(message)
+    return seq, fetched_at, parts, behind
+
+
+def test_message_round_trip_with_gzip_and_br():
+    br = b"\x8b\x1f\x80brotli-bytes"   # passed through as is; the bus never decodes it
+    message = radar.bus_message(snap(42, 1234.5, {"gzip": gzip.compress(BODY), "br": br}))
+    seq, fetched_at, (body, gz, got_br), behind = parse(message)
+    assert (seq, fetched_at, behind) == (42, 1234.5, 0)
+    assert body == BODY and gzip.decompress(gz) == BODY and got_br == br
+    assert radar.bus_variants(gz, got_br) == {"gzip": gz, "br": br}
+
+
+def test_message_without_variants():
+    seq, _, (body, gz, br), _ = parse(radar.bus_message(snap(7)))
+    assert (seq, body, gz, br) == (7, BODY, b"", b"")
+    assert radar.bus_variants(gz, br) == {}
+
+
+def test_replayed_marks_messages_still_to_come():
+    message = radar.bus_message(snap(3, variants={"gzip": gzip.compress(BODY)}))
+    again = radar.replayed(message, 5)
+    assert len(again) == len(message)
+    assert parse(again)[3] == 5
+    assert parse(again)[:3] == parse(message)[:3]
+
+
+def test_foreign_bytes_are_rejected():
+    with pytest.raises(ValueError):
+        radar.read_bus_header(b"HTTP" + bytes(radar.BUS_HEADER.size - 4))
+
+
+def test_link_verdicts():
+    link = radar.BusLink("unix:/nowhere")
+    assert link.verdict(10, 100.0) == "new"
+    assert link.verdict(11, 102.0) == "new"
+    assert link.verdict(11, 102.0) == "seen"        # the same message again
+    assert link.verdict(9, 98.0) == "seen"          # a reconnect replaying older snapshots
+    assert (link.seq, link.resets) == (11, 0)
+    assert link.verdict(13, 106.0) == "new"         # a gap is fine
+    assert link.verdict(1, 200.0) == "restart"      # seq went back with a newer fetch: ingest restarted
+    assert (link.seq, link.resets) == (1, 1)
+    assert link.verdict(1, 200.0) == "seen"
+    assert link.verdict(2, 202.0) == "new"
+
+
+def test_slow_subscriber_drops_the_oldest():
+    queue = radar.BusQueue(None, 2)
+    assert queue.put(b"1") and queue.put(b"2")
+    assert not queue.put(b"3")
+    assert [queue.take(), queue.take()] == [b"2", b"3"]
+    queue.close()
+    assert queue.take() is None
+
+
+def test_publisher_counts_drops_for_a_slow_subscriber():
+    publisher = radar.SnapshotPublisher("unix:/nowhere", window=4, queue_size=2)
+    publisher._pid = os.getpid()   # act as the bound publisher without a socket
+    sub = radar.BusQueue(None, 2)
+    publisher.subscribers.add(sub)
+    for seq in range(1, 6):
+        publisher.send(snap(seq))
+    assert (publisher.published, publisher.dropped) == (5, 3)
+    assert [parse(sub.take())[0] for _ in range(2)] == [4, 5]
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs unix sockets")
+def test_new_subscriber_gets_a_replay_then_live_messages(tmp_path):
+    publisher = radar.SnapshotPublisher(f"unix:{tmp_path}/bus.sock", window=3, queue_size=8)
+    for seq in range(1, 6):
+        publisher.send(snap(seq, 1000.0 + seq))
+    assert publisher.stats()["listening"]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(f"{tmp_path}/bus.sock")
+        stream = sock.makefile("rb")
+
+        def read():
+            header = stream.read(radar.BUS_HEADER.size)
+            seq, fetched_at, sizes, behind = radar.read_bus_header(header)
+            body = stream.read(sizes[0])
+            stream.read(sizes[1] + sizes[2])
+            return seq, fetched_at, behind, body
+
+        assert [read()[::2] for _ in range(3)] == [(3, 2), (4, 1), (5, 0)]
+        publisher.send(snap(6, 1006.0))
+        assert read() == (6, 1006.0, 0, BODY)
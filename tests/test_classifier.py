@@ -0,0 +1,85 @@
+"""TagClassifier: learning custom tags without losing them or recompiling per request."""
+import threading
+
+import pytest
+
+import geofs_live_radar as radar
+
+
+@pytest.fixture
+def compiles(monkeypatch):
+    """Counts TagMatcher builds, i.e. automaton compiles."""
+    count = [0]
+    matcher = radar.TagMatcher
+
+    def counted(tags):
+        count[0] += 1
+        return matcher(tags)
+
+    monkeypatch.setattr(radar, "TagMatcher", counted)
+    return count
+
+
+def test_base_tags_need_no_learning(compiles):
+    classifier = radar.TagClassifier(["[PMC]", "[U]"], 128, max_tags=4, learn_max=2)
+    built = compiles[0]
+    classify = classifier.learn(("[PMC]",))
+    assert classify("[PMC] Viper") == frozenset({"[PMC]"})
+    assert radar.matched_tags("[U][PMC] Duo", ("[PMC]", "[U]"), classifier.learn(("[PMC]", "[U]"))) == ["[PMC]", "[U]"]
+    assert compiles[0] == built and classifier.recompiles == 0
+
+
+def test_learning_past_both_caps_keeps_the_querys_own_tags(compiles):
+    classifier = radar.TagClassifier(["[PMC]"], 128, max_tags=3, learn_max=2)
+    first = ("[A]", "[B]", "[C]", "[PMC]")   # one more than learn_max
+    classify = classifier.learn(first)
+    assert classifier.recompiles == 1 and len(classifier.tags) == 3
+    for tag in first:
+        assert radar.matched_tags(f"{tag} Pilot", first, classify) == [tag]
+    second = ("[D]", "[E]", "[F]")           # past max_tags: nothing more is compiled in
+    classify = classifier.learn(second)
+    assert classifier.recompiles == 2 and len(classifier.tags) == 4
+    for tag in second:
+        assert radar.matched_tags(f"x{tag}y", second, classify) == [tag]
+    assert radar.matched_tags("[D][F]", second, classify) == ["[D]", "[F]"]
+    third = ("[G]", "[H]")
+    classify = classifier.learn(third)
+    assert classifier.recompiles == 2 and len(classifier.tags) == 4
+    assert radar.matched_tags("[H] [PMC]", third + ("[PMC]",), classifier.learn(third + ("[PMC]",))) == ["[H]", "[PMC]"]
+    assert classify("nothing here") == frozenset()
+    assert classifier.stats()["overflow_sets"] >= 2
+
+
+def test_alternating_queries_do_not_recompile(compiles):
+    classifier = radar.TagClassifier(["[PMC]"], 128, max_tags=2, learn_max=1)
+    queries = [("[A]", "[B]", "[C]"), ("[X]", "[Y]"), ("[PMC]", "[Z]")]
+    for q in queries:
+        classifier.learn(q)
+    built, recompiles = compiles[0], classifier.recompiles
+    for _ in range(50):
+        for q in queries:
+            classify = classifier.learn(q)
+            assert all(radar.matched_tags(f"-{t}-", q, classify) == [t] for t in q)
+    assert (compiles[0], classifier.recompiles) == (built, recompiles)
+
+
+def test_concurrent_learners_each_get_their_own_tags():
+    classifier = radar.TagClassifier([], 128, max_tags=8, learn_max=4)
+    start = threading.Barrier(16)
+    failures = []
+
+    def run(n):
+        tags = tuple(f"[T{n}-{k}]" for k in range(3))
+        start.wait()
+        for _ in range(20):
+            classify = classifier.learn(tags)
+            if any(radar.matched_tags(f"{t} wing", tags, classify) != [t] for t in tags):
+                failures.append(n)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert failures == []
+    assert len(classifier.tags) <= 8
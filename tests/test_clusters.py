@@ -0,0 +1,79 @@
+"""Zoom-dependent clustering: the ClusterIndex pyramid and ?zoom= answers."""
+import json
+import random
+
+import geofs_live_radar as radar
+from helpers import snapshot, user
+
+
+def synthetic_users(n, seed=3):
+    rng = random.Random(seed)
+    users = [user(i, f"F{i}", rng.gauss(50, 5), rng.gauss(5, 10), ac=i % 4) for i in range(n)]
+    users.append(user(n, "Alone", -60.0, -150.0, ac=9))
+    return users
+
+
+def test_every_level_accounts_for_every_aircraft():
+    users = synthetic_users(2000)
+    index = radar.ClusterIndex(users, max_zoom=6)
+    assert len(index.levels) == 6
+    for zoom in range(6):
+        singles, clusters = index.query(zoom)
+        assert len(singles) + sum(c[2] for c in clusters) == len(users)
+        assert sum(cell[0] for cell in index.levels[zoom].values()) == len(users)
+    # Each coarser level merges 2x2 cells of the one below.
+    assert [len(level) for level in index.levels] == sorted(len(level) for level in index.levels)
+
+
+def test_singletons_come_back_as_aircraft():
+    users = synthetic_users(500)
+    index = radar.ClusterIndex(users, max_zoom=6)
+    for zoom in range(6):
+        singles, clusters = index.query(zoom)
+        assert users[-1] in singles
+        assert all(c[2] > 1 for c in clusters)
+        assert singles == sorted(singles, key=users.index)
+
+
+def test_cluster_rows():
+    users = [user(1, "A", 10.0, 10.0, ac=3), user(2, "B", 10.2, 10.2, ac=3), user(3, "C", 10.1, 10.1, ac=5)]
+    singles, clusters = radar.ClusterIndex(users, max_zoom=6).query(0)
+    assert singles == []
+    assert clusters == [[10.1, 10.1, 3, 3]]
+
+
+def test_bbox_cuts_clusters_by_centroid():
+    users = synthetic_users(500)
+    singles, clusters = radar.ClusterIndex(users, max_zoom=6).query(2, radar.parse_bbox({"bbox": "-70,-160,-50,-140"}))
+    assert singles == [users[-1]] and clusters == []
+
+
+def answer(path, snap):
+    with radar.app.test_request_context(path):
+        query = radar.MapQuery.parse(radar.request.args)
+        encoded, _ = radar.encode_snapshot(radar.request, snap, query)
+    return json.loads(encoded.body)
+
+
+def test_zoom_below_the_limit_clusters_and_at_or_above_it_does_not():
+    users = synthetic_users(300)
+    snap = snapshot(users)
+    clustered = answer("/api/map?zoom=1", snap)
+    assert clustered["zoom"] == 1 and clustered["clusters"]
+    assert len(clustered["users"]) + sum(c[2] for c in clustered["clusters"]) == len(users)
+    for zoom in (radar.CLUSTER_MAX_ZOOM, radar.CLUSTER_MAX_ZOOM + 3):
+        plain = answer(f"/api/map?zoom={zoom}", snap)
+        assert "clusters" not in plain and "zoom" not in plain
+        assert [u["id"] for u in plain["users"]] == [u["id"] for u in users]
+
+
+def test_counts_follow_the_tag_filter():
+    users = synthetic_users(600)
+    for u in users[::3]:
+        u["cs"] = "[PMC] " + u["cs"]
+    snap = snapshot(users)
+    tagged = len(users[::3])
+    for zoom in range(radar.CLUSTER_MAX_ZOOM):
+        singles, clusters = snap.cluster_index(("[PMC]",)).query(zoom)
+        assert len(singles) + sum(c[2] for c in clusters) == tagged
+        assert all(u["cs"].startswith("[PMC]") for u in singles)
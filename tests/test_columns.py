@@ -0,0 +1,91 @@
+"""SnapshotColumns: validation, missing values, and numpy/pure-Python parity."""
+import math
+
+import pytest
+
+import geofs_live_radar as radar
+from helpers import snapshot, user
+
+
+@pytest.fixture(params=["numpy", "python"])
+def backend(request, monkeypatch):
+    """Run a test against both the numpy and the pure-Python column code."""
+    if request.param == "numpy" and radar.np is None:
+        pytest.skip("numpy not installed")
+    if request.param == "python":
+        monkeypatch.setattr(radar, "np", None)
+    return request.param
+
+
+USERS = [
+    user(1, "[PMC] Viper", 51.5, -0.1, 7000.0, 90.0, 450.0),
+    user(2, "[U] Cub", 51.6, -0.2, 300.0, 270.0, 90.0, ac=2),
+    {"id": 3, "cs": "Nomad", "ac": 22, "co": [-33.9, 151.2, 1000.0, None]},
+    {"id": 4, "cs": "[PMC] Lost", "ac": 7, "co": [40.6, -73.8, "high", 10.0], "st": {"as": 300.0}},
+    {"id": 5, "cs": "Offworld", "co": [91.0, 0.0, 0.0, 0.0]},
+    {"id": 6, "cs": "  ", "co": [1.0, 1.0, 0.0, 0.0]},
+    {"id": 7, "cs": "Nowhere", "co": [True, 1.0]},
+    {"id": 8, "cs": "Bad", "co": "51,0"},
+    "not a record",
+    {"id": 9, "cs": "Booly", "ac": True, "acid": -3, "co": [1.0, 2.0]},
+]
+
+
+def test_only_valid_aircraft_get_rows(backend):
+    cols = snapshot(USERS).columns
+    assert [u["id"] for u in cols.users] == [1, 2, 3, 4, 9]
+    assert cols.index == {"1": 0, "2": 1, "3": 2, "4": 3, "9": 4}
+    assert list(cols.ac) == [7, 2, 22, 7, -1]
+    assert list(cols.acid) == [1, 2, -1, -1, -1]
+    assert cols.alt[0] == pytest.approx(7000.0 * radar.FT_PER_M)
+
+
+def test_missing_numbers_are_nan(backend):
+    cols = snapshot(USERS).columns
+    assert math.isnan(cols.hdg[2]) and math.isnan(cols.speed[2])
+    assert math.isnan(cols.alt[3])
+    assert math.isnan(cols.alt[4]) and math.isnan(cols.hdg[4])
+
+
+def matching(q):
+    return [u["id"] for u in radar.compile_filter(q).apply(snapshot(USERS).columns)]
+
+
+@pytest.mark.parametrize("q, ids", [
+    ("hdg!=90", [2, 4]),
+    ("hdg<1000", [1, 2, 4]),
+    ("alt!=0", [1, 2, 3]),
+    ("alt=0", []),
+    ("speed!=450", [2, 4]),
+    ("type:7", [1, 4]),
+    # A negated term is everything the term did not match, missing values included.
+    ("-alt!=0", [4, 9]),
+])
+def test_missing_values_never_match_a_comparison(backend, q, ids):
+    assert matching(q) == ids
+
+
+PARITY_QUERIES = ["tag:[PMC]", "alt>1000", "hdg!=90", "-speed<100", "near:51.5,-0.1,50nm",
+                  "type:7,22 alt<30000", "cs:o -hdg=10"]
+
+
+def test_backends_agree(monkeypatch):
+    if radar.np is None:
+        pytest.skip("numpy not installed")
+    users = [user(i, f"[PMC] Flight {i}" if i % 3 else f"Solo {i}", (i * 7.3) % 180 - 90, (i * 13.1) % 360 - 180,
+                  alt_m=(i * 97) % 12000, hdg=None if i % 11 == 0 else (i * 31) % 360,
+                  speed=None if i % 5 == 0 else (i * 17) % 600, ac=i % 30)
+             for i in range(500)]
+
+    def run():
+        cols = snapshot(users).columns
+        return ([list(cols.alt), list(cols.hdg), list(cols.speed)],
+                {q: [u["id"] for u in radar.compile_filter(q).apply(cols)] for q in PARITY_QUERIES})
+
+    numpy_cols, numpy_matches = run()
+    monkeypatch.setattr(radar, "np", None)
+    python_cols, python_matches = run()
+    assert numpy_matches == python_matches
+    assert any(numpy_matches.values())
+    for a, b in zip(numpy_cols, python_cols):
+        assert a == pytest.approx(b, nan_ok=True)
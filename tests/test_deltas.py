@@ -0,0 +1,44 @@
+"""?since= deltas between two snapshots."""
+import geofs_live_radar as radar
+from helpers import snapshot, user
+
+
+def apply(view, delta):
+    view = dict(view)
+    for key in delta["removed"]:
+        del view[key]
+    for u in delta["added"]:
+        view[radar.aircraft_id(u)] = u
+    for key, fields in delta["changed"].items():
+        view[key] = {**view[key], **fields}
+    return view
+
+
+def test_delta_payload_applies_to_the_old_view():
+    old = snapshot([user(1, "Alpha", 1.0, 1.0), user(2, "Bravo", 2.0, 2.0)], seq=1)
+    new = snapshot([user(1, "Alpha", 1.5, 1.0), user(3, "Charlie", 3.0, 3.0)], seq=2)
+    query = radar.MapQuery()
+    delta = radar.delta_payload(old, new, query)
+    assert (delta["since"], delta["seq"], delta["delta"]) == (1, 2, True)
+    assert delta["removed"] == ["2"]
+    assert [u["id"] for u in delta["added"]] == [3]
+    assert delta["changed"] == {"1": {"co": [1.5, 1.0, 1000.0, 90.0]}}
+    assert apply(radar.keyed_view(old, query), delta) == radar.keyed_view(new, query)
+
+
+def test_delta_follows_the_query():
+    old = snapshot([user(1, "[PMC] Alpha", 1.0, 1.0), user(2, "Bravo", 2.0, 2.0)], seq=1)
+    new = snapshot([user(1, "Alpha", 1.0, 1.0), user(2, "[PMC] Bravo", 2.5, 2.0)], seq=2)
+    query = radar.MapQuery(tags=("[PMC]",), fields=("id", "cs", "tags"))
+    delta = radar.delta_payload(old, new, query)
+    # Leaving or entering the tag filter is a removal or an addition.
+    assert delta["removed"] == ["1"]
+    assert delta["added"] == [{"id": 2, "cs": "[PMC] Bravo", "tags": ["[PMC]"]}]
+    assert delta["changed"] == {}
+    assert apply(radar.keyed_view(old, query), delta) == radar.keyed_view(new, query)
+
+
+def test_unchanged_snapshot_gives_an_empty_delta():
+    users = [user(1, "Alpha", 1.0, 1.0)]
+    delta = radar.delta_payload(snapshot(users, seq=4), snapshot(users, seq=5), radar.MapQuery())
+    assert (delta["added"], delta["changed"], delta["removed"]) == ([], {}, [])
@@ -0,0 +1,42 @@
+"""GFR1 binary frames: encode_frame and decode_frame round trips."""
+import math
+
+import pytest
+
+import geofs_live_radar as radar
+from helpers import snapshot, user
+
+
+def test_frame_round_trip():
+    users = [user(1, "[PMC] Alpha", 51.5, -0.1, 3000.0, 45.0, 320.0),
+             user(2, "Bravo", -33.9, 151.2, 0.0, 359.0, 0.0, ac=3),
+             {"id": 3, "cs": "Charlie", "co": [10.0, 20.0, 500.0, None]}]
+    snap = snapshot(users, seq=42)
+    frame = radar.decode_frame(radar.encode_frame(snap, radar.MapQuery()))
+    assert (frame["seq"], frame["count"], frame["userCount"]) == (42, 3, 3)
+    assert frame["id"] == ["1", "2", "3"]
+    assert frame["cs"] == ["[PMC] Alpha", "Bravo", "Charlie"]
+    assert frame["tags"] == ["", "", ""]
+    assert list(frame["lat"]) == pytest.approx([51.5, -33.9, 10.0], abs=1e-4)
+    assert list(frame["lon"]) == pytest.approx([-0.1, 151.2, 20.0], abs=1e-4)
+    assert frame["alt"][0] == pytest.approx(3000.0 * radar.FT_PER_M, rel=1e-6)
+    assert frame["hdg"][0] == pytest.approx(45.0)
+    assert math.isnan(frame["hdg"][2]) and math.isnan(frame["speed"][2])
+    assert list(frame["acid"]) == [1, 2, radar.NO_U32]
+    assert list(frame["ac"]) == [7, 3, radar.NO_U16]
+
+    tagged = radar.decode_frame(radar.encode_frame(snap, radar.MapQuery(tags=("[PMC]", "[U]"))))
+    assert (tagged["id"], tagged["tags"], tagged["userCount"]) == (["1"], ["[PMC]"], 3)
+
+
+def test_frame_skips_invalid_users_and_rejects_foreign_bytes():
+    users = [user(1, "Alpha", 95.0, 0.0), user(2, "", 1.0, 1.0), user(3, "Charlie", 1.0, 2.0)]
+    frame = radar.decode_frame(radar.encode_frame(snapshot(users), radar.MapQuery()))
+    assert frame["id"] == ["3"]
+    with pytest.raises(ValueError):
+        radar.decode_frame(b"GFR0" + bytes(radar.FRAME_HEADER.size))
+
+
+def test_empty_frame():
+    frame = radar.decode_frame(radar.encode_frame(snapshot([]), radar.MapQuery()))
+    assert frame["count"] == 0 and frame["cs"] == []
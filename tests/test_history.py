@@ -0,0 +1,84 @@
+"""Track history: chunk encoding, trails, replay and the byte budget."""
+import pytest
+
+import geofs_live_radar as radar
+from helpers import snapshot, user
+
+
+def samples(n):
+    rows, row = [], (10_000, 5_150_000, -10_000, 9_000, 90, 300)
+    for i in range(n):
+        rows.append(row)
+        # Mixed step sizes push the columns into different delta widths.
+        row = (row[0] + 10 + i % 3, row[1] + 37 * i, row[2] - 70_000 * (i % 2), row[3] + (1 << 20) * (i % 5 == 0),
+               (row[4] + 1) % 360, radar.NO_VALUE if i % 7 == 0 else 300 + i)
+    return rows
+
+
+@pytest.mark.parametrize("n", [1, 2, 50])
+def test_samples_round_trip(n):
+    rows = samples(n)
+    assert radar.decode_samples(radar.encode_samples(rows)) == tuple(rows)
+
+
+def test_sample_at():
+    rows = samples(50)
+    blob = radar.encode_samples(rows)
+    assert radar.sample_at(blob, rows[0][0] - 1) is None
+    assert radar.sample_at(blob, rows[0][0]) == rows[0]
+    assert radar.sample_at(blob, rows[20][0]) == rows[20]
+    assert radar.sample_at(blob, rows[20][0] + 1) == rows[20]
+    assert radar.sample_at(blob, rows[-1][0] + 1000) == rows[-1]
+
+
+def fly(history, seconds, t0=1000.0):
+    for step in range(seconds):
+        history.record(snapshot([user(1, "Alpha", 10.0 + step / 100, 20.0, 1000.0 + step),
+                                 user(2, "Bravo", -5.0, 40.0, 200.0)], fetched_at=t0 + step))
+
+
+def test_trail_and_replay_across_open_and_closed_chunks():
+    history = radar.TrackHistory(seconds=600, max_bytes=1 << 20, chunk=8)
+    fly(history, 20)
+    meta, rows = history.trail("1", 1000.0, 1019.0)
+    assert meta == ("Alpha", 7, 1)
+    assert [r[0] for r in rows] == [10_000 + 10 * step for step in range(20)]
+    assert rows[12][1:4] == (1_012_000, 2_000_000, 1012)
+    assert history.stats()["chunks"] == 4   # 2 aircraft x 2 full chunks; the rest still open
+    replayed = {u["id"]: u for u in history.replay(1012.5).users}
+    assert replayed["1"]["co"] == [10.12, 20.0, 1012, 90]
+    assert set(replayed) == {"1", "2"}
+    assert history.replay(900.0).users == ()
+
+
+def test_a_missed_poll_closes_the_chunk():
+    history = radar.TrackHistory(seconds=600, max_bytes=1 << 20, chunk=64)
+    fly(history, 3)
+    history.record(snapshot([user(2, "Bravo", -5.0, 40.0)], fetched_at=1003.0))
+    fly(history, 3, t0=1004.0)
+    _, rows = history.trail("1", 0, 2000)
+    assert len(rows) == 6
+    assert [c.blob is not None for c in history.tracks["1"].chunks] == [True, False]
+
+
+def test_budget_counts_open_and_closed_chunks():
+    history = radar.TrackHistory(seconds=10_000, max_bytes=16_000, chunk=8)
+    fly(history, 400)
+    stats = history.stats()
+    assert stats["evicted_chunks"] > 0
+    assert stats["bytes"] + stats["open_bytes"] <= history.max_bytes - history.decoded.max_bytes
+    assert history.bytes == sum(c.size() for c in history.closed)
+    assert history.open_bytes == sum(t.chunks[-1].size() for t in history.tracks.values()
+                                     if t.chunks and t.chunks[-1].blob is None)
+    _, rows = history.trail("1", 0, 2000)
+    assert rows[-1][0] == 13_990 and rows[0][0] > 10_000
+
+
+def test_decoded_chunks_stay_within_their_budget():
+    blobs = [radar.encode_samples([(t + i, *rest) for t, *rest in samples(10)]) for i in range(3)]
+    decoded = radar.DecodedChunks(max_bytes=25 * radar.DecodedChunks.ROW_BYTES)
+    for blob in blobs:
+        decoded.get(blob)
+    assert decoded.bytes == 20 * radar.DecodedChunks.ROW_BYTES   # the oldest went
+    decoded.discard(blobs[2])
+    assert decoded.bytes == 10 * radar.DecodedChunks.ROW_BYTES
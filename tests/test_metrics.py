@@ -0,0 +1,112 @@
+"""Metrics: merging workers' saved totals, retiring exited workers, endpoint labels."""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import geofs_live_radar as radar
+
+
+def registry(directory):
+    metrics = radar.Metrics(str(directory), save_every=60)
+    hits = metrics.add(radar.Tally("t_hits_total", "Hits", ("kind",)))
+    latency = metrics.add(radar.Histogram("t_seconds", "Latency", buckets=(0.1, 1)))
+    level = metrics.add(radar.Sampled("t_level", "Level", lambda: {(): 5}))
+    return metrics, hits, latency, level
+
+
+def dead_pid():
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+    return child.pid
+
+
+def save_as(directory, pid, dump):
+    with open(os.path.join(directory, f"{pid}.json"), "w") as f:
+        json.dump(dump, f)
+
+
+def totals(metrics):
+    return {m.name: values for m, values in metrics.collect()}
+
+
+def test_workers_are_summed_and_exited_ones_retired_once(tmp_path):
+    metrics, hits, latency, _ = registry(tmp_path)
+    hits.inc("a", n=2)
+    latency.observe(0.05)
+    live, dead = os.getppid(), dead_pid()
+    save_as(tmp_path, live, {"t_hits_total": [[["a"], 10], [["b"], 1]], "t_seconds": [[[], [1, 0, 0, 0.05]]],
+                             "t_level": [[[], 7]]})
+    save_as(tmp_path, dead, {"t_hits_total": [[["a"], 100]], "t_seconds": [[[], [0, 2, 0, 1.0]]],
+                             "t_level": [[[], 9]]})
+    expected = {"t_hits_total": {("a",): 112, ("b",): 1},
+                "t_seconds": {(): [2, 2, 0, pytest.approx(1.1)]},
+                "t_level": {(): 12}}   # a gauge of an exited worker is not kept
+    assert totals(metrics) == expected
+    assert not (tmp_path / f"{dead}.json").exists()
+    retired = json.loads((tmp_path / "retired.json").read_text())
+    assert retired == {"t_hits_total": [[["a"], 100]], "t_seconds": [[[], [0, 2, 0, 1.0]]]}
+    # Collecting again must not fold the exited worker in a second time.
+    assert totals(metrics) == expected
+    assert json.loads((tmp_path / "retired.json").read_text()) == retired
+
+
+def test_counters_survive_a_worker_exiting(tmp_path):
+    metrics, hits, _, _ = registry(tmp_path)
+    pids = [dead_pid(), dead_pid()]
+    save_as(tmp_path, pids[0], {"t_hits_total": [[["a"], 5]]})
+    assert totals(metrics)["t_hits_total"] == {("a",): 5}
+    save_as(tmp_path, pids[1], {"t_hits_total": [[["a"], 3], [["c"], 1]]})
+    assert totals(metrics)["t_hits_total"] == {("a",): 8, ("c",): 1}
+    hits.inc("a")
+    assert totals(metrics)["t_hits_total"] == {("a",): 9, ("c",): 1}
+
+
+def test_save_writes_this_workers_dump(tmp_path):
+    metrics, hits, _, _ = registry(tmp_path)
+    hits.inc("a")
+    metrics.save()
+    saved = json.loads((tmp_path / f"{os.getpid()}.json").read_text())
+    assert saved["t_hits_total"] == [[["a"], 1]] and saved["t_level"] == [[[], 5]]
+    assert totals(metrics)["t_hits_total"] == {("a",): 1}   # its own file is not added twice
+
+
+def counted(endpoint, status):
+    return radar.http_requests.values().get((endpoint, status), 0)
+
+
+def wsgi(method, path):
+    return radar.app.test_client().open(path, method=method).status_code
+
+
+def asgi(method, path):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"", "headers": []}
+    asyncio.run(radar.asgi_app(scope, receive, send))
+    return sent[0]["status"]
+
+
+@pytest.mark.parametrize("method, path, status, endpoint", [
+    ("POST", "/api/map", 405, "/api/map"),
+    ("DELETE", "/api/stream", 405, "/api/stream"),
+    ("PUT", "/assets/app.js", 405, "/assets/<name>"),
+    ("GET", "/nowhere", 404, "other"),
+    ("POST", "/nowhere", 404, "other"),
+    ("GET", "/assets/a/b", 404, "other"),
+    ("OPTIONS", "/api/map", 200, "/api/map"),
+])
+def test_both_modes_answer_and_label_alike(method, path, status, endpoint):
+    for serve in (wsgi, asgi):
+        before = counted(endpoint, status)
+        assert serve(method, path) == status, serve.__name__
+        assert counted(endpoint, status) == before + 1, serve.__name__
@@ -0,0 +1,76 @@
+"""The ?q= filter language: what it accepts, what it rejects, what it matches."""
+import pytest
+
+import geofs_live_radar as radar
+from helpers import snapshot
+
+USERS = [
+    {"id": 1, "cs": "[PMC] Viper", "ac": 7, "co": [51.5, -0.1, 7000.0, 90.0], "st": {"as": 450.0}},
+    {"id": 2, "cs": "[U] Cub", "ac": 2, "co": [51.6, -0.2, 300.0, 270.0], "st": {"as": 90.0}},
+    {"id": 3, "cs": "Nomad", "ac": 22, "co": [-33.9, 151.2, 1000.0, 180.0], "st": {"as": 120.0}},
+]
+
+
+def matching(q, users=USERS):
+    return [u["id"] for u in radar.compile_filter(q).apply(snapshot(users).columns)]
+
+
+@pytest.mark.parametrize("q, ids", [
+    ("tag:[PMC]", [1]),
+    ("tag:[pmc],[u]", [1, 2]),
+    ("cs:cub", [2]),
+    ("nomad", [3]),
+    ("type:F-16", [1]),
+    ("type:2,22", [2, 3]),
+    ("alt>20000", [1]),
+    ("alt>2000m", [1]),
+    ("speed<=120", [2, 3]),
+    ("hdg>=180", [2, 3]),
+    ("hdg=90", [1]),
+    ("hdg!=90", [2, 3]),
+    ("-tag:[PMC]", [2, 3]),
+    ("tag:[PMC],[U] -alt<1000", [1]),
+    ("near:51.5,-0.1,20nm", [1, 2]),
+    ("near:51.5,-0.1,1km", [1]),
+    ("near:-33.9,151.2,5mi", [3]),
+    ("'cs:[PMC] Viper'", [1]),
+])
+def test_filter_matches(q, ids):
+    assert matching(q) == ids
+
+
+@pytest.mark.parametrize("q", ["", "   "])
+def test_empty_query_has_no_filter(q):
+    assert radar.compile_filter(q) is None
+    assert radar.parse_filter({"q": q}) is None
+
+
+def test_equivalent_queries_share_a_key():
+    a = radar.compile_filter("alt>20000  tag:[u],[pmc]")
+    b = radar.compile_filter("TAG:[PMC],[U] altitude>20000ft")
+    assert a.key == b.key
+    assert radar.parse_filter({"q": "tag:[pmc],[u] alt>20000"}) == a.key
+    assert radar.compile_filter(a.key).key == a.key
+
+
+@pytest.mark.parametrize("q", [
+    "tag:",
+    "tag:,",
+    "cs:",
+    "type:no-such-plane",
+    "near:1,2",
+    "near:x,2,3",
+    "near:91,0,10",
+    "near:0,0,0",
+    "near:0,0,10parsecs",
+    "near:nan,0,10",
+    "colour:red",
+    "wingspan>30",
+    "speed>400mph",
+    "alt>>3",
+    "alt>",
+    "'unterminated",
+])
+def test_rejected_queries(q):
+    with pytest.raises(ValueError):
+        radar.compile_filter(q)
@@ -0,0 +1,96 @@
+"""ResultCache: single-flight builds and size/byte-bounded LRU eviction."""
+import threading
+import time
+
+import pytest
+
+import geofs_live_radar as radar
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_concurrent_misses_build_once():
+    cache = radar.ResultCache(size=8, max_bytes=1 << 20)
+    release = threading.Event()
+    builds = []
+
+    def build():
+        builds.append(1)
+        release.wait(5)
+        return radar.Encoded(b"answer")
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(("full", 1, "q"), build)))
+               for _ in range(2)]
+    threads[0].start()
+    wait_for(lambda: builds)
+    threads[1].start()
+    wait_for(lambda: cache.waits == 1)
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(builds) == 1
+    assert results[0] is results[1]
+    # The waiter picks the finished answer up as a hit.
+    assert (cache.misses, cache.waits, cache.hits) == (1, 1, 1)
+
+
+def test_a_waiter_builds_itself_if_the_builder_fails():
+    cache = radar.ResultCache(size=8, max_bytes=1 << 20)
+    release = threading.Event()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("boom")
+
+    errors = []
+
+    def first():
+        try:
+            cache.get("k", failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    t = threading.Thread(target=first)
+    t.start()
+    started.wait(5)
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(cache.get("k", lambda: b"second")))
+    waiter.start()
+    wait_for(lambda: cache.waits == 1)
+    release.set()
+    t.join()
+    waiter.join()
+    assert len(errors) == 1 and result == [b"second"]
+    assert cache.misses == 2
+
+
+def test_bytes_limit_evicts_the_least_recently_used():
+    cache = radar.ResultCache(size=100, max_bytes=100)
+    cache.get("a", lambda: b"x" * 40)
+    cache.get("b", lambda: radar.Encoded(b"y" * 40))
+    assert cache.bytes == 80
+    cache.get("a", pytest.fail)                   # "a" is now the most recent
+    cache.get("c", lambda: b"z" * 40)
+    assert cache.bytes == 80 and cache.evictions == 1
+    assert list(cache._entries) == ["a", "c"]
+    cache.get("big", lambda: b"w" * 101)          # larger than the whole budget: not kept
+    assert cache.bytes == 80 and "big" not in cache._entries
+    assert cache.stats()["entries"] == 2
+
+
+def test_size_limit_evicts_the_oldest():
+    cache = radar.ResultCache(size=2, max_bytes=1 << 20)
+    for key in "abc":
+        cache.get(key, lambda: b"v" * 10)
+    assert list(cache._entries) == ["b", "c"]
+    assert (cache.bytes, cache.evictions) == (20, 1)
+    cache.clear()
+    assert cache.bytes == 0 and not cache._entries
@@ -0,0 +1,93 @@
+"""SnapshotCache: one upstream fetch per TTL across threads and worker processes."""
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+import geofs_live_radar as radar
+
+needs_flock = pytest.mark.skipif(radar.fcntl is None, reason="no fcntl: single-flight is per process")
+
+
+def stale_cache_dir(tmp_path, ttl):
+    """A CACHE_DIR holding an entry that went stale `ttl` seconds ago."""
+    radar.SnapshotCache(None, ttl, str(tmp_path))._write_shared((b"old", time.time() - 2 * ttl, 7))
+    return str(tmp_path)
+
+
+@needs_flock
+def test_concurrent_misses_share_one_fetch(tmp_path):
+    directory = stale_cache_dir(tmp_path, ttl=5)
+    calls = []
+    start = threading.Barrier(4)
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return b"new"
+
+    # One cache per simulated worker, so only the file lock can collapse the fetches.
+    caches = [radar.SnapshotCache(fetch, 5, directory) for _ in range(4)]
+    results = [None] * len(caches)
+
+    def run(i):
+        start.wait()
+        results[i] = caches[i].get()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(caches))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert {(body, seq) for body, _, seq in results} == {(b"new", 8)}
+
+
+def _worker(directory, counter, start, out):
+    def fetch():
+        with counter.get_lock():
+            counter.value += 1
+        time.sleep(0.2)
+        return b"new"
+    cache = radar.SnapshotCache(fetch, 5, directory)
+    start.wait()
+    body, _, seq = cache.get()
+    out.put((body, seq))
+
+
+@needs_flock
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_misses_across_processes_share_one_fetch(tmp_path):
+    directory = stale_cache_dir(tmp_path, ttl=5)
+    ctx = multiprocessing.get_context("fork")
+    counter, start, out = ctx.Value("i", 0), ctx.Barrier(3), ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(directory, counter, start, out)) for _ in range(3)]
+    for p in workers:
+        p.start()
+    results = [out.get(timeout=10) for _ in workers]
+    for p in workers:
+        p.join(10)
+    assert counter.value == 1
+    assert set(results) == {(b"new", 8)}
+
+
+def test_fresh_entry_is_served_without_a_fetch(tmp_path):
+    def fetch():
+        raise AssertionError("fetched while fresh")
+
+    writer = radar.SnapshotCache(lambda: b"body", 5, str(tmp_path))
+    first = writer.get()
+    assert writer.get() is first   # fresh in memory
+    if radar.fcntl is not None:
+        # A sibling worker picks the fresh copy up from disk.
+        assert radar.SnapshotCache(fetch, 5, str(tmp_path)).get() == first
+
+
+def test_stale_entry_is_refetched_with_the_next_seq(tmp_path):
+    calls = []
+    cache = radar.SnapshotCache(lambda: calls.append(1) or b"v%d" % len(calls), 0.05, str(tmp_path))
+    assert cache.get()[::2] == (b"v1", 1)
+    time.sleep(0.06)
+    assert cache.get()[::2] == (b"v2", 2)
+    assert len(calls) == 2
@@ -0,0 +1,52 @@
+"""?bbox= parsing and the per-snapshot spatial grid."""
+import random
+
+import pytest
+
+import geofs_live_radar as radar
+from helpers import snapshot, user
+
+
+def bbox(text):
+    return radar.parse_bbox({"bbox": text})
+
+
+def test_parse_bbox():
+    assert bbox(None) is None
+    assert bbox("10,20,30,40") == (10.0, 30.0, ((20.0, 40.0),))
+    assert bbox("-100,0,100,10") == (-90.0, 90.0, ((0.0, 10.0),))
+    assert bbox("0,-200,10,200") == (0.0, 10.0, ((-180.0, 180.0),))
+    assert bbox("0,170,10,190") == (0.0, 10.0, ((170.0, 180.0), (-180.0, -170.0)))
+    assert bbox("0,170,10,-170") == (0.0, 10.0, ((170.0, 180.0), (-180.0, -170.0)))
+    assert bbox("0,0,10,180") == (0.0, 10.0, ((0.0, 180.0),))
+
+
+@pytest.mark.parametrize("text", ["30,20,10,40", "a,0,1,1", "0,0,1", "0,0,1,1,2", "0,nan,1,1",
+                                  "0,0,inf,1", "0,,1,1"])
+def test_malformed_bbox_is_rejected(text):
+    with pytest.raises(ValueError):
+        bbox(text)
+
+
+def test_box_across_the_antimeridian_has_both_sides():
+    users = [user(1, "East", 5.0, 179.5), user(2, "West", 5.0, -179.5), user(3, "Middle", 5.0, 0.0),
+             user(4, "North", 50.0, 179.5), user(5, "Edge", 5.0, 180.0)]
+    snap = snapshot(users)
+    for text in ("0,170,10,190", "0,170,10,-170"):
+        assert [u["id"] for u in snap.grid.query(bbox(text))] == [1, 2, 5]
+
+
+def test_grid_matches_a_brute_force_filter():
+    rng = random.Random(7)
+    users = [user(i, f"F{i}", rng.uniform(-90, 90), rng.uniform(-180, 180)) for i in range(3000)]
+    users += [user(3000 + i, f"P{i}", lat, lon) for i, (lat, lon) in
+              enumerate([(90.0, 180.0), (-90.0, -180.0), (0.0, 180.0), (0.0, -180.0)])]
+    snap = snapshot(users)
+    boxes = ["-10,-10,10,10", "40,100,60,-120", "-90,-180,90,180", "89,179,90,180", "-5,175,5,185",
+             "20,-30,20.5,-29.5", "-60,-200,-50,-150"]
+    boxes += [",".join(f"{v:.3f}" for v in (lat, lon, lat + rng.uniform(0, 40), lon + rng.uniform(0, 120)))
+              for lat, lon in ((rng.uniform(-90, 60), rng.uniform(-180, 180)) for _ in range(30))]
+    for text in boxes:
+        box = bbox(text)
+        expected = [u for u in snap.valid_users if radar.in_bbox(box, *radar.position(u))]
+        assert snap.grid.query(box) == expected, text
@@ -0,0 +1,140 @@
+"""Circuit breaker transitions and failover in the upstream pool."""
+import itertools
+
+import pytest
+
+import geofs_live_radar as radar
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(radar.time, "monotonic", clock)
+    return clock
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    health = radar.EndpointHealth(window=20, max_failures=3, cooldown=15)
+    health.failed()
+    health.succeeded(0.1)   # a success resets the run of failures
+    health.failed()
+    health.failed()
+    assert health.state() == "closed" and health.acquire()
+    health.failed()
+    assert health.state() == "open" and health.opens == 1
+    assert not health.acquire()
+
+
+def test_half_open_allows_one_trial(clock):
+    health = radar.EndpointHealth(window=20, max_failures=1, cooldown=15)
+    health.failed()
+    clock.now += 14.9
+    assert health.state() == "open"
+    clock.now += 0.1
+    assert health.state() == "half-open"
+    assert health.acquire()
+    assert not health.acquire()   # the trial is taken
+    health.release()              # ... and given back unused
+    assert health.acquire()
+
+
+def test_trial_success_closes_and_failure_reopens(clock):
+    health = radar.EndpointHealth(window=20, max_failures=1, cooldown=15)
+    health.failed()
+    clock.now += 15
+    assert health.acquire()
+    health.failed()
+    assert health.state() == "open" and health.opens == 2
+    clock.now += 14
+    assert health.state() == "open"   # the cooldown starts over
+    clock.now += 1
+    assert health.acquire()
+    health.succeeded(0.2)
+    assert health.state() == "closed" and health.failures == 0
+    assert health.acquire() and health.acquire()
+
+
+class ScriptedClient:
+    """Stand-in UpstreamClient that answers from a per-URL script."""
+
+    scripts = {}
+
+    def __init__(self, url, *args):
+        self.url = url
+        self.answers = iter(self.scripts[url])
+
+    def fetch(self):
+        answer = next(self.answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def stats(self):
+        return {"backend": "test", "http_version": None, "requests": 0, "errors": 0, "handshakes": 0}
+
+
+class ScriptedPool(radar.UpstreamPool):
+    client_class = ScriptedClient
+
+
+def test_pool_fails_over_and_skips_open_endpoints(clock):
+    ScriptedClient.scripts = {"a": itertools.repeat(OSError("down")), "b": itertools.repeat(b"ok")}
+    pool = ScriptedPool(["a", "b"], 1, 1, 1, False, hedge=False)
+    # Both endpoints start out equal, so "a" goes first and fails over to "b".
+    assert pool.fetch() == b"ok"
+    assert pool.failovers == 1
+    assert pool.candidates() == [1, 0]   # "a" is ranked down after failing
+    for _ in range(radar.BREAKER_FAILURES - 1):
+        pool.health[0].failed()
+    assert pool.candidates() == [1]
+    assert pool.fetch() == b"ok"
+    assert pool.failovers == 1
+
+
+def test_pool_rejects_when_every_circuit_is_open(clock):
+    ScriptedClient.scripts = {"a": itertools.repeat(OSError("down"))}
+    pool = ScriptedPool(["a"], 1, 1, 1, False, hedge=False)
+    # A lone endpoint is tried twice per fetch.
+    for _ in range(-(-radar.BREAKER_FAILURES // 2)):
+        with pytest.raises(OSError):
+            pool.fetch()
+    assert pool.health[0].state() == "open"
+    with pytest.raises(RuntimeError):
+        pool.fetch()
+    assert pool.rejected == 1
+
+
+def test_hedges_leave_a_thread_for_the_next_fetch(monkeypatch):
+    release = radar.threading.Event()
+
+    class Hanging(ScriptedClient):
+        def fetch(self):
+            answer = next(self.answers)
+            if answer is None:
+                release.wait(0.5)
+                return b"late"
+            return answer
+
+    class Pool(radar.UpstreamPool):
+        client_class = Hanging
+
+    # Every first attempt hangs and every hedge answers at once, so each
+    # fetch leaves a straggler holding a thread.
+    Hanging.scripts = {"a": itertools.cycle([None, b"ok"])}
+    pool = Pool(["a"], 1, 1, 1, False)
+    monkeypatch.setattr(pool, "hedge_delay", lambda i: 0.01)
+    try:
+        for _ in range(pool.workers + 2):
+            assert pool.fetch() in (b"ok", b"late")
+            assert pool._busy < pool.workers
+        assert pool.hedge_skipped > 0
+    finally:
+        release.set()
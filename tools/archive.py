@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Query and compact the on-disk track archive (ARCHIVE_DIR).
+
+    python tools/archive.py info
+    python tools/archive.py trail 5000003 --from 2026-10-16T18:00 --to 2026-10-16T19:30
+    python tools/archive.py window --from -600 > last10min.jsonl
+    python tools/archive.py compact --merge 86400 --keep-days 14
+
+Times are unix seconds, ISO dates (local time unless they carry an offset),
+or negative seconds before now. Trails and windows are printed as JSON lines.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geofs_live_radar as radar  # noqa: E402
+
+def when(text):
+    try:
+        t = float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    return time.time() + t if t < 0 else t
+
+def clean(v):
+    return None if math.isnan(v) else round(v, 1)
+
+def point(row):
+    t, lat, lon, alt, hdg, spd, ac = row
+    return {"t": t, "lat": round(lat, 6), "lon": round(lon, 6), "alt": clean(alt),
+            "hdg": clean(hdg), "spd": clean(spd), "ac": None if ac == radar.NO_U16 else ac}
+
+def cmd_info(reader, args):
+    for seg in reader.segments():
+        rows = sum(b[1] for b in seg.blocks)
+        ids = len(seg.ids) if seg.ids is not None else "-"
+        print(f"{os.path.basename(seg.path):28} {'sealed' if seg.sealed else 'open  '} "
+              f"{datetime.datetime.fromtimestamp(seg.start):%Y-%m-%d %H:%M} "
+              f"{seg.end - seg.start:6}s blocks={len(seg.blocks):5} rows={rows:10} ids={ids} "
+              f"bytes={os.path.getsize(seg.path)}")
+
+def cmd_trail(reader, args):
+    started = time.perf_counter()
+    cs, rows = reader.trail(args.id, args.t_from, args.t_to)
+    for row in rows:
+        print(json.dumps({"id": args.id, "cs": cs, **point(row)}))
+    print(f"{len(rows)} points in {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+
+def cmd_window(reader, args):
+    started = time.perf_counter()
+    n = 0
+    for key, cs, *row in reader.window_rows(args.t_from, args.t_to):
+        print(json.dumps({"id": key, "cs": cs, **point(row)}))
+        n += 1
+    print(f"{n} points in {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+
+def cmd_compact(reader, args):
+    keep = args.keep_days * 86400 if args.keep_days else None
+    read, written, before, after = radar.compact_archive(
+        reader.directory, reader.window, args.merge, keep, args.block_rows)
+    print(f"compacted {read} segments into {written}: {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--dir", default=radar.ARCHIVE_DIR or None, help="archive directory (default: ARCHIVE_DIR)")
+    ap.add_argument("--window", type=int, default=radar.ARCHIVE_SEGMENT_SECONDS,
+                    help="segment length the writer used (ARCHIVE_SEGMENT_SECONDS)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("info", help="list segments")
+    for name in ("trail", "window"):
+        p = sub.add_parser(name, help=f"print a {name} as JSON lines")
+        if name == "trail":
+            p.add_argument("id", help="aircraft id, as in /api/map")
+        p.add_argument("--from", dest="t_from", type=when, default=-math.inf)
+        p.add_argument("--to", dest="t_to", type=when, default=math.inf)
+    p = sub.add_parser("compact", help="rewrite finished segments with full blocks")
+    p.add_argument("--merge", type=int, help="merge segments into windows of this many seconds")
+    p.add_argument("--keep-days", type=float, help="drop rows older than this")
+    p.add_argument("--block-rows", type=int, default=65536)
+    args = ap.parse_args()
+    if not args.dir:
+        ap.error("set ARCHIVE_DIR or pass --dir")
+    reader = radar.ArchiveReader(args.dir, args.window)
+    {"info": cmd_info, "trail": cmd_trail, "window": cmd_window, "compact": cmd_compact}[args.cmd](reader, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Compare the columnar track archive with a naive JSON-lines log.
+
+    python tools/bench_archive.py                       # 2000 aircraft, 6 h at one sample / 5 s
+    python tools/bench_archive.py --aircraft 5000 --hours 24
+
+Writes the same synthetic flights both ways into a temporary directory and
+reports ingest rate, size on disk, and the latency of one aircraft's trail
+over an hour and of a ten-second whole-world window (indexes already
+loaded), before and after compaction. The JSON-lines side has no index, so every query reads the log.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geofs_live_radar as radar  # noqa: E402
+from synthetic import make_users, step  # noqa: E402
+
+def jsonl_trail(path, key, t_from, t_to):
+    out = []
+    with open(path) as f:
+        for line in f:
+            row = json.loads(line)
+            if row["id"] == key and t_from <= row["t"] <= t_to:
+                out.append(row)
+    return out
+
+def jsonl_window(path, t_from, t_to):
+    with open(path) as f:
+        return [row for row in map(json.loads, f) if t_from <= row["t"] <= t_to]
+
+def timed(fn, reps, warm=True):
+    if warm:
+        fn()  # loads the segment indexes
+    t = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - t) / reps * 1000
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--aircraft", type=int, default=2000)
+    ap.add_argument("--hours", type=float, default=6)
+    ap.add_argument("--every", type=float, default=radar.ARCHIVE_EVERY)
+    ap.add_argument("--reps", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rnd = random.Random(args.seed)
+    users = make_users(args.aircraft, args.seed)
+    ticks = int(args.hours * 3600 / args.every)
+    start = (time.time() - args.hours * 3600) // 3600 * 3600
+    tmp = tempfile.mkdtemp(prefix="radar-archive-")
+    try:
+        archive = radar.TrackArchive(os.path.join(tmp, "archive"), radar.ARCHIVE_SEGMENT_SECONDS,
+                                     args.every, radar.ARCHIVE_FLUSH_SECONDS)
+        log = os.path.join(tmp, "tracks.jsonl")
+        snaps = []
+        for i in range(ticks):
+            step(users, rnd, args.every)
+            seen = tuple(dict(u, co=list(u["co"])) for u in users)
+            snaps.append(radar.Snapshot(None, seen, len(seen), start + i * args.every, i))
+        flush_every = max(1, int(radar.ARCHIVE_FLUSH_SECONDS / args.every))
+
+        t = time.perf_counter()
+        for i, snap in enumerate(snaps):
+            archive.record(snap)
+            if i % flush_every == flush_every - 1:
+                archive.flush()
+        archive.flush()
+        archive_ingest = time.perf_counter() - t
+
+        t = time.perf_counter()
+        with open(log, "w") as f:
+            for snap in snaps:
+                for u in snap.users:
+                    row = radar.archive_row(u, snap.fetched_at)
+                    if row is not None:
+                        key, cs, ts, lat, lon, alt, hdg, spd, ac = row
+                        f.write(json.dumps({"id": key, "cs": cs, "t": ts, "lat": lat, "lon": lon,
+                                            "alt": alt, "hdg": hdg, "spd": spd, "ac": ac}) + "\n")
+        jsonl_ingest = time.perf_counter() - t
+
+        rows = archive.rows
+        key = radar.aircraft_id(users[0])
+        mid = start + args.hours * 1800
+        reader = radar.ArchiveReader(archive.directory, radar.ARCHIVE_SEGMENT_SECONDS)
+
+        def archive_size():
+            d = archive.directory
+            return sum(os.path.getsize(os.path.join(d, n)) for n in os.listdir(d) if n.endswith(".seg"))
+
+        def archive_queries():
+            return (timed(lambda: reader.trail(key, mid - 1800, mid + 1800), args.reps),
+                    timed(lambda: list(reader.window_rows(mid, mid + 10)), args.reps))
+
+        print(f"aircraft={args.aircraft} hours={args.hours} every={args.every}s rows={rows}")
+        print(f"  ingest rows/s       archive {rows / archive_ingest:12.0f}   jsonl {rows / jsonl_ingest:12.0f}")
+        before = archive_size()
+        trail_ms, window_ms = archive_queries()
+        for seg in reader.segments():
+            if not seg.sealed:
+                archive.seal(seg.start)
+        radar.compact_archive(archive.directory, radar.ARCHIVE_SEGMENT_SECONDS, now=start + 10 * 86400)
+        reader = radar.ArchiveReader(archive.directory, radar.ARCHIVE_SEGMENT_SECONDS)
+        after = archive_size()
+        ctrail_ms, cwindow_ms = archive_queries()
+        jtrail_ms = timed(lambda: jsonl_trail(log, key, mid - 1800, mid + 1800), 1, warm=False)
+        jwindow_ms = timed(lambda: jsonl_window(log, mid, mid + 10), 1, warm=False)
+        print(f"  bytes per row       archive {before / rows:12.1f}   compacted {after / rows:10.1f}"
+              f"   jsonl {os.path.getsize(log) / rows:10.1f}")
+        print(f"  1 h trail (ms)      archive {trail_ms:12.2f}   compacted {ctrail_ms:10.2f}   jsonl {jtrail_ms:10.1f}")
+        print(f"  10 s window (ms)    archive {window_ms:12.2f}   compacted {cwindow_ms:10.2f}   jsonl {jwindow_ms:10.1f}")
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
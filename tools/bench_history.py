@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Measure the track history behind /api/history and /api/replay.
+
+    python tools/bench_history.py                        # 2000 aircraft, one hour at 1 Hz
+    python tools/bench_history.py --aircraft 5000 --seconds 600 --max-mb 16
+
+Feeds synthetic snapshots (one per simulated second) into a TrackHistory and
+reports record time per snapshot, memory used per sample against a naive
+list of float tuples, and trail / whole-world replay latency. With --max-mb
+below what the run needs, it also shows eviction keeping within the budget.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geofs_live_radar as radar  # noqa: E402
+from synthetic import make_users, step  # noqa: E402
+
+# sys.getsizeof of a 6-tuple of floats plus its six float objects.
+NAIVE_SAMPLE_BYTES = sys.getsizeof((0.0,) * 6) + 6 * sys.getsizeof(0.0)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--aircraft", type=int, default=2000)
+    ap.add_argument("--seconds", type=int, default=3600, help="simulated seconds, one snapshot each")
+    ap.add_argument("--max-mb", type=float, default=radar.HISTORY_MAX_BYTES / 2**20)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rnd = random.Random(args.seed)
+    users = make_users(args.aircraft, args.seed)
+    hist = radar.TrackHistory(args.seconds, int(args.max_mb * 2**20),
+                              radar.HISTORY_CHUNK, radar.HISTORY_MAX_GAP)
+    start = time.time() - args.seconds
+    for i in range(args.seconds):
+        step(users, rnd)
+        # Drop a few aircraft from each snapshot so chunks also close on gaps.
+        seen = [u for u in users if rnd.random() > 0.01]
+        hist.record(radar.Snapshot(None, tuple(seen), len(seen), start + i, i))
+    stats = hist.stats()
+
+    keys = list(hist.tracks)
+    trail, world = [], []
+    for _ in range(args.queries):
+        key = rnd.choice(keys)
+        t = time.perf_counter()
+        hist.trail(key, start, start + args.seconds)
+        trail.append(time.perf_counter() - t)
+    for _ in range(max(1, args.queries // 20)):
+        at = start + rnd.uniform(0, args.seconds)
+        t = time.perf_counter()
+        hist.replay(at)
+        world.append(time.perf_counter() - t)
+
+    closed = stats["samples"] - stats["open_samples"]
+    print(f"aircraft={args.aircraft} snapshots={args.seconds} budget={args.max_mb:.1f} MB")
+    print(f"  record per snapshot  mean {stats['timings_ms']['record']['mean']:8.3f} ms"
+          f"  max {stats['timings_ms']['record']['max']:8.3f} ms")
+    print(f"  samples kept         {stats['samples']:12} ({closed} in closed chunks)")
+    print(f"  closed chunk bytes   {stats['bytes'] / 2**20:12.2f} MB")
+    print(f"  open chunk bytes     {stats['open_bytes'] / 2**20:12.2f} MB")
+    print(f"  decoded chunk cache  {stats['decoded_bytes'] / 2**20:12.2f} MB")
+    print(f"  bytes per sample     {stats['bytes_per_sample']:12.2f}"
+          f"  (naive float tuples: {NAIVE_SAMPLE_BYTES})")
+    print(f"  evicted chunks       {stats['evicted_chunks']:12}")
+    print(f"  trail query          p50 {percentile(trail, 0.5):8.3f} ms  p95 {percentile(trail, 0.95):8.3f} ms")
+    print(f"  replay (whole world) p50 {percentile(world, 0.5):8.3f} ms  p95 {percentile(world, 0.95):8.3f} ms")
+
+if __name__ == "__main__":
+    main()
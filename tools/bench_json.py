@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Time each JSON backend on the work the server does per snapshot.
+
+    python tools/bench_json.py                        # synthetic 2000/5000/20000 aircraft
+    python tools/bench_json.py --payload map1.json map2.json
+
+For every backend in JSON_BACKENDS (the stdlib, plus orjson when it is
+installed) reports the time to parse one upstream /map payload and to
+encode the answers /api/map builds from it: the full list and the list
+filtered to DEFAULT_TAGS. Record real payloads with e.g.
+`curl -X POST -d '{}' https://mps.geo-fs.com/map > map.json`.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geofs_live_radar as radar  # noqa: E402
+from synthetic import make_payload  # noqa: E402
+
+def timed(fn, reps):
+    fn()
+    t = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - t) / reps * 1000
+
+def bench(body, reps):
+    snap = radar.Snapshot.parse(body, time.time(), 1)
+    full = radar.full_payload(snap, radar.MapQuery(fields=("ac", "acid", "co", "cs", "id", "st.as")))
+    tags = tuple(sorted({t.upper() for t in radar.DEFAULT_TAGS}))
+    tagged = radar.full_payload(snap, radar.MapQuery(tags=tags))
+    rows = {}
+    for name, (decode, encode) in radar.JSON_BACKENDS.items():
+        rows[name] = {
+            "parse_ms": timed(lambda: decode(body), reps),
+            "encode_full_ms": timed(lambda: encode(full), reps),
+            "encode_tagged_ms": timed(lambda: encode(tagged), reps),
+            "full_bytes": len(encode(full)),
+            "tagged_bytes": len(encode(tagged)),
+        }
+    return len(snap.users), rows
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--payload", nargs="+", help="recorded upstream /map responses (JSON)")
+    ap.add_argument("--aircraft", type=int, nargs="+", default=[2000, 5000, 20000])
+    ap.add_argument("--reps", type=int, default=20)
+    args = ap.parse_args()
+    if args.payload:
+        bodies = []
+        for path in args.payload:
+            with open(path, "rb") as f:
+                bodies.append((path, f.read()))
+    else:
+        bodies = [(f"synthetic-{n}", make_payload(n)) for n in args.aircraft]
+    print(f"server backend: {radar.JSON_BACKEND}")
+    for name, body in bodies:
+        count, rows = bench(body, args.reps)
+        print(f"{name}: {count} aircraft, {len(body)} bytes")
+        keys = next(iter(rows.values())).keys()
+        print(f"  {'':18}" + "".join(f"{backend:>12}" for backend in rows))
+        for key in keys:
+            cells = (rows[b][key] for b in rows)
+            print(f"  {key:18}" + "".join(f"{v:12.3f}" if isinstance(v, float) else f"{v:12}" for v in cells))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Measure snapshot-refresh latency against flaky upstream mirrors, with and without hedging.
+
+    python tools/bench_upstream.py --mirrors 2 --slow-p 0.1 --slow-delay 1.5
+    python tools/bench_upstream.py --mirrors 3 --dead 1 --fetches 100
+
+Starts --mirrors stand-in upstreams (tools/fake_upstream.py). Each one
+answers after --delay seconds, slows --slow-p of its answers down by
+--slow-delay more and fails --fail-p of them with a 503, independently of
+the others; the first --dead mirrors fail every request. The same fetch
+sequence then runs through the server's UpstreamPool once with hedging off
+and once with it on, and the tool prints latency percentiles, errors, and
+the pool's hedge, failover and circuit breaker counters.
+"""
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geofs_live_radar as radar  # noqa: E402
+from fake_upstream import serve  # noqa: E402
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run(urls, hedge, args):
+    pool = radar.UpstreamPool(urls, radar.CONNECT_TIMEOUT, radar.READ_TIMEOUT, radar.UPSTREAM_POOL_SIZE,
+                              radar.UPSTREAM_HTTP2, hedge)
+    latencies, errors = [], 0
+    for _ in range(args.fetches):
+        started = time.monotonic()
+        try:
+            pool.fetch()
+            latencies.append(time.monotonic() - started)
+        except Exception:
+            errors += 1
+        time.sleep(args.interval)
+    return latencies, errors, pool.stats()
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--mirrors", type=int, default=2)
+    ap.add_argument("--aircraft", type=int, default=500)
+    ap.add_argument("--delay", type=float, default=0.05, help="seconds every answer takes")
+    ap.add_argument("--slow-p", type=float, default=0.1, help="chance that an answer is slowed down")
+    ap.add_argument("--slow-delay", type=float, default=1.5, help="seconds added to a slowed answer")
+    ap.add_argument("--fail-p", type=float, default=0.0, help="chance that an answer is a 503")
+    ap.add_argument("--dead", type=int, default=0, help="mirrors that fail every request")
+    ap.add_argument("--fetches", type=int, default=200)
+    ap.add_argument("--interval", type=float, default=0.0, help="seconds between fetches")
+    args = ap.parse_args()
+
+    servers, urls = [], []
+    for n in range(args.mirrors):
+        port = free_port()
+        fail_p = 1.0 if n < args.dead else args.fail_p
+        servers.append(serve(port, args.aircraft, args.delay, 0.0, n + 1, "127.0.0.1",
+                             args.slow_p, args.slow_delay, fail_p))
+        urls.append(f"http://127.0.0.1:{port}/map")
+    try:
+        for hedge in (False, True):
+            latencies, errors, stats = run(urls, hedge, args)
+            print(f"hedging {'on' if hedge else 'off'}: {args.fetches} fetches over {len(urls)} mirrors")
+            for q in (0.5, 0.95, 0.99, 1.0):
+                value = radar.percentile(latencies, q)
+                label = "max" if q == 1.0 else f"p{round(q * 100)}"
+                print(f"  {label:10} {value * 1000:9.1f} ms" if value is not None else f"  {label:10}        -")
+            print(f"  errors     {errors:9}")
+            print(f"  hedged     {stats['hedged']:9}  (won {stats['hedge_wins']}, skipped {stats['hedge_skipped']})")
+            print(f"  failovers  {stats['failovers']:9}")
+            for ep in stats["endpoints"]:
+                print(f"  {ep['url']}  {ep['state']:9} requests {ep['requests']:5}  errors {ep['errors']:5}"
+                      f"  opens {ep['opens']}")
+    finally:
+        for server in servers:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
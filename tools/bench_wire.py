@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Compare the JSON and binary-frame wire formats for /api/map.
+
+    python tools/bench_wire.py                   # synthetic 2000/5000/20000 aircraft
+    python tools/bench_wire.py --payload map.json --tags "[U],[PMC]"
+
+Reports payload size (raw and gzip) and encode/decode time per snapshot.
+Decode is timed in Python, and also in Node with the page's own decodeFrame
+against JSON.parse when `node` is on PATH.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geofs_live_radar as radar  # noqa: E402
+from synthetic import make_payload  # noqa: E402
+
+NODE_BENCH = """
+const fs = require('fs');
+%(decoder)s
+function time(fn, reps) {
+  fn();
+  const t = process.hrtime.bigint();
+  for (let i = 0; i < reps; i++) fn();
+  return Number(process.hrtime.bigint() - t) / 1e6 / reps;
+}
+const jsonText = fs.readFileSync(process.argv[2], 'utf8');
+const b = fs.readFileSync(process.argv[3]);
+const buf = b.buffer.slice(b.byteOffset, b.byteOffset + b.length);
+const reps = +process.argv[4];
+const j = time(() => {
+  const d = JSON.parse(jsonText);
+  let s = 0;
+  for (const u of d.users) s += u.co[0] + u.co[1];
+  return s;
+}, reps);
+const f = time(() => {
+  const fr = decodeFrame(buf);
+  let s = 0;
+  for (let i = 0; i < fr.count; i++) s += fr.lat[i] + fr.lon[i];
+  return s;
+}, reps);
+console.log(JSON.stringify({json: j, frame: f}));
+"""
+
+def timed(fn, reps):
+    fn()
+    t = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - t) / reps * 1000
+
+def node_decode(json_body, frame, reps):
+    node = shutil.which("node")
+    if not node:
+        return None
+    decoder = re.search(r"(  const FRAME_HEADER_BYTES.*?\n  }\n)", radar.WORKER_JS, re.S).group(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, n) for n in ("bench.js", "map.json", "map.frame")]
+        with open(paths[0], "w") as f:
+            f.write(NODE_BENCH % {"decoder": decoder})
+        with open(paths[1], "wb") as f:
+            f.write(json_body)
+        with open(paths[2], "wb") as f:
+            f.write(frame)
+        out = subprocess.run([node, *paths, str(reps)], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+def bench(body, tags, reps):
+    snap = radar.Snapshot.parse(body, time.time(), 1)
+    query = radar.MapQuery(tags=tags)
+    json_body = radar.encode_json(radar.full_payload(snap, query))
+    frame = radar.encode_frame(snap, query)
+    row = {
+        "aircraft": radar.decode_frame(frame)["count"],
+        "json_bytes": len(json_body),
+        "json_gzip": len(gzip.compress(json_body, 6)),
+        "frame_bytes": len(frame),
+        "frame_gzip": len(gzip.compress(frame, 6)),
+        "json_encode_ms": timed(lambda: radar.encode_json(radar.full_payload(snap, query)), reps),
+        "frame_encode_ms": timed(lambda: radar.encode_frame(snap, query), reps),
+        "json_decode_ms": timed(lambda: json.loads(json_body), reps),
+        "frame_decode_ms": timed(lambda: radar.decode_frame(frame), reps),
+    }
+    js = node_decode(json_body, frame, reps * 5)
+    if js:
+        row["js_json_decode_ms"] = js["json"]
+        row["js_frame_decode_ms"] = js["frame"]
+    return row
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--payload", help="recorded upstream /map response (JSON)")
+    ap.add_argument("--aircraft", type=int, nargs="+", default=[2000, 5000, 20000])
+    ap.add_argument("--tags", help="comma-separated tag filter applied before encoding")
+    ap.add_argument("--reps", type=int, default=20)
+    args = ap.parse_args()
+    tags = tuple(sorted({t.strip().upper() for t in args.tags.split(",")} - {""})) if args.tags else None
+    if args.payload:
+        with open(args.payload, "rb") as f:
+            bodies = [(args.payload, f.read())]
+    else:
+        bodies = [(f"synthetic-{n}", make_payload(n)) for n in args.aircraft]
+    for name, body in bodies:
+        row = bench(body, tags, args.reps)
+        print(name)
+        for key, val in row.items():
+            print(f"  {key:20} {val:12.3f}" if isinstance(val, float) else f"  {key:20} {val:12}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Local stand-in for the GeoFS map endpoint.
+
+    python tools/fake_upstream.py --port 8765 --aircraft 3000 --delay 0.05
+    UPSTREAM_URL=http://127.0.0.1:8765/map python geofs_live_radar.py
+
+    # a flaky mirror: 10% of answers take 2 s more, 5% fail with 503
+    python tools/fake_upstream.py --port 8766 --slow-p 0.1 --slow-delay 2 --fail-p 0.05
+
+POST /map returns a synthetic payload whose aircraft move a little on every
+request. GET /_stats reports how many requests and TCP connections the
+server has seen, which shows whether the proxy reuses its connections.
+POST /_faults with a JSON object of any of delay, jitter, slow_p,
+slow_delay and fail_p changes the injected latency and failures while it
+runs.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from synthetic import make_users, step
+
+FAULTS = ("delay", "jitter", "slow_p", "slow_delay", "fail_p")
+
+class State:
+    def __init__(self, aircraft, delay, jitter, seed, slow_p=0.0, slow_delay=0.0, fail_p=0.0):
+        self.users = make_users(aircraft, seed)
+        self.rnd = random.Random(seed)
+        self.delay = delay
+        self.jitter = jitter
+        self.slow_p = slow_p
+        self.slow_delay = slow_delay
+        self.fail_p = fail_p
+        self.requests = 0
+        self.failures = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.last_step = time.monotonic()
+
+    def payload(self):
+        with self.lock:
+            now = time.monotonic()
+            step(self.users, self.rnd, now - self.last_step)
+            self.last_step = now
+            self.requests += 1
+            return json.dumps({"userCount": len(self.users), "users": self.users}).encode()
+
+    def latency(self):
+        """(seconds to wait, whether to fail) for the next request."""
+        with self.lock:
+            wait = self.delay + self.rnd.uniform(-self.jitter, self.jitter)
+            if self.rnd.random() < self.slow_p:
+                wait += self.slow_delay
+            fail = self.rnd.random() < self.fail_p
+            if fail:
+                self.failures += 1
+            return max(0.0, wait), fail
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.connections += 1
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path == "/_faults":
+                try:
+                    changes = json.loads(body or b"{}")
+                    with state.lock:
+                        for key in FAULTS:
+                            if key in changes:
+                                setattr(state, key, float(changes[key]))
+                except (ValueError, TypeError, AttributeError):
+                    self.send_error(400)
+                    return
+                self._send(json.dumps({key: getattr(state, key) for key in FAULTS}).encode())
+                return
+            wait, fail = state.latency()
+            time.sleep(wait)
+            if fail:
+                self._send(b'{"error":"injected failure"}', 503)
+                return
+            self._send(state.payload())
+
+        def do_GET(self):
+            if self.path != "/_stats":
+                self.send_error(404)
+                return
+            self._send(json.dumps({"requests": state.requests, "connections": state.connections,
+                                   "failures": state.failures}).encode())
+
+        def _send(self, body, status=200):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def serve(port, aircraft=2000, delay=0.0, jitter=0.0, seed=1, host="127.0.0.1",
+          slow_p=0.0, slow_delay=0.0, fail_p=0.0):
+    """Start the server in a background thread and return it."""
+    state = State(aircraft, delay, jitter, seed, slow_p, slow_delay, fail_p)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.state = state
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--aircraft", type=int, default=2000)
+    ap.add_argument("--delay", type=float, default=0.0, help="seconds added to every response")
+    ap.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of random extra delay")
+    ap.add_argument("--slow-p", type=float, default=0.0, help="chance that a response is slowed down")
+    ap.add_argument("--slow-delay", type=float, default=0.0, help="seconds added to a slowed response")
+    ap.add_argument("--fail-p", type=float, default=0.0, help="chance that a response is a 503")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    serve(args.port, args.aircraft, args.delay, args.jitter, args.seed, args.host,
+          args.slow_p, args.slow_delay, args.fail_p)
+    print(f"stand-in upstream on http://{args.host}:{args.port}/map ({args.aircraft} aircraft)")
+    threading.Event().wait()
+
+if __name__ == "__main__":
+    main()
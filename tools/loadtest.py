@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Hold many concurrent pollers/stream subscribers against the radar and measure memory.
+
+    python tools/loadtest.py --mode asgi --clients 2000 --kind stream
+    python tools/loadtest.py --mode wsgi --clients 200 --kind poll
+
+Starts a stand-in upstream (tools/fake_upstream.py) and the radar in the
+chosen mode, opens --clients connections, keeps them busy for --duration
+seconds and prints the server's resident memory before and after, the
+connections served per MB, and poll latency percentiles. WSGI mode uses
+gunicorn (gthread) when it is installed and Flask's threaded server
+otherwise. Memory is read from /proc, so this is Linux-only.
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_upstream import serve
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+QUERY = "tags=%5BU%5D,%5BPMC%5D&fields=id,acid,cs,co,ac,st.as"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def rss_kb(pid):
+    """Resident memory of `pid` and all its descendants, in KiB."""
+    total = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                pids += [int(c) for c in f.read().split()]
+        except OSError:
+            continue
+    return total
+
+def start_server(mode, port, upstream_port, workers, threads):
+    env = dict(os.environ, UPSTREAM_URL=f"http://127.0.0.1:{upstream_port}/map",
+               CACHE_DIR=tempfile.mkdtemp(prefix="radar-load-"), PORT=str(port),
+               MAX_STREAMS="100000")
+    if mode == "asgi":
+        cmd = [sys.executable, "geofs_live_radar.py", "--asgi"]
+    elif shutil.which("gunicorn"):
+        cmd = ["gunicorn", "-k", "gthread", "-w", str(workers), "--threads", str(threads),
+               "-b", f"127.0.0.1:{port}", "--log-level", "warning", "geofs_live_radar:app"]
+    else:
+        cmd = [sys.executable, "geofs_live_radar.py"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, start_new_session=True)
+    for _ in range(100):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit(f"server did not start: {' '.join(cmd)}")
+
+async def http_get(reader, writer, path):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: load\r\nAccept-Encoding: gzip\r\n\r\n".encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+    return status
+
+async def poller(port, interval, stop, stats):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    stats["connected"] += 1
+    try:
+        while not stop.is_set():
+            t = time.perf_counter()
+            status = await http_get(reader, writer, f"/api/map?{QUERY}")
+            stats["latency"].append(time.perf_counter() - t)
+            stats["ok" if status == 200 else "errors"] += 1
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        writer.close()
+
+async def subscriber(port, stop, stats):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET /api/stream?{QUERY} HTTP/1.1\r\nHost: load\r\n\r\n".encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    if b" 200 " not in head.split(b"\r\n", 1)[0]:
+        stats["errors"] += 1
+        writer.close()
+        return
+    stats["connected"] += 1
+    try:
+        while not stop.is_set():
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            stats["ok"] += chunk.count(b"event: map")
+    finally:
+        writer.close()
+
+async def run_clients(args, port, server_pid):
+    stop = asyncio.Event()
+    stats = {"connected": 0, "ok": 0, "errors": 0, "latency": []}
+    tasks = []
+    for i in range(args.clients):
+        if args.kind == "stream":
+            coro = subscriber(port, stop, stats)
+        else:
+            coro = poller(port, args.interval, stop, stats)
+        tasks.append(asyncio.ensure_future(coro))
+        if i % 100 == 99:
+            await asyncio.sleep(0.05)
+    await asyncio.sleep(args.duration)
+    rss = rss_kb(server_pid)
+    stop.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    stats["errors"] += sum(isinstance(r, Exception) for r in results)
+    return stats, rss
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--mode", choices=["wsgi", "asgi"], default="asgi")
+    ap.add_argument("--kind", choices=["poll", "stream"], default="stream")
+    ap.add_argument("--clients", type=int, default=500)
+    ap.add_argument("--duration", type=float, default=10.0)
+    ap.add_argument("--interval", type=float, default=2.0, help="seconds between polls per client")
+    ap.add_argument("--aircraft", type=int, default=2000)
+    ap.add_argument("--workers", type=int, default=2, help="gunicorn workers (wsgi mode)")
+    ap.add_argument("--threads", type=int, default=64, help="threads per gunicorn worker (wsgi mode)")
+    args = ap.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    upstream_port, port = free_port(), free_port()
+    upstream = serve(upstream_port, args.aircraft)
+    proc = start_server(args.mode, port, upstream_port, args.workers, args.threads)
+    try:
+        time.sleep(2.0)
+        idle = rss_kb(proc.pid)
+        stats, loaded = asyncio.run(run_clients(args, port, proc.pid))
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait()
+        upstream.shutdown()
+
+    lat = sorted(stats["latency"])
+    grown_mb = max(loaded - idle, 1) / 1024
+    print(f"mode={args.mode} kind={args.kind} clients={args.clients} duration={args.duration}s")
+    print(f"  connected          {stats['connected']}")
+    print(f"  responses/events   {stats['ok']}")
+    print(f"  errors             {stats['errors']}")
+    print(f"  rss idle           {idle / 1024:.1f} MB")
+    print(f"  rss loaded         {loaded / 1024:.1f} MB")
+    print(f"  connections per MB {stats['connected'] / grown_mb:.1f} (of growth), "
+          f"{stats['connected'] / (loaded / 1024):.1f} (of total)")
+    if lat:
+        print(f"  poll latency p50   {lat[len(lat) // 2] * 1000:.1f} ms")
+        print(f"  poll latency p95   {lat[int(len(lat) * 0.95)] * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Synthetic GeoFS /map payloads for benchmarks and the stand-in upstream.
+
+The shape follows the real endpoint: {"userCount": n, "users": [...]} with
+id, acid, cs, ac, co = [lat, lon, alt_m, heading, pitch, roll] and st.as.
+"""
+
+import json
+import math
+import random
+
+TAGS = ["[U]", "[PMC]", "[USSR]", "[JASDF]", "[NFS]", "[AEF]", "[MAC]", "[VKS]", ""]
+AIRCRAFT = [1, 2, 4, 7, 10, 18, 24, 25, 27, 29, 2310, 2581, 2857, 3591, 5229]
+
+def make_users(n, seed=1, tagged=0.3):
+    """`n` aircraft; roughly `tagged` of them carry a squadron tag."""
+    rnd = random.Random(seed)
+    users = []
+    for i in range(n):
+        tag = rnd.choice(TAGS[:-1]) if rnd.random() < tagged else ""
+        users.append({
+            "acid": 100000 + i,
+            "id": str(5000000 + i),
+            "cs": f"pilot{i}{tag}",
+            "ac": rnd.choice(AIRCRAFT),
+            "co": [rnd.uniform(-70, 70), rnd.uniform(-180, 180), rnd.uniform(0, 12000),
+                   rnd.uniform(0, 360), rnd.uniform(-5, 5), rnd.uniform(-20, 20)],
+            "st": {"gr": rnd.random() < 0.2, "as": rnd.uniform(0, 550)},
+        })
+    return users
+
+def step(users, rnd, dt=1.0):
+    """Move every airborne aircraft along its heading for `dt` seconds."""
+    for u in users:
+        if u["st"]["gr"]:
+            continue
+        co = u["co"]
+        co[3] = (co[3] + rnd.uniform(-2, 2)) % 360
+        nm = u["st"]["as"] * dt / 3600
+        rad = math.radians(co[3])
+        co[0] = max(-85.0, min(85.0, co[0] + nm / 60 * math.cos(rad)))
+        co[1] = (co[1] + nm / 60 * math.sin(rad) + 540) % 360 - 180
+
+def make_payload(n, seed=1):
+    users = make_users(n, seed)
+    return json.dumps({"userCount": n, "users": users}).encode()